@@ -0,0 +1,177 @@
+"""
+    Benchmark of the product extraction of the detail pages: the css queries building a ProductItem of raw
+    text nodes, against the single pass building a compact ProductRecord (COMPACT_ITEMS_ENABLED).
+    Reports the pages/sec of the extraction, the pages being parsed beforehand as the crawl does once per
+    page, and the memory held per product while it waits in the pipelines and the feed buffers, both as
+    extracted and once normalized by ScraperPipeline.
+
+    Run from the project directory (the one with scrapy.cfg):
+
+        python benchmarks/detail_extraction_benchmark.py
+        python benchmarks/detail_extraction_benchmark.py --fixtures fixtures/small
+
+    Without --fixtures, synthetic pages shaped like the rendered detail pages are used. With a fixture set
+    (see scrapy benchmark --record), the detail documents recorded in it are used.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from itemadapter import ItemAdapter
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+
+from scraper.fixtures import FixtureStore
+from scraper.pipelines import ScraperPipeline
+from scraper.spiders.tops_online_spider import TopsOnlineSpider
+
+
+SAMPLE_PRODUCTS = [
+    ("Ushibori Pure Apple Vinegar 500ml", "4970285850132", "270.00"),
+    ("Chao Thai Coconut Powder 60g", "8852114531602", "18.00"),
+    ("Zab Mike Pasteurized Thai Fermented Fish Sauce 330ml.", "8858981500901", "40.00"),
+    ("Tops Jasmine Rice 5kg", "8853474012345", "1,290.00"),
+    ("Lay's Classic Potato Chips", "8850718801213", "35.00"),
+]
+DETAIL_PROPERTIES = [
+    ("Properties", "The product received may be subject to package modification and quantity from the manufacturer."),
+    ("Storage", "Keep in a cool and dry place, away from direct sunlight."),
+    ("Disclaimer", "We reserve the right to make any changes without prior notice. *The images used are for advertising purposes only."),
+]
+
+
+def synthetic_page(index):
+    name, bar_code, price = SAMPLE_PRODUCTS[index % len(SAMPLE_PRODUCTS)]
+    # the header, menu and footer of the rendered page are most of its DOM
+    menu = "".join(f'<li class="menu-item"><a href="/en/category-{item}">Category {item}</a></li>' for item in range(150))
+    images = "".join(f'<div class="thumb"><img src="https://assets.tops.co.th/{bar_code}-{image}" alt="{name}"></div>' for image in range(1, 4))
+    properties = "".join(
+        f'<div class="accordion-property">\n    <span class="title">{title}</span>\n    :\n    \n        <p>{text}</p>\n</div>'
+        for title, text in DETAIL_PROPERTIES
+    )
+    labels = '<div class="product-Details-seasonal-label"> Sale </div>' if index % 3 == 0 else ""
+    body = f"""<html><head><title>{name}</title></head><body>
+        <header><nav><ul>{menu}</ul></nav></header>
+        <div class="product-Details-page-root">
+            <h1 class="product-tile__name">{name}</h1>
+            <div class="product-Details-images">{images}</div>
+            <div class="product-Details-sku">SKU {bar_code}</div>
+            <div class="product-Details-current-price">฿{price}</div>
+            {labels}
+            <div class="product-Details-promo"><span class="promo-name"> Buy 2 <b>save 10%</b> </span></div>
+            <div class="accordion">{properties}</div>
+            <button class="add-to-cart">Add to cart</button>
+        </div>
+        <footer>{menu}</footer>
+    </body></html>"""
+    return f"https://www.tops.co.th/en/product-{index}-{bar_code}", body.encode("utf-8")
+
+
+def recorded_pages(directory):
+    store = FixtureStore(directory)
+    pages = []
+    for entry in store.index.values():
+        if entry["stage"] == "detail" and entry["resource_type"] == "document" and entry["status"] == 200:
+            pages.append((entry["url"], store.read_body(entry)))
+    return pages
+
+
+def responses(pages, count):
+    result = []
+    for index in range(count):
+        url, body = pages[index % len(pages)]
+        extra_data = {"url": url, "category": "Pantry & Ingredients", "subcategory": "Seasonings & Spices"}
+        response = HtmlResponse(url, body=body, encoding="utf-8", request=Request(url, meta={"extra_data": extra_data}))
+        # parsed once per page by the crawl whichever way it is read, kept out of the timings
+        response.selector
+        result.append(response)
+    return result
+
+
+class BenchmarkSpider(TopsOnlineSpider):
+    failed_items = 0
+
+    def __init__(self, compact):
+        super().__init__()
+        self.settings = Settings({"COMPACT_ITEMS_ENABLED": compact})
+
+    @property
+    def logger(self):
+        return logging.getLogger("benchmark")
+
+
+def traced_bytes(run):
+    # the bytes still allocated once run returns, for what it returns
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = run()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename")), result
+
+
+def measure(name, spider, data, repeat):
+    """
+        Time the extraction of every page, best of repeat runs, then trace the memory held by the products
+        of one more run, as extracted and once normalized
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = [spider.extract_product(response) for response in data]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    del items
+
+    extracted, items = traced_bytes(lambda: [spider.extract_product(response) for response in data])
+    pipeline = ScraperPipeline()
+    normalized, items = traced_bytes(lambda: [pipeline.process_item(item, spider) for item in [spider.extract_product(response) for response in data]])
+
+    return {
+        "mode": name,
+        "pages_per_s": round(len(data) / best),
+        "extracted_bytes_per_item": round(extracted / len(data)),
+        "normalized_bytes_per_item": round(normalized / len(data)),
+        "sample": ItemAdapter(items[0]).asdict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the product extraction of the detail pages")
+    parser.add_argument("--fixtures", help="fixture set holding recorded detail pages (default: synthetic pages)")
+    parser.add_argument("--pages", type=int, default=2000, help="pages extracted per run (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each mode, the best is kept (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pages = recorded_pages(args.fixtures) if args.fixtures else [synthetic_page(index) for index in range(len(SAMPLE_PRODUCTS) * 3)]
+    if not pages:
+        parser.error(f"no detail pages recorded in {args.fixtures}")
+    data = responses(pages, args.pages)
+
+    results = [
+        measure("ProductItem, css queries", BenchmarkSpider(False), data, args.repeat),
+        measure("ProductRecord, one pass", BenchmarkSpider(True), data, args.repeat),
+    ]
+
+    print(f"{len(data)} pages, {len(pages)} distinct")
+    for result in results:
+        print(
+            f"{result['mode']:<26} {result['pages_per_s']:>7} pages/s"
+            f"  {result['extracted_bytes_per_item']:>6} B/item extracted  {result['normalized_bytes_per_item']:>6} B/item normalized"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+
+
+if __name__ == "__main__":
+    main()
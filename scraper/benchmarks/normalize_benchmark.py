@@ -0,0 +1,202 @@
+"""
+    Microbenchmark of the product normalization of ScraperPipeline, over a corpus of raw ProductItems.
+    Reports items/sec and the memory allocated per item for the per-item pipeline, the batches normalized
+    in process, the batches normalized by a worker pool, and the per-field loop the pipeline used before.
+
+    Run from the project directory (the one with scrapy.cfg):
+
+        python benchmarks/normalize_benchmark.py
+        python benchmarks/normalize_benchmark.py --corpus raw_items.jsonl --batch-size 500 --workers 4
+
+    Without --corpus, a synthetic corpus shaped like the raw items of the detail pages is used. A corpus of
+    recorded raw items is the feed of a crawl run without the item pipelines, e.g. replaying a fixture set:
+
+        scrapy crawl tops_online -s FIXTURES_REPLAY_DIR=fixtures/small -s ITEM_PIPELINES={} -O raw_items.jsonl
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from itemadapter import ItemAdapter
+
+from scraper.items import ProductItem
+from scraper.pipelines import ScraperPipeline, normalize_batch
+
+
+SAMPLE_PRODUCTS = [
+    ("Ushibori Pure Apple Vinegar 500ml", "4970285850132", "270.00"),
+    ("Chao Thai Coconut Powder 60g", "8852114531602", "18.00"),
+    ("Zab Mike Pasteurized Thai Fermented Fish Sauce 330ml.", "8858981500901", "40.00"),
+    ("Tops Jasmine Rice 5kg", "8853474012345", "1,290.00"),
+    ("Lay's Classic Potato Chips", "8850718801213", "35.00"),
+]
+DETAILS = [
+    "Properties", "\n                            :\n                            \n                                ",
+    "The product received may be subject to package modification and quantity from the manufacturer.",
+    "\nWe reserve the right to make any changes without prior notice. ", "\n*The images used are for advertising purposes only.",
+]
+
+
+class BenchmarkSpider:
+    name = "benchmark"
+    failed_items = 0
+    logger = logging.getLogger("benchmark")
+
+
+def synthetic_corpus(count):
+    rows = []
+    for index in range(count):
+        name, bar_code, price = SAMPLE_PRODUCTS[index % len(SAMPLE_PRODUCTS)]
+        rows.append({
+            "product_name": name,
+            "product_images": [f"https://assets.tops.co.th/{bar_code}-{image}" for image in range(1, 4)],
+            "category": "Pantry & Ingredients",
+            "subcategory": "Seasonings & Spices",
+            "categories": [{"category": "Pantry & Ingredients", "subcategory": "Seasonings & Spices"}],
+            "bar_code_number": f"SKU {bar_code}",
+            "product_details": list(DETAILS),
+            "price": f"฿{price}",
+            "labels": ["Sale"] if index % 3 == 0 else [],
+            "url": f"https://www.tops.co.th/en/product-{index}-{bar_code}",
+        })
+    return rows
+
+
+def load_corpus(path, count):
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    # repeated up to the requested size, so small recordings still give stable timings
+    return [dict(rows[index % len(rows)]) for index in range(max(count, len(rows)))]
+
+
+def legacy_process_item(item, spider):
+    # ScraperPipeline.process_item before the normalizers were precompiled, kept as the baseline
+    def split_name_quantity(name):
+        pattern = re.compile(r'\s+((\d+\.?\d*\s*(ml|L|g|kg|oz|pcs|lb|cc|oz|gal|m|cm))\.?)', re.IGNORECASE)
+        match = pattern.search(name)
+        if match:
+            volume = match.group(1)
+            name = " ".join(name.split(volume))
+            volume = match.group(2)
+            return name, volume
+        return name, None
+
+    def extract_bar_code(sku):
+        pattern = re.compile(r'\s?(\d+)', re.IGNORECASE)
+        match = pattern.search(sku)
+        return match.group(0).strip() if match else ""
+
+    def convert_price_to_float(price):
+        price = re.sub(r'[^\d\.]', '', price)
+        return float(price)
+
+    try:
+        adapter = ItemAdapter(item)
+        for field in adapter.field_names():
+            spider.logger.debug(f"field is {field}")
+            if 'product_name' == field:
+                spider.logger.debug(f"name and vol {adapter[field]}")
+                name, quantity = split_name_quantity(adapter[field])
+                spider.logger.debug(f"name and vol after {name}, {quantity}")
+                adapter["product_name"] = name.strip()
+                adapter["quantity"] = quantity
+            if 'product_details' == field:
+                adapter[field] = "".join(adapter[field]).strip()
+            if 'price' == field:
+                adapter[field] = convert_price_to_float(adapter[field])
+            if 'bar_code_number' == field:
+                adapter[field] = extract_bar_code(adapter[field])
+    except Exception as e:
+        spider.logger.error(f"Error processing item {item}: {e}")
+        spider.failed_items += 1
+    return item
+
+
+def chunks(rows, size):
+    return [rows[start:start + size] for start in range(0, len(rows), size)]
+
+
+def measure(name, corpus, run, prepare, repeat):
+    """
+        Time run over a fresh copy of the corpus, best of repeat runs, then trace the memory of one more run
+    """
+    best = None
+    for _ in range(repeat):
+        data = prepare(corpus)
+        start = time.perf_counter()
+        run(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    data = prepare(corpus)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = run(data)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    del result
+
+    return {
+        "mode": name,
+        "items_per_s": round(len(corpus) / best),
+        "peak_bytes_per_item": round(peak / len(corpus), 1),
+        "retained_allocations_per_item": round(retained / len(corpus), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the product normalization of ScraperPipeline")
+    parser.add_argument("--corpus", help="JSON lines of raw items (default: a synthetic corpus)")
+    parser.add_argument("--items", type=int, default=20000, help="corpus size (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each mode, the best is kept (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=500, help="items per batch (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the pool mode (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # the crawl logs at INFO, the debug calls are only formatted when they are emitted
+    logging.basicConfig(level=logging.INFO)
+    corpus = load_corpus(args.corpus, args.items) if args.corpus else synthetic_corpus(args.items)
+    spider = BenchmarkSpider()
+    pipeline = ScraperPipeline()
+
+    def items(rows):
+        return [ProductItem({field: list(value) if isinstance(value, list) else value for field, value in row.items()}) for row in rows]
+
+    def batches(rows):
+        return chunks([dict(row, product_details=list(row["product_details"])) for row in rows], args.batch_size)
+
+    with ProcessPoolExecutor(args.workers) as executor:
+        # started before the timings, the pool is started once per crawl
+        list(executor.map(normalize_batch, chunks(synthetic_corpus(args.workers), 1)))
+        results = [
+            measure("legacy per item", corpus, lambda data: [legacy_process_item(item, spider) for item in data], items, args.repeat),
+            measure("per item", corpus, lambda data: [pipeline.process_item(item, spider) for item in data], items, args.repeat),
+            measure("batch in process", corpus, lambda data: [normalize_batch(batch) for batch in data], batches, args.repeat),
+            measure(f"batch, {args.workers} workers", corpus, lambda data: list(executor.map(normalize_batch, data)), batches, args.repeat),
+        ]
+
+    print(f"{len(corpus)} items, {spider.failed_items} failed")
+    for result in results:
+        print(
+            f"{result['mode']:<22} {result['items_per_s']:>9} items/s"
+            f"  {result['peak_bytes_per_item']:>8} peak B/item  {result['retained_allocations_per_item']:>6} retained allocations/item"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+
+class Command(ScrapyCommand):
+    """
+        Replays the crawl of a spider from recorded fixture sets, each in its own process, and reports
+        pages/sec, items/sec, p50/p95 time per crawl stage and the CPU time and memory used by the browser.
+        With --record, the fixture sets are recorded from the live site first, using the spider arguments
+        configured for each set in BENCHMARK_FIXTURE_SETS
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] [fixture set ...]"
+
+    def short_desc(self):
+        return "Benchmark the crawl against recorded fixture sets"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--spider", default="tops_online", help="spider to benchmark (default: %(default)s)")
+        parser.add_argument("--runs", type=int, default=1, help="replays of each fixture set (default: %(default)s)")
+        parser.add_argument("--record", action="store_true", help="record the fixture sets from the live site first")
+        parser.add_argument("-o", "--output", help="also write the report as JSON to this file")
+
+    def run(self, args, opts):
+        fixture_sets = self.settings.getdict("BENCHMARK_FIXTURE_SETS")
+        fixtures_dir = self.settings.get("BENCHMARK_FIXTURES_DIR")
+        names = args or list(fixture_sets)
+        unknown = [name for name in names if name not in fixture_sets]
+        if unknown:
+            raise UsageError(f"Unknown fixture sets {unknown}, the configured ones are {list(fixture_sets)}")
+
+        if opts.record:
+            for name in names:
+                directory = os.path.join(fixtures_dir, name)
+                if os.path.exists(directory):
+                    raise UsageError(f"{directory} already exists, remove it to record the fixture set again")
+                print(f"Recording {name} into {directory}")
+                self.crawl(opts.spider, fixture_sets[name], {"FIXTURES_RECORD_DIR": directory})
+
+        report = {}
+        for name in names:
+            directory = os.path.join(fixtures_dir, name)
+            if not os.path.exists(os.path.join(directory, "index.jsonl")):
+                raise UsageError(f"No fixtures recorded in {directory}, run with --record first")
+            with open(os.path.join(directory, "fixture.json"), encoding="utf-8") as f:
+                spider_args = json.load(f)["spider_args"]
+
+            report[name] = []
+            for run in range(opts.runs):
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    stats_path = os.path.join(temp_dir, "benchmark.json")
+                    self.crawl(opts.spider, spider_args, {"FIXTURES_REPLAY_DIR": directory, "BENCHMARK_STATS_PATH": stats_path})
+                    with open(stats_path, encoding="utf-8") as f:
+                        result = json.load(f)
+                report[name].append(result)
+                self.print_result(name, run + 1, result)
+
+        if opts.output:
+            with open(opts.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+    def crawl(self, spider, spider_args, settings):
+        command = [sys.executable, "-m", "scrapy", "crawl", spider, "-s", "FEEDS={}", "-s", "LOG_LEVEL=WARNING"]
+        for name, value in settings.items():
+            command += ["-s", f"{name}={value}"]
+        for name, value in spider_args.items():
+            command += ["-a", f"{name}={value}"]
+        subprocess.run(command, check=True)
+
+    def print_result(self, name, run, result):
+        rss = result["browser_rss_peak_bytes"]
+        print(
+            f"{name} run {run}: {result['pages']} pages, {result['items']} items in {result['elapsed_s']}s"
+            f" | {result['pages_per_s']} pages/s, {result['items_per_s']} items/s"
+            f" | browser {result['browser_cpu_s']}s CPU, {rss // (1024 * 1024) if rss else '-'}MB peak RSS"
+            f" | {result['fixtures_missing']} missing fixtures"
+        )
+        for stage, latency in result["stages"].items():
+            print(f"    {stage:<12} {latency['count']:>6} pages  p50 {latency['p50_ms']:>6}ms  p95 {latency['p95_ms']:>6}ms")
@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from ..stores import ShardFrontier
+
+
+class Command(ScrapyCommand):
+    """
+        Runs a crawl split across several worker processes, each with its own browser. The workers claim
+        the home page, categories and subcategory lists from a SQLite frontier shared in SHARD_DIR, and a
+        product found by several of them is only rendered by the first one. Their feeds are merged into
+        one deduplicated product feed, with every category/subcategory each product was found under
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] <spider>"
+
+    def short_desc(self):
+        return "Run a crawl across several worker processes and merge their feeds"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="set spider argument (may be repeated)")
+        parser.add_argument("-w", "--workers", type=int, help="number of worker processes (default: SHARD_WORKERS)")
+        parser.add_argument("-o", "--output", required=True,
+                            help="merged feed, as a JSON array for .json and JSON lines otherwise")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        spider_name = args[0]
+        spidercls = self.crawler_process.spider_loader.load(spider_name)
+        workers = opts.workers or self.settings.getint("SHARD_WORKERS") or os.cpu_count()
+
+        shard_dir = self.settings.get("SHARD_DIR")
+        os.makedirs(shard_dir, exist_ok=True)
+        frontier_path = os.path.join(shard_dir, "frontier.sqlite3")
+        # every sharded crawl starts from scratch
+        for name in os.listdir(shard_dir):
+            if name.startswith("frontier.sqlite3") or name.startswith("worker-"):
+                os.remove(os.path.join(shard_dir, name))
+
+        frontier = ShardFrontier(frontier_path)
+        for url in spidercls.start_urls:
+            frontier.add("home", url, {})
+
+        processes = {}
+        restarts = {}
+        for worker in range(workers):
+            processes[worker] = self.start_worker(spider_name, opts.spargs, shard_dir, frontier_path, worker)
+            restarts[worker] = 0
+        print(f"Started {workers} workers, logs in {shard_dir}")
+
+        last_report = time.monotonic()
+        while processes:
+            time.sleep(1)
+            for worker, process in list(processes.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del processes[worker]
+                released = frontier.release(str(worker))
+                if returncode != 0:
+                    print(f"Worker {worker} exited with code {returncode}, {released} units handed back")
+                    if frontier.unfinished() and restarts[worker] < self.settings.getint("SHARD_MAX_RESTARTS"):
+                        restarts[worker] += 1
+                        processes[worker] = self.start_worker(spider_name, opts.spargs, shard_dir, frontier_path, worker)
+            if time.monotonic() - last_report >= self.settings.getfloat("SHARD_PROGRESS_INTERVAL"):
+                last_report = time.monotonic()
+                print(f"{len(processes)} workers running: {frontier.progress()}")
+
+        progress = frontier.progress()
+        if frontier.unfinished():
+            print(f"Some units were never finished: {progress}")
+        items = self.merge_feeds(
+            [os.path.join(shard_dir, f"worker-{worker}.jsonl") for worker in range(workers)],
+            frontier.memberships(),
+            opts.output,
+        )
+        frontier.close()
+        print(f"Merged {items} products into {opts.output}: {progress}")
+
+    def start_worker(self, spider_name, spider_args, shard_dir, frontier_path, worker):
+        feed = json.dumps({os.path.join(shard_dir, f"worker-{worker}.jsonl"): {"format": "jsonlines"}})
+        command = [
+            sys.executable, "-m", "scrapy", "crawl", spider_name,
+            "-s", f"FEEDS={feed}",
+            "-s", f"LOG_FILE={os.path.join(shard_dir, f'worker-{worker}.log')}",
+            "-s", f"SHARD_FRONTIER_PATH={frontier_path}",
+            "-s", f"SHARD_WORKER_ID={worker}",
+            # the products are merged from the feed of each worker
+            "-s", "BATCHED_EXPORT_ENABLED=False",
+            # the shard frontier already keeps what is left to do
+            "-s", "CHECKPOINT_ENABLED=False",
+            # each worker is its own process, only one can serve the live metrics on a given port
+            "-s", "CRAWL_METRICS_HTTP_PORT=0",
+        ]
+        for name, value in spider_args.items():
+            command += ["-a", f"{name}={value}"]
+        return subprocess.Popen(command)
+
+    def merge_feeds(self, paths, memberships, output):
+        """
+            Write the products of the worker feeds to output, once per url, with every category/subcategory
+            it was found under. Returns the number of products written
+        """
+        seen = set()
+        as_array = output.endswith(".json")
+        with open(output, "w", encoding="utf-8") as f:
+            if as_array:
+                f.write("[")
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                with open(path, encoding="utf-8") as feed:
+                    for line in feed:
+                        item = json.loads(line)
+                        if item.get("url") in seen:
+                            continue
+                        seen.add(item.get("url"))
+                        if item.get("url") in memberships:
+                            item["categories"] = memberships[item["url"]]
+                        if as_array:
+                            f.write(",\n" if len(seen) > 1 else "\n")
+                            f.write(json.dumps(item, ensure_ascii=False))
+                        else:
+                            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            if as_array:
+                f.write("\n]")
+        return len(seen)
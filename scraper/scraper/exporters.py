@@ -0,0 +1,182 @@
+# Writers for the part files of the batched export.
+#
+# A part is written to a temporary file next to its final path, batch by batch,
+# and renamed to the final path once it is complete, so a reader watching the
+# output directory only ever sees complete files.
+
+import gzip
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .normalizers import convert_price_to_float
+
+
+def parquet_schema():
+    # explicit, so every batch and every part has the same columns and types
+    return pyarrow.schema([
+        ("product_name", pyarrow.string()),
+        ("product_images", pyarrow.list_(pyarrow.string())),
+        ("image_files", pyarrow.list_(pyarrow.string())),
+        ("category", pyarrow.string()),
+        ("subcategory", pyarrow.string()),
+        ("categories", pyarrow.list_(pyarrow.struct([("category", pyarrow.string()), ("subcategory", pyarrow.string())]))),
+        ("quantity", pyarrow.string()),
+        ("bar_code_number", pyarrow.string()),
+        ("product_details", pyarrow.string()),
+        ("price", pyarrow.float64()),
+        ("labels", pyarrow.list_(pyarrow.string())),
+        ("url", pyarrow.string()),
+    ])
+
+
+def conform_value(value, value_type):
+    # an item the pipeline failed to normalize keeps raw values: the price as text, the details as text nodes...
+    if value is None:
+        return None
+    if pyarrow.types.is_string(value_type):
+        if isinstance(value, list):
+            return "".join(str(part) for part in value).strip()
+        return value if isinstance(value, str) else str(value)
+    if pyarrow.types.is_floating(value_type):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        if not isinstance(value, str):
+            return None
+        try:
+            return convert_price_to_float(value)
+        except ValueError:
+            return None
+    if pyarrow.types.is_list(value_type):
+        if isinstance(value, (str, dict)):
+            value = [value]
+        if not isinstance(value, (list, tuple)):
+            return None
+        return [conform_value(entry, value_type.value_type) for entry in value]
+    if pyarrow.types.is_struct(value_type):
+        if not isinstance(value, dict):
+            return None
+        return {field.name: conform_value(value.get(field.name), field.type) for field in value_type}
+    return value
+
+
+def conform_row(row, schema):
+    """
+        Return the columns of the schema from row, converted to the type of their column or set to None when they
+        can not be
+    """
+    return {field.name: conform_value(row.get(field.name), field.type) for field in schema}
+
+
+class JsonLinesPartWriter:
+    """
+        Writes items as JSON lines, optionally compressed with gzip or zstd
+    """
+    extensions = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.raw_file = open(self.temp_path, "wb")
+
+        if compression == "gzip":
+            self.file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+        elif compression == "zstd":
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw_file)
+        else:
+            self.file = self.raw_file
+
+    def write_batch(self, rows):
+        self.file.write(b"".join(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n" for row in rows))
+        self.file.flush()
+        self.raw_file.flush()
+
+    @property
+    def size(self):
+        # compressed size on disk
+        return self.raw_file.tell()
+
+    def close(self):
+        if self.file is not self.raw_file:
+            self.file.close()
+        self.raw_file.close()
+        os.replace(self.temp_path, self.path)
+
+
+class ParquetPartWriter:
+    """
+        Writes items as a Parquet file, one row group per batch
+    """
+    extensions = {None: ".parquet", "gzip": ".parquet", "zstd": ".parquet", "snappy": ".parquet"}
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.schema = parquet_schema()
+        self.raw_file = open(self.temp_path, "wb")
+        self.writer = pyarrow.parquet.ParquetWriter(self.raw_file, self.schema, compression=compression or "none")
+
+    def write_batch(self, rows):
+        """
+            Write rows as a row group. The rows still not matching the schema once conformed are left out and
+            appended to the rejects file next to the part, returns how many were
+        """
+        rows = [conform_row(row, self.schema) for row in rows]
+        try:
+            table = pyarrow.Table.from_pylist(rows, schema=self.schema)
+            rejected = []
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            # find the rows at fault, one at a time
+            accepted, rejected = [], []
+            for row in rows:
+                try:
+                    pyarrow.Table.from_pylist([row], schema=self.schema)
+                    accepted.append(row)
+                except (pyarrow.ArrowException, TypeError, ValueError):
+                    rejected.append(row)
+            table = pyarrow.Table.from_pylist(accepted, schema=self.schema)
+
+        if rejected:
+            with open(f"{self.path}.rejects.jsonl", "a", encoding="utf-8") as f:
+                for row in rejected:
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+        if table.num_rows:
+            self.writer.write_table(table)
+            self.raw_file.flush()
+        return len(rejected)
+
+    @property
+    def size(self):
+        return self.raw_file.tell()
+
+    def close(self):
+        self.writer.close()
+        self.raw_file.close()
+        os.replace(self.temp_path, self.path)
+
+
+PART_WRITERS = {
+    "jsonl": JsonLinesPartWriter,
+    "parquet": ParquetPartWriter,
+}
+
+
+def missing_dependency(export_format, compression):
+    """
+        Return the name of the optional package missing for the given format and compression, if any
+    """
+    if export_format == "parquet" and pyarrow is None:
+        return "pyarrow"
+    if export_format == "jsonl" and compression == "zstd" and zstandard is None:
+        return "zstandard"
+    return None
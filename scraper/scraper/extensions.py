@@ -0,0 +1,326 @@
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import json
+import os
+import time
+
+from scrapy import signals, exceptions
+from twisted.internet import task
+from twisted.web import server, resource
+
+from .metrics import child_processes, histogram_buckets, percentile, prometheus_text
+
+
+class BenchmarkStats:
+    """
+        Collects the figures reported by the benchmark command and writes them to BENCHMARK_STATS_PATH when the spider closes:
+        pages and items per second, p50/p95 download time (including the page readiness checks) per crawl stage,
+        and the CPU time and memory used by the browser processes, sampled every BENCHMARK_SAMPLE_INTERVAL seconds
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.path = crawler.settings.get('BENCHMARK_STATS_PATH')
+        self.sample_interval = crawler.settings.getfloat('BENCHMARK_SAMPLE_INTERVAL')
+
+        self.started = None
+        self.stage_latencies = {}
+        # last CPU time seen for each browser process, kept once the process exits
+        self.browser_cpu = {}
+        self.rss_samples = []
+        self.sampler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('BENCHMARK_STATS_PATH'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.response_received, signal=signals.response_received)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        self.started = time.monotonic()
+        self.sampler = task.LoopingCall(self.sample_browser)
+        self.sampler.start(self.sample_interval)
+
+    def response_received(self, response, request, spider):
+        stage = request.meta.get("crawl_stage")
+        if stage and "download_latency" in request.meta:
+            self.stage_latencies.setdefault(stage, []).append(request.meta["download_latency"] * 1000)
+
+    def sample_browser(self):
+        processes = child_processes()
+        if processes is None:
+            return
+        self.rss_samples.append(sum(rss for rss, _ in processes.values()))
+        for pid, (_, cpu) in processes.items():
+            self.browser_cpu[pid] = cpu
+
+    def spider_closed(self, spider, reason):
+        if self.sampler.running:
+            self.sampler.stop()
+        self.sample_browser()
+
+        elapsed = time.monotonic() - self.started
+        stats = self.crawler.stats
+        pages = stats.get_value("response_received_count", 0)
+        items = stats.get_value("item_scraped_count", 0)
+
+        report = {
+            "reason": reason,
+            "elapsed_s": round(elapsed, 3),
+            "pages": pages,
+            "items": items,
+            "pages_per_s": round(pages / elapsed, 3) if elapsed else None,
+            "items_per_s": round(items / elapsed, 3) if elapsed else None,
+            "stages": {
+                stage: {
+                    "count": len(latencies),
+                    "p50_ms": round(percentile(latencies, 50)),
+                    "p95_ms": round(percentile(latencies, 95)),
+                }
+                for stage, latencies in self.stage_latencies.items()
+            },
+            "browser_cpu_s": round(sum(self.browser_cpu.values()), 3),
+            "browser_rss_peak_bytes": max(self.rss_samples, default=None),
+            "browser_rss_mean_bytes": sum(self.rss_samples) // len(self.rss_samples) if self.rss_samples else None,
+            "fixtures_missing": stats.get_value("fixtures/missing", 0),
+        }
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+class CrawlMetrics:
+    """
+        Makes the progress of a running crawl visible.
+        The items coming out of the item pipelines are counted from the item_scraped, item_dropped and item_error
+        signals, and every CRAWL_METRICS_INTERVAL seconds the throughput, the time since the last item and the
+        queues of the engine are added to the stats.
+        The stats are served in the Prometheus text format on CRAWL_METRICS_HTTP_PORT (/metrics) and written
+        as JSON to CRAWL_METRICS_JSON_PATH, when set
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = crawler.settings.getfloat('CRAWL_METRICS_INTERVAL')
+        self.http_port = crawler.settings.getint('CRAWL_METRICS_HTTP_PORT')
+        self.json_path = crawler.settings.get('CRAWL_METRICS_JSON_PATH')
+        self.buckets = histogram_buckets(crawler.settings, 'CRAWL_METRICS_HISTOGRAM_BUCKETS_MS')
+
+        self.started = None
+        self.last_sample = None
+        self.ticker = None
+        self.listener = None
+        # items out of the pipelines so far by outcome, and when the last one came out
+        self.item_outcomes = {"scraped": 0, "dropped": 0, "error": 0}
+        self.last_item_at = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CRAWL_METRICS_ENABLED'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_error, signal=signals.item_error)
+        return s
+
+    def spider_opened(self, spider):
+        self.started = time.monotonic()
+        self.last_sample = (self.started, dict(self.item_outcomes), 0)
+
+        self.ticker = task.LoopingCall(self.tick)
+        self.ticker.start(self.interval, now=False)
+        if self.http_port:
+            from twisted.internet import reactor
+            self.listener = reactor.listenTCP(self.http_port, server.Site(MetricsResource(self.stats)), interface="127.0.0.1")
+            spider.logger.info(f"CrawlMetrics serving the crawl stats on http://127.0.0.1:{self.http_port}/metrics")
+
+    def item_scraped(self, item, response, spider):
+        self.item_out("scraped")
+
+    def item_dropped(self, item, response, exception, spider):
+        self.item_out("dropped")
+
+    def item_error(self, item, response, spider, failure):
+        self.item_out("error")
+
+    def item_out(self, outcome):
+        self.item_outcomes[outcome] += 1
+        self.last_item_at = time.monotonic()
+        self.stats.inc_value(f"crawl/items_{outcome}")
+
+    def tick(self):
+        now = time.monotonic()
+        pages = self.stats.get_value("response_received_count", 0)
+        last_time, last_outcomes, last_pages = self.last_sample
+        self.last_sample = (now, dict(self.item_outcomes), pages)
+
+        # throughput over the last interval, to see a crawl slowing down or stalling
+        self.stats.set_value("crawl/pages_per_minute", round((pages - last_pages) * 60 / (now - last_time), 2))
+        self.stats.set_value("crawl/items_per_minute", round((self.item_outcomes["scraped"] - last_outcomes["scraped"]) * 60 / (now - last_time), 2))
+        self.stats.set_value("crawl/dropped_items_per_minute", round((self.item_outcomes["dropped"] - last_outcomes["dropped"]) * 60 / (now - last_time), 2))
+        self.stats.set_value("crawl/item_errors_per_minute", round((self.item_outcomes["error"] - last_outcomes["error"]) * 60 / (now - last_time), 2))
+        self.stats.set_value("crawl/seconds_since_last_item", round(now - (self.last_item_at or self.started)))
+        self.stats.set_value("crawl/elapsed_seconds", round(now - self.started))
+
+        engine = self.crawler.engine
+        self.stats.set_value("crawl/scheduled_requests", len(engine.slot.scheduler) if engine.slot else 0)
+        self.stats.set_value("crawl/downloading_requests", len(engine.downloader.active))
+        self.stats.set_value("crawl/scraping_responses", len(engine.scraper.slot.active) if engine.scraper.slot else 0)
+
+        if self.json_path:
+            self.write_json()
+
+    def write_json(self):
+        temp_path = f"{self.json_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.stats.get_stats(), f, indent=2, sort_keys=True, default=str)
+        os.replace(temp_path, self.json_path)
+
+    def spider_closed(self, spider):
+        if self.ticker and self.ticker.running:
+            self.ticker.stop()
+        if self.json_path:
+            self.write_json()
+        if self.listener:
+            return self.listener.stopListening()
+
+
+class StageAutoThrottle:
+    """
+        Adjusts how many pages of each crawl stage the browser pool opens at the same time.
+        Every STAGE_AUTOTHROTTLE_INTERVAL seconds, for each stage:
+        - when more than STAGE_AUTOTHROTTLE_MAX_FAILURE_RATE of its requests failed, its concurrency is halved
+        - when the server (time to the first byte of the page) or the browser (the rest of the download) got more than
+          STAGE_AUTOTHROTTLE_LATENCY_FACTOR times slower than the fastest seen so far, its concurrency is lowered by one
+        - otherwise, when all of its pages were in use and it is below its STAGE_AUTOTHROTTLE_TARGET_PAGES_PER_MINUTE,
+          its concurrency is raised by one
+        Each decision is counted in the autothrottle/<stage>/* stats
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.interval = settings.getfloat('STAGE_AUTOTHROTTLE_INTERVAL')
+        self.min_concurrency = settings.getint('STAGE_AUTOTHROTTLE_MIN_CONCURRENCY')
+        self.max_concurrency = settings.getdict('STAGE_AUTOTHROTTLE_MAX_CONCURRENCY')
+        self.targets = settings.getdict('STAGE_AUTOTHROTTLE_TARGET_PAGES_PER_MINUTE')
+        self.max_failure_rate = settings.getfloat('STAGE_AUTOTHROTTLE_MAX_FAILURE_RATE')
+        self.latency_factor = settings.getfloat('STAGE_AUTOTHROTTLE_LATENCY_FACTOR')
+
+        self.pool = None
+        self.ticker = None
+        self.saturation_sampler = None
+        # latencies of the pages downloaded during the current interval, per (stage, phase)
+        self.latencies = {}
+        # fastest median latency seen over an interval, per (stage, phase)
+        self.baselines = {}
+        self.last_counts = {}
+        self.was_saturated = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('STAGE_AUTOTHROTTLE_ENABLED'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.response_received, signal=signals.response_received)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        self.pool = next((middleware for middleware in self.crawler.engine.downloader.middleware.middlewares if hasattr(middleware, "set_concurrency")), None)
+        if self.pool is None:
+            spider.logger.warning("StageAutoThrottle needs PlaywrightPoolMiddleware (BROWSER_POOL_ENABLED), disabled")
+            return
+
+        for stage, limiter in self.pool.stage_slots.items():
+            self.stats.set_value(f"autothrottle/{stage}/concurrency", limiter.limit)
+            self.last_counts[stage] = (0, 0)
+        self.ticker = task.LoopingCall(self.adjust)
+        self.ticker.start(self.interval, now=False)
+        # sampled more often than adjusted, a burst filling the stage between two adjustments still counts
+        self.saturation_sampler = task.LoopingCall(self.sample_saturation)
+        self.saturation_sampler.start(min(1, self.interval), now=False)
+
+    def response_received(self, response, request, spider):
+        stage = request.meta.get("crawl_stage")
+        timing = request.meta.get("download_timing") or {}
+        for phase in ("server", "render"):
+            if phase in timing:
+                self.latencies.setdefault((stage, phase), []).append(timing[phase])
+
+    def sample_saturation(self):
+        for stage, limiter in self.pool.stage_slots.items():
+            if limiter.saturated:
+                self.was_saturated[stage] = True
+
+    def adjust(self):
+        for stage, limiter in self.pool.stage_slots.items():
+            done = self.stats.get_value(f"timing/{stage}/download/count", 0)
+            failed = self.stats.get_value(f"timing/{stage}/failed", 0)
+            last_done, last_failed = self.last_counts[stage]
+            self.last_counts[stage] = (done, failed)
+            done, failed = done - last_done, failed - last_failed
+            saturated = self.was_saturated.pop(stage, False)
+
+            slower = []
+            for phase in ("server", "render"):
+                latencies = self.latencies.pop((stage, phase), [])
+                if not latencies:
+                    continue
+                median = percentile(latencies, 50)
+                baseline = self.baselines.setdefault((stage, phase), median)
+                self.stats.set_value(f"autothrottle/{stage}/{phase}_p50_ms", round(median))
+                if median > baseline * self.latency_factor:
+                    slower.append(phase)
+                self.baselines[(stage, phase)] = min(baseline, median)
+
+            pages_per_minute = done * 60 / self.interval
+            target = self.targets.get(stage)
+            concurrency = limiter.limit
+
+            if done + failed and failed / (done + failed) > self.max_failure_rate:
+                self.set_concurrency(stage, max(self.min_concurrency, concurrency // 2), "failures")
+            elif slower:
+                self.set_concurrency(stage, max(self.min_concurrency, concurrency - 1), f"{slower[0]}_latency")
+            elif saturated and (target is None or pages_per_minute < target):
+                self.set_concurrency(stage, min(self.max_concurrency.get(stage, concurrency), concurrency + 1), "increase")
+
+    def set_concurrency(self, stage, concurrency, reason):
+        current = self.pool.stage_slots[stage].limit
+        if concurrency == current:
+            return
+        self.pool.set_concurrency(stage, concurrency)
+        self.stats.set_value(f"autothrottle/{stage}/concurrency", concurrency)
+        self.stats.inc_value(f"autothrottle/{stage}/{'raised' if concurrency > current else 'lowered'}")
+        if concurrency < current:
+            self.stats.inc_value(f"autothrottle/{stage}/lowered/{reason}")
+        self.crawler.spider.logger.info(f"StageAutoThrottle: {stage} concurrency {current} -> {concurrency} ({reason})")
+
+    def spider_closed(self, spider):
+        for loop in (self.ticker, self.saturation_sampler):
+            if loop and loop.running:
+                loop.stop()
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return prometheus_text(self.stats.get_stats()).encode("utf-8")
@@ -0,0 +1,238 @@
+# Helpers for pulling product data out of pages without a browser.
+#
+# The detail pages are rendered by JavaScript, but the server-side HTML still
+# carries most of what the spider needs in structured form (JSON-LD and
+# OpenGraph/product meta tags), and the product lists are filled from JSON XHR
+# responses. These helpers read that data so the spider can skip Playwright
+# renders whenever it is complete enough.
+
+import json
+from urllib.parse import urljoin
+
+from lxml import etree
+from w3lib.html import remove_tags
+
+
+def _iter_json_ld(response):
+    for script in response.css('script[type="application/ld+json"]::text').getall():
+        try:
+            yield json.loads(script)
+        except ValueError:
+            continue
+
+
+def _find_typed_object(data, type_name):
+    # JSON-LD may be a single object, a list of objects or an object with a "@graph"
+    if isinstance(data, list):
+        for entry in data:
+            found = _find_typed_object(entry, type_name)
+            if found:
+                return found
+    elif isinstance(data, dict):
+        types = data.get("@type")
+        if types == type_name or (isinstance(types, list) and type_name in types):
+            return data
+        if "@graph" in data:
+            return _find_typed_object(data["@graph"], type_name)
+    return None
+
+
+def extract_embedded_product(response):
+    """
+        Return the raw product fields found in the JSON-LD and meta tags of a detail page.
+        The values have the same shape as the ones collected by the spider from the rendered DOM,
+        so they can go through ScraperPipeline unchanged.
+    """
+    fields = {}
+
+    product = None
+    for data in _iter_json_ld(response):
+        product = _find_typed_object(data, "Product")
+        if product:
+            break
+
+    if product:
+        fields["product_name"] = product.get("name")
+
+        images = product.get("image") or []
+        if isinstance(images, str):
+            images = [images]
+        fields["product_images"] = [image for image in images if isinstance(image, str)]
+
+        fields["bar_code_number"] = product.get("gtin13") or product.get("gtin") or product.get("sku")
+
+        if product.get("description"):
+            fields["product_details"] = [product["description"]]
+
+        offers = product.get("offers") or {}
+        if isinstance(offers, list):
+            offers = offers[0] if offers else {}
+        price = offers.get("price") if isinstance(offers, dict) else None
+        if price is not None:
+            # the pipeline expects the price as text, the same as the rendered page
+            fields["price"] = str(price)
+
+    # OpenGraph / product meta tags are used for whatever the JSON-LD did not provide
+    if not fields.get("product_name"):
+        fields["product_name"] = response.css('meta[property="og:title"]::attr(content)').get()
+    if not fields.get("product_images"):
+        fields["product_images"] = response.css('meta[property="og:image"]::attr(content)').getall()
+    if not fields.get("price"):
+        fields["price"] = response.css('meta[property="product:price:amount"]::attr(content)').get()
+
+    return {field: value for field, value in fields.items() if value}
+
+
+# the elements of a rendered detail page the spider reads, and a few more to be told apart by their classes,
+# found in one walk of the page. A union of the css queries would walk the page once per query
+DETAIL_ELEMENTS = etree.XPath("//*[contains(@class, 'product-') or contains(@class, 'accordion-property')]")
+
+
+def _first_text(element):
+    # the first text node of the element itself, like ::text
+    if element.text is not None:
+        return element.text
+    return next((child.tail for child in element if child.tail is not None), None)
+
+
+def _text(element):
+    # every text node below the element, like .//text()
+    return "".join(element.itertext())
+
+
+def extract_detail_fields(response):
+    """
+        Return the product fields of a rendered detail page, read in a single pass over its DOM with the text
+        already cleaned: the details are joined and the name, bar code, price and labels stripped
+    """
+    fields = {"product_name": None, "product_images": [], "bar_code_number": None, "price": None, "labels": []}
+    details = []
+
+    for element in DETAIL_ELEMENTS(response.selector.root):
+        classes = element.get("class").split()
+        if "accordion-property" in classes:
+            details.append(_text(element))
+        elif "product-Details-images" in classes:
+            fields["product_images"] += [image.get("src") for image in element.iter("img") if image.get("src") is not None]
+        elif "product-Details-seasonal-label" in classes:
+            fields["labels"].append(_text(element).strip())
+        elif "product-Details-promo" in classes:
+            fields["labels"] += [_text(promo).strip() for promo in element.iter() if "promo-name" in (promo.get("class") or "").split()]
+        else:
+            # the first one found wins, like .get()
+            for name, field in (("product-tile__name", "product_name"), ("product-Details-sku", "bar_code_number"), ("product-Details-current-price", "price")):
+                if name in classes and fields[field] is None:
+                    text = _first_text(element)
+                    fields[field] = text.strip() if text is not None else None
+
+    fields["labels"] = [label for label in fields["labels"] if label]
+    fields["product_details"] = "".join(details).strip()
+    return fields
+
+
+def extract_breadcrumb(response):
+    """
+        Return the names of the BreadcrumbList in the JSON-LD of a page, in order, or an empty list if it has none
+    """
+    for data in _iter_json_ld(response):
+        breadcrumb = _find_typed_object(data, "BreadcrumbList")
+        if not breadcrumb:
+            continue
+        elements = [element for element in breadcrumb.get("itemListElement") or [] if isinstance(element, dict)]
+        elements.sort(key=lambda element: element.get("position") or 0)
+        names = []
+        for element in elements:
+            name = element.get("name")
+            if not name and isinstance(element.get("item"), dict):
+                name = element["item"].get("name")
+            if isinstance(name, str) and name.strip():
+                names.append(remove_tags(name).strip())
+        return names
+    return []
+
+
+def _first(data, keys):
+    for key in keys:
+        value = data.get(key)
+        if value not in (None, "", [], {}):
+            return value
+    return None
+
+
+def _listing_price(product):
+    # Magento style "price_range.minimum_price.final_price.value" or a plain number/text
+    price = _first(product, ["price_range", "final_price", "special_price", "price"])
+    while isinstance(price, dict):
+        price = _first(price, ["minimum_price", "final_price", "regular_price", "value", "amount"])
+    return None if price is None else str(price)
+
+
+def _listing_images(product):
+    images = []
+    for key in ["media_gallery", "images", "image", "small_image", "thumbnail"]:
+        value = product.get(key)
+        if not value:
+            continue
+        for entry in value if isinstance(value, list) else [value]:
+            url = entry.get("url") if isinstance(entry, dict) else entry
+            if isinstance(url, str) and url not in images:
+                images.append(url)
+    return images
+
+
+def _listing_labels(product):
+    labels = []
+    for key in ["labels", "promotion_labels", "badges", "promotions"]:
+        for entry in product.get(key) or []:
+            label = _first(entry, ["name", "label", "text", "title"]) if isinstance(entry, dict) else entry
+            if isinstance(label, str) and label.strip():
+                labels.append(label.strip())
+    return labels
+
+
+def _listing_details(product):
+    details = _first(product, ["description", "short_description", "product_details"])
+    if isinstance(details, dict):
+        details = details.get("html")
+    if isinstance(details, str):
+        return [remove_tags(details)]
+    return None
+
+
+def _looks_like_product(data):
+    return isinstance(data, dict) and "name" in data and any(key in data for key in ["sku", "barcode", "gtin", "url_key"])
+
+
+def _iter_listing_products(data):
+    if _looks_like_product(data):
+        yield data
+    elif isinstance(data, dict):
+        for value in data.values():
+            yield from _iter_listing_products(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from _iter_listing_products(value)
+
+
+def products_from_listing_payload(payload, base_url):
+    """
+        Yield the raw product fields of every product found in a captured listing XHR payload.
+        The url of each product is made absolute against base_url
+    """
+    for product in _iter_listing_products(payload):
+        url = _first(product, ["url", "canonical_url", "url_key"])
+        if not isinstance(url, str):
+            continue
+        if product.get("url_suffix") and not url.endswith(product["url_suffix"]):
+            url += product["url_suffix"]
+
+        fields = {
+            "url": urljoin(base_url, url),
+            "product_name": product.get("name"),
+            "product_images": _listing_images(product),
+            "bar_code_number": _first(product, ["barcode", "gtin", "sku"]),
+            "product_details": _listing_details(product),
+            "price": _listing_price(product),
+            "labels": _listing_labels(product),
+        }
+        yield {field: value for field, value in fields.items() if value}
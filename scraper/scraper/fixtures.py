@@ -0,0 +1,193 @@
+# Recorded crawl fixtures, used to replay a crawl offline.
+#
+# A fixture set is a directory holding:
+#   - fixture.json: the start urls and spider arguments the set was recorded with
+#   - index.jsonl: one line per recorded response (key, url, status, headers, stage,
+#     resource type and the file of its body)
+#   - bodies/: the response bodies, named by the sha1 of their content
+#
+# Responses are keyed by method, url (without fragment and volatile query
+# parameters) and the sha1 of the request body, if any. When replaying, the
+# browser is served from the fixtures through page routes, so pages keep their
+# original origin and their XHRs behave as they did when recorded. Plain HTTP
+# requests go to a local HTTP server serving the same fixtures.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urljoin, urlsplit
+
+from w3lib.url import url_query_cleaner
+
+# headers describing how the body was transferred, which no longer holds once it is stored decoded
+HOP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+def fixture_key(method, url, body=None, ignored_query_params=()):
+    url = url.split("#", 1)[0]
+    if ignored_query_params:
+        url = url_query_cleaner(url, ignored_query_params, remove=True, unique=False)
+    key = f"{method.upper()} {url}"
+    if body:
+        key += f" {hashlib.sha1(body).hexdigest()}"
+    return key
+
+
+class FixtureStore:
+    """
+        The recorded responses of a fixture set, read from and appended to its directory
+    """
+
+    def __init__(self, directory, ignored_query_params=()):
+        self.directory = directory
+        self.ignored_query_params = list(ignored_query_params)
+        self.index = {}
+        self.index_file = None
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        index_path = os.path.join(directory, "index.jsonl")
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.index[entry["key"]] = entry
+
+    def key(self, method, url, body=None):
+        return fixture_key(method, url, body, self.ignored_query_params)
+
+    def get(self, method, url, body=None):
+        return self.index.get(self.key(method, url, body))
+
+    def read_body(self, entry):
+        if not entry["body"]:
+            return b""
+        with open(os.path.join(self.directory, "bodies", entry["body"]), "rb") as f:
+            return f.read()
+
+    def save(self, method, url, request_body, status, headers, body, stage=None, resource_type=None):
+        key = self.key(method, url, request_body)
+        if key in self.index:
+            # the first response recorded for a request is the one replayed
+            return
+
+        body_name = hashlib.sha1(body).hexdigest() if body else None
+        if body_name:
+            body_path = os.path.join(self.directory, "bodies", body_name)
+            if not os.path.exists(body_path):
+                with open(body_path, "wb") as f:
+                    f.write(body)
+
+        entry = {
+            "key": key,
+            "url": url,
+            "status": status,
+            "headers": {name: value for name, value in headers.items() if name.lower() not in HOP_HEADERS},
+            "body": body_name,
+            "stage": stage,
+            "resource_type": resource_type,
+        }
+        with self.lock:
+            self.index[key] = entry
+            if self.index_file is None:
+                self.index_file = open(os.path.join(self.directory, "index.jsonl"), "a", encoding="utf-8")
+            self.index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def read_metadata(self):
+        path = os.path.join(self.directory, "fixture.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_metadata(self, start_urls, spider_args):
+        with open(os.path.join(self.directory, "fixture.json"), "w", encoding="utf-8") as f:
+            json.dump({"start_urls": start_urls, "spider_args": spider_args, "recorded_at": time.time()}, f, indent=2)
+
+    def close(self):
+        with self.lock:
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+
+
+def local_path(url):
+    # http://localhost:<port>/<scheme>/<host>/<path>?<query> for <scheme>://<host>/<path>?<query>
+    parts = urlsplit(url)
+    path = f"/{parts.scheme}/{parts.netloc}{parts.path or '/'}"
+    return f"{path}?{parts.query}" if parts.query else path
+
+
+def original_url(path):
+    scheme, netloc, rest = (path.lstrip("/").split("/", 2) + ["", ""])[:3]
+    rest, _, query = rest.partition("?")
+    url = f"{scheme}://{netloc}/{rest}"
+    return f"{url}?{query}" if query else url
+
+
+class ReplayServer:
+    """
+        Local HTTP server serving the responses of a fixture set, started in a background thread
+    """
+
+    def __init__(self, store, port=0, on_missing=None):
+        self.store = store
+        self.on_missing = on_missing
+        self.server = ThreadingHTTPServer(("localhost", port), self.handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://localhost:{self.server.server_address[1]}"
+
+    def url_for(self, url):
+        return self.base_url + local_path(url)
+
+    def handler_class(self):
+        replay_server = self
+
+        class FixtureRequestHandler(BaseHTTPRequestHandler):
+            def serve(self):
+                length = int(self.headers.get("content-length") or 0)
+                body = self.rfile.read(length) if length else None
+                url = original_url(self.path)
+                entry = replay_server.store.get(self.command, url, body)
+
+                if entry is None:
+                    if replay_server.on_missing:
+                        replay_server.on_missing(url)
+                    self.send_error(404, "Not recorded")
+                    return
+
+                content = replay_server.store.read_body(entry)
+                self.send_response(entry["status"])
+                for name, value in entry["headers"].items():
+                    if name.lower() in ("server", "date"):
+                        # already sent by send_response
+                        continue
+                    if name.lower() == "location":
+                        # keep redirects within the fixtures
+                        value = replay_server.url_for(urljoin(entry["url"], value))
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = serve
+            do_POST = serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return FixtureRequestHandler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -3,18 +3,95 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
+from dataclasses import dataclass, field
+
 import scrapy
+from itemadapter import ItemAdapter
+from itemadapter.adapter import DataclassAdapter
 
 
 class ProductItem(scrapy.Item):
     # define the fields for your item here like:
     product_name = scrapy.Field()
     product_images = scrapy.Field()
+    image_files = scrapy.Field()
     category = scrapy.Field()
     subcategory = scrapy.Field()
+    # every {"category", "subcategory"} pair the product was found under
+    categories = scrapy.Field()
     quantity = scrapy.Field()
     bar_code_number = scrapy.Field()
     product_details = scrapy.Field()
     price = scrapy.Field()
     labels = scrapy.Field()
     url = scrapy.Field()
+
+
+class StoredProductItem(ProductItem):
+    # a product carried forward from the incremental store, already normalized
+    pass
+
+
+@dataclass(slots=True)
+class ProductRecord:
+    """
+        A compact product, built from a single pass over the detail page with its text already cleaned.
+        Read and written by field name like a ProductItem, so the spider, the pipelines and the feed
+        exporters handle both the same way. The fields a ProductItem only gets later (from the pipelines)
+        stay unset until then, so they are left out of the exported product as well
+    """
+    product_name: str = None
+    product_images: list = field(default_factory=list)
+    image_files: list = field(init=False, repr=False, compare=False)
+    category: str = None
+    subcategory: str = None
+    categories: list = None
+    quantity: str = field(init=False, repr=False, compare=False)
+    bar_code_number: str = None
+    product_details: str = None
+    price: str = None
+    labels: list = field(default_factory=list)
+    url: str = None
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ or not hasattr(self, key):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(f"ProductRecord does not support field: {key}")
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+
+class ProductRecordAdapter(DataclassAdapter):
+    """
+        ItemAdapter of the ProductRecords: an unset field is a missing key, as it is for a ProductItem,
+        instead of the AttributeError of its empty slot
+    """
+    @classmethod
+    def is_item(cls, item):
+        return isinstance(item, ProductRecord)
+
+    @classmethod
+    def is_item_class(cls, item_class):
+        return isinstance(item_class, type) and issubclass(item_class, ProductRecord)
+
+    def __getitem__(self, field_name):
+        try:
+            return super().__getitem__(field_name)
+        except AttributeError:
+            raise KeyError(field_name)
+
+
+# ahead of the generic dataclass adapter
+ItemAdapter.ADAPTER_CLASSES.appendleft(ProductRecordAdapter)
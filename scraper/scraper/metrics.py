@@ -0,0 +1,147 @@
+# Helpers for keeping simple metrics in the Scrapy stats collector
+
+import functools
+import math
+import numbers
+import os
+import re
+import time
+
+from twisted.internet.defer import Deferred
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+PROMETHEUS_LABEL_ESCAPES = re.compile(r'[\\"\n]')
+
+# upper bounds (in ms) of the histogram buckets, the last bucket catches everything above
+DEFAULT_BUCKETS_MS = [100, 250, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+def histogram_buckets(settings, name):
+    """
+        Read a list of bucket bounds (in ms) from the settings, as numbers even when given on the command line
+        (-s NAME=100,250,500)
+    """
+    return sorted(int(bound) for bound in settings.getlist(name))
+
+
+def record_histogram(stats, prefix, value_ms, buckets=None):
+    """
+        Add a duration to a histogram kept as flat stats keys:
+        <prefix>/count, <prefix>/total_ms, <prefix>/max_ms and one <prefix>/le_<bound>ms counter per bucket
+    """
+    buckets = buckets or DEFAULT_BUCKETS_MS
+    value_ms = int(value_ms)
+
+    stats.inc_value(f"{prefix}/count")
+    stats.inc_value(f"{prefix}/total_ms", value_ms)
+    stats.max_value(f"{prefix}/max_ms", value_ms)
+
+    for bound in buckets:
+        if value_ms <= bound:
+            stats.inc_value(f"{prefix}/le_{bound}ms")
+            return
+    stats.inc_value(f"{prefix}/gt_{buckets[-1]}ms")
+
+
+def timed_process_item(process_item):
+    """
+        Decorate the process_item of an item pipeline to time it into the timing/pipeline/<name> histogram when
+        CRAWL_METRICS_ENABLED is set, until the Deferred it returns fires for the asynchronous ones
+    """
+    @functools.wraps(process_item)
+    def timed(pipeline, item, spider):
+        crawler = getattr(spider, "crawler", None)
+        if crawler is None or not crawler.settings.getbool("CRAWL_METRICS_ENABLED"):
+            return process_item(pipeline, item, spider)
+
+        prefix = f"timing/pipeline/{type(pipeline).__name__}"
+        buckets = histogram_buckets(crawler.settings, "CRAWL_METRICS_HISTOGRAM_BUCKETS_MS")
+        start = time.perf_counter()
+
+        def record(result):
+            record_histogram(crawler.stats, prefix, (time.perf_counter() - start) * 1000, buckets)
+            return result
+
+        try:
+            result = process_item(pipeline, item, spider)
+        except Exception:
+            record(None)
+            raise
+        if isinstance(result, Deferred):
+            return result.addBoth(record)
+        return record(result)
+
+    return timed
+
+
+def prometheus_text(stats, prefix="scrapy"):
+    """
+        Render the numeric crawl stats in the Prometheus text format, as one gauge with the stat name as a label,
+        e.g. scrapy_stat{name="readiness/home/count"} 12
+    """
+    lines = [f"# TYPE {prefix}_stat gauge"]
+    for name, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, numbers.Number):
+            continue
+        label = PROMETHEUS_LABEL_ESCAPES.sub(lambda match: "\\" + ("n" if match.group() == "\n" else match.group()), name)
+        lines.append(f'{prefix}_stat{{name="{label}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def child_processes(pid=None):
+    """
+        Return the resident memory (in bytes) and CPU time used so far (in seconds) of each descendant of a process
+        (the browser and its renderers for the crawler process) as {pid: (rss, cpu)}, or None where /proc is not available
+    """
+    pid = pid or os.getpid()
+    children = {}
+    usage = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # the process name may contain spaces, the fields after it are space separated
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{entry}/statm") as f:
+                    resident_pages = int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            # utime and stime, in clock ticks
+            usage[int(entry)] = (resident_pages * PAGE_SIZE, (int(fields[11]) + int(fields[12])) / CLOCK_TICKS)
+    except OSError:
+        return None
+
+    descendants = {}
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        if child in usage:
+            descendants[child] = usage[child]
+        pending += children.get(child, [])
+    return descendants
+
+
+def child_processes_rss_bytes(pid=None):
+    """
+        Return the total resident memory of all the descendants of a process, or None where /proc is not available
+    """
+    descendants = child_processes(pid)
+    if descendants is None:
+        return None
+    return sum(rss for rss, _ in descendants.values())
+
+
+def percentile(values, q):
+    """
+        Return the q-th percentile (0-100) of a list of values, using the nearest rank
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
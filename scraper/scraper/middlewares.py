@@ -3,11 +3,45 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import asyncio
+import random
+import re
+import time
+from collections import deque
+
 from scrapy import signals, exceptions
+from twisted.internet import task
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
-from playwright.async_api import TimeoutError
+from playwright.async_api import TimeoutError, Error as PlaywrightError
+
+from .metrics import child_processes_rss_bytes, histogram_buckets, percentile, record_histogram
+from .readiness import harvest_binding
+from .fixtures import FixtureStore, ReplayServer
+
+
+class RetryScheduled(exceptions.IgnoreRequest):
+    """
+        The request failed and a retry of it was scheduled, raised so it leaves the downloader during the backoff
+    """
+
+
+def add_page_init_callback(request, callback):
+    """
+        Set the page init callback of a Playwright request, running the one already set by an earlier middleware
+        (if any) after it. The callbacks are only set while the request is downloaded, so the queued request stays serializable
+    """
+    previous = request.meta.get("playwright_page_init_callback")
+    if previous is None:
+        request.meta["playwright_page_init_callback"] = callback
+        return
+
+    async def init_page(page, request):
+        await callback(page, request)
+        await previous(page, request)
+
+    request.meta["playwright_page_init_callback"] = init_page
 
 
 class ScraperSpiderMiddleware:
@@ -57,6 +91,83 @@ class ScraperSpiderMiddleware:
         spider.logger.info(f"Spider opened: {spider.name}")
 
 
+class CallbackTimingMiddleware:
+    """
+        Records how long the spider callbacks take in the timing/callback/<name> histograms.
+        Only the time spent producing the results is counted, not the time the other middlewares spend on them.
+        The items are timed from the moment the callback yields them until the item_scraped, item_dropped or
+        item_error signal of their pipelines outcome, in the timing/item_pipelines/<outcome> histograms
+    """
+
+    def __init__(self, crawler):
+        self.stats = crawler.stats
+        self.buckets = histogram_buckets(crawler.settings, 'CRAWL_METRICS_HISTOGRAM_BUCKETS_MS')
+        # when each item in the pipelines was yielded, by id as items may be plain dicts
+        self.items_started = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CRAWL_METRICS_ENABLED'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_error, signal=signals.item_error)
+        return s
+
+    def item_scraped(self, item, response, spider):
+        self.item_done(item, "scraped")
+
+    def item_dropped(self, item, response, exception, spider):
+        self.item_done(item, "dropped")
+
+    def item_error(self, item, response, spider, failure):
+        self.item_done(item, "error")
+
+    def item_done(self, item, outcome):
+        started = self.items_started.pop(id(item), None)
+        if started is not None:
+            record_histogram(self.stats, f"timing/item_pipelines/{outcome}", (time.perf_counter() - started) * 1000, self.buckets)
+
+    def item_yielded(self, output):
+        if is_item(output):
+            self.items_started[id(output)] = time.perf_counter()
+
+    def callback_name(self, response, spider):
+        callback = response.request.callback if response.request is not None else None
+        return getattr(callback or spider.parse, "__name__", "unknown")
+
+    def process_spider_output(self, response, result, spider):
+        elapsed = 0
+        results = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                output = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            self.item_yielded(output)
+            yield output
+        record_histogram(self.stats, f"timing/callback/{self.callback_name(response, spider)}", elapsed * 1000, self.buckets)
+
+    async def process_spider_output_async(self, response, result, spider):
+        elapsed = 0
+        results = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                output = await results.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            self.item_yielded(output)
+            yield output
+        record_histogram(self.stats, f"timing/callback/{self.callback_name(response, spider)}", elapsed * 1000, self.buckets)
+
+
 class ScraperDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -110,31 +221,736 @@ class ScraperDownloaderMiddleware:
         spider.logger.info(f"Spider opened: {spider.name}")
 
 class PlaywrightRetryMiddleware:
+    """
+        Retries Playwright requests that timed out, after an exponential backoff with jitter. The failed request leaves
+        the downloader right away (with RetryScheduled) and its retry is sent to the engine once the backoff is over,
+        so requests waiting to be retried do not hold download slots.
+        The navigation and selector timeouts of each request are derived from the latencies observed for its crawl stage
+        (a percentile of the recent successful requests times ADAPTIVE_TIMEOUT_MULTIPLIER) instead of fixed constants,
+        and doubled on each retry. A per-host circuit breaker drops the download concurrency of a host while its failure
+        rate is over CIRCUIT_BREAKER_FAILURE_RATE. The product links harvested by a subcategory page before it failed are
+        kept on the retried request, so they are not lost if the list fails again
+    """
+
     def __init__(self, crawler):
-        self.retry_times = crawler.settings.getint('RETRY_TIMES', 3)
-        self.retry_http_codes = set(int(x) for x in crawler.settings.getlist('RETRY_HTTP_CODES'))
-        self.priority_adjust = crawler.settings.getint('RETRY_PRIORITY_ADJUST', -1)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.retry_times = settings.getint('RETRY_TIMES', 3)
+        self.retry_http_codes = set(int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
+        self.priority_adjust = settings.getint('RETRY_PRIORITY_ADJUST', -1)
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE')
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX')
+
+        self.adaptive_timeouts = settings.getbool('ADAPTIVE_TIMEOUT_ENABLED')
+        self.timeout_percentile = settings.getfloat('ADAPTIVE_TIMEOUT_PERCENTILE')
+        self.timeout_multiplier = settings.getfloat('ADAPTIVE_TIMEOUT_MULTIPLIER')
+        self.timeout_min_samples = settings.getint('ADAPTIVE_TIMEOUT_MIN_SAMPLES')
+        self.timeout_min_ms = settings.getint('ADAPTIVE_TIMEOUT_MIN_MS')
+        # the configured timeouts, used until enough latencies were observed and as upper bounds
+        self.timeout_max_ms = {
+            "navigation": settings.getint('PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT'),
+            "selector_wait": settings.getint('READINESS_SELECTOR_TIMEOUT_MS'),
+        }
+        # recent latencies of successful requests, per (stage, phase)
+        self.latencies = {}
+        self.latency_window = settings.getint('ADAPTIVE_TIMEOUT_WINDOW')
+
+        self.circuit_breaker = settings.getbool('CIRCUIT_BREAKER_ENABLED')
+        self.breaker_window = settings.getint('CIRCUIT_BREAKER_WINDOW')
+        self.breaker_min_requests = settings.getint('CIRCUIT_BREAKER_MIN_REQUESTS')
+        self.breaker_failure_rate = settings.getfloat('CIRCUIT_BREAKER_FAILURE_RATE')
+        self.breaker_concurrency = settings.getint('CIRCUIT_BREAKER_OPEN_CONCURRENCY')
+        self.breaker_cooldown = settings.getfloat('CIRCUIT_BREAKER_COOLDOWN')
+        # recent outcomes per downloader slot, and the open circuits with their original concurrency and opening time
+        self.outcomes = {}
+        self.open_circuits = {}
+        # retries waiting for their backoff to be over
+        self.delayed_retries = set()
 
     @classmethod
     def from_crawler(cls, crawler):
         s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
+    def process_request(self, request, spider):
+        if not request.meta.get("playwright"):
+            return None
+
+        stage = request.meta.get("crawl_stage")
+        retries = request.meta.get('retry_times', 0)
+        if self.adaptive_timeouts and stage:
+            navigation_timeout = self.timeout_for(stage, "navigation", retries)
+            request.meta["playwright_page_goto_kwargs"] = {**request.meta.get("playwright_page_goto_kwargs", {}), "timeout": navigation_timeout}
+            selector_timeout = self.timeout_for(stage, "selector_wait", retries)
+            for page_method in request.meta.get("playwright_page_methods") or []:
+                if page_method.method == "wait_for_selector":
+                    page_method.kwargs["timeout"] = selector_timeout
+            self.stats.set_value(f"adaptive_timeout/{stage}/navigation_ms", navigation_timeout)
+            self.stats.set_value(f"adaptive_timeout/{stage}/selector_wait_ms", selector_timeout)
+        return None
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        stage = request.meta.get("crawl_stage")
+        for phase, value_ms in (request.meta.get("download_timing") or {}).items():
+            self.latencies.setdefault((stage, phase), deque(maxlen=self.latency_window)).append(value_ms)
+        self.record_outcome(request, response.status < 500)
+        return response
+
     def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        if not isinstance(exception, exceptions.IgnoreRequest):
+            self.record_outcome(request, False)
+
         if isinstance(exception, TimeoutError) and request.meta.get("playwright", False):
             retries = request.meta.get('retry_times', 0) + 1
 
             if retries <= self.retry_times:
-                spider.logger.info(f"Retrying {request.url} due to playwright timeout (retry {retries}/{self.retry_times}).")
+                delay = self.backoff_delay(retries)
+                spider.logger.info(f"Retrying {request.url} due to playwright timeout in {delay:.1f}s (retry {retries}/{self.retry_times}).")
+                self.stats.inc_value("retry/playwright_timeout")
+                if request.meta.get("harvested_links"):
+                    self.stats.inc_value("retry/kept_harvested_links", len(request.meta["harvested_links"]))
+
                 retryreq = request.copy()
                 retryreq.meta['retry_times'] = retries
                 retryreq.dont_filter = True
                 retryreq.priority = request.priority + self.priority_adjust
-                return retryreq
+                self.schedule_retry(retryreq, delay)
+                raise RetryScheduled(f"retry of {request.url} scheduled in {delay:.1f}s")
             else:
                 spider.logger.info(f"Gave up retrying {request.url} after {retries} attempts.")
 
+    def schedule_retry(self, request, delay):
+        from twisted.internet import reactor
+
+        def send():
+            self.delayed_retries.discard(call)
+            self.crawler.engine.crawl(request)
+
+        call = reactor.callLater(delay, send)
+        self.delayed_retries.add(call)
+        self.stats.max_value("retry/delayed_max", len(self.delayed_retries))
+
+    def spider_idle(self, spider):
+        if self.delayed_retries:
+            # the retries still to be sent are the rest of the crawl
+            raise exceptions.DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in self.delayed_retries:
+            if call.active():
+                call.cancel()
+        self.delayed_retries.clear()
+
+    def timeout_for(self, stage, phase, retries):
+        """
+            Return the timeout (in ms) of a phase of a request of the given stage, after the given number of retries
+        """
+        timeout_max_ms = self.timeout_max_ms[phase]
+        latencies = self.latencies.get((stage, phase))
+        if not latencies or len(latencies) < self.timeout_min_samples:
+            return timeout_max_ms
+
+        timeout = percentile(list(latencies), self.timeout_percentile) * self.timeout_multiplier * 2 ** retries
+        return int(min(max(timeout, self.timeout_min_ms), timeout_max_ms))
+
+    def backoff_delay(self, retries):
+        # exponential, with half of it random so the retries of a burst of failures are spread out
+        delay = min(self.backoff_base * 2 ** (retries - 1), self.backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_outcome(self, request, success):
+        if not self.circuit_breaker:
+            return
+        slot_key = self.crawler.engine.downloader.get_slot_key(request)
+        outcomes = self.outcomes.setdefault(slot_key, deque(maxlen=self.breaker_window))
+        outcomes.append(success)
+
+        slot = self.crawler.engine.downloader.slots.get(slot_key)
+        if slot is None:
+            return
+
+        if slot_key in self.open_circuits:
+            concurrency, opened_at = self.open_circuits[slot_key]
+            if time.monotonic() - opened_at >= self.breaker_cooldown:
+                # closed again, the failures seen while it was open no longer count
+                slot.concurrency = concurrency
+                del self.open_circuits[slot_key]
+                outcomes.clear()
+                self.stats.inc_value("circuit_breaker/closed")
+                self.stats.set_value("circuit_breaker/open_hosts", len(self.open_circuits))
+                self.crawler.spider.logger.info(f"Circuit breaker closed for {slot_key}, concurrency back to {concurrency}")
+            return
+
+        failures = outcomes.count(False)
+        if len(outcomes) >= self.breaker_min_requests and failures / len(outcomes) >= self.breaker_failure_rate:
+            self.open_circuits[slot_key] = (slot.concurrency, time.monotonic())
+            slot.concurrency = min(slot.concurrency, self.breaker_concurrency)
+            self.stats.inc_value("circuit_breaker/opened")
+            self.stats.set_value("circuit_breaker/open_hosts", len(self.open_circuits))
+            self.crawler.spider.logger.info(f"Circuit breaker opened for {slot_key}: {failures}/{len(outcomes)} recent requests failed, concurrency down to {slot.concurrency} for {self.breaker_cooldown}s")
+
     def spider_opened(self, spider):
         spider.logger.info(f"PlaywrightRetryMiddleware initialized: RETRY_TIMES={self.retry_times}, RETRY_HTTP_CODES={list(self.retry_http_codes)}, RETRY_PRIORITY_ADJUST={self.priority_adjust}")
         spider.logger.info(f"Spider opened: {spider.name}")
+
+
+class HarvestedLinksMiddleware:
+    """
+        Exposes the function the scroll script of a subcategory page passes its product links to, batch by batch,
+        and keeps them in the "harvested_links" meta key of the request. So the links found before the page fails
+        are still known to the errback and to the retry of the request
+    """
+
+    def process_request(self, request, spider):
+        if request.meta.get("playwright") and request.meta.get("harvest_links"):
+            add_page_init_callback(request, self.expose_harvest_binding)
+        return None
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return None
+
+    async def expose_harvest_binding(self, page, request):
+        harvested_links = request.meta.setdefault("harvested_links", [])
+        await page.expose_function(harvest_binding, harvested_links.extend)
+
+
+class ResourceBlockingMiddleware:
+    """
+        Stops the browser from downloading resources the crawl does not need.
+        The resource types and url patterns to block are configured per crawl stage in RESOURCE_BLOCKING_POLICY,
+        and installed as a page route before the page navigates
+    """
+
+    def __init__(self, crawler):
+        self.stats = crawler.stats
+        self.policy = crawler.settings.getdict('RESOURCE_BLOCKING_POLICY')
+        self.estimated_bytes = crawler.settings.getdict('RESOURCE_BLOCKING_ESTIMATED_BYTES')
+        # average size of the responses actually downloaded, per resource type
+        self.observed_bytes = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RESOURCE_BLOCKING_ENABLED'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_request(self, request, spider):
+        if request.meta.get("playwright") and request.meta.get("crawl_stage") in self.policy:
+            add_page_init_callback(request, self.init_page)
+        return None
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return None
+
+    async def init_page(self, page, request):
+        stage = request.meta["crawl_stage"]
+        policy = self.policy[stage]
+        resource_types = set(policy.get("resource_types", []))
+        url_patterns = [re.compile(pattern) for pattern in policy.get("url_patterns", [])]
+
+        async def route_request(route, playwright_request):
+            resource_type = playwright_request.resource_type
+            if resource_type in resource_types or any(pattern.search(playwright_request.url) for pattern in url_patterns):
+                self.stats.inc_value(f"resource_blocking/{stage}/blocked")
+                self.stats.inc_value(f"resource_blocking/{stage}/blocked/{resource_type}")
+                self.stats.inc_value(f"resource_blocking/{stage}/bytes_saved_estimate", self.expected_size(resource_type))
+                await route.abort()
+            else:
+                # let scrapy-playwright handle the request as usual
+                await route.fallback()
+
+        page.on("response", self.observe_response_size)
+        await page.route("**/*", route_request)
+
+    def observe_response_size(self, response):
+        content_length = response.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            resource_type = response.request.resource_type
+            total, count = self.observed_bytes.get(resource_type, (0, 0))
+            self.observed_bytes[resource_type] = (total + int(content_length), count + 1)
+
+    def expected_size(self, resource_type):
+        # prefer what was actually seen for the same type of resource over the configured estimate
+        total, count = self.observed_bytes.get(resource_type, (0, 0))
+        if count:
+            return total // count
+        return self.estimated_bytes.get(resource_type, self.estimated_bytes.get("default", 0))
+
+    def spider_opened(self, spider):
+        spider.logger.info(f"ResourceBlockingMiddleware initialized for stages: {list(self.policy)}")
+
+
+class StageLimiter:
+    """
+        Cap on the pages of a crawl stage open at the same time, which can be raised or lowered while the crawl runs
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.waiters = deque()
+
+    @property
+    def saturated(self):
+        return self.in_use >= self.limit or bool(self.waiters)
+
+    async def acquire(self):
+        while self.in_use >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+        self.wake_up()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self.wake_up()
+
+    def wake_up(self):
+        for _ in range(min(self.limit - self.in_use, len(self.waiters))):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class PlaywrightPoolMiddleware:
+    """
+        Manages the browser contexts used by Playwright requests.
+        Each crawl stage gets its own contexts and concurrency cap from BROWSER_POOL_STAGES, as scroll pages are much heavier than detail pages.
+        A context is recycled (replaced by a fresh one, and closed once its pages are done) after BROWSER_POOL_RECYCLE_AFTER_PAGES pages,
+        and all of them are recycled when the browser uses more than BROWSER_POOL_MAX_RSS_MB.
+        Requests failing because the browser crashed are scheduled again, the browser itself is relaunched by scrapy-playwright.
+        With StageScheduler (SCHEDULER) the requests of a stage at its cap are held back before the downloader, so they never wait
+        for a page holding a download slot
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.stages = crawler.settings.getdict('BROWSER_POOL_STAGES')
+        self.recycle_after_pages = crawler.settings.getint('BROWSER_POOL_RECYCLE_AFTER_PAGES')
+        self.max_rss = crawler.settings.getint('BROWSER_POOL_MAX_RSS_MB') * 1024 * 1024
+        self.watchdog_interval = crawler.settings.getfloat('BROWSER_POOL_WATCHDOG_INTERVAL')
+        self.crash_retries = crawler.settings.getint('BROWSER_POOL_CRASH_RETRIES')
+
+        self.stage_slots = {stage: StageLimiter(config.get("concurrency", 1)) for stage, config in self.stages.items()}
+        self.pages_in_flight = {stage: 0 for stage in self.stages}
+        # the generation of each (stage, slot) context, bumped when the context is recycled
+        self.generations = {}
+        self.next_slot = {stage: 0 for stage in self.stages}
+        # pages served and pages still open, per context name
+        self.pages_served = {}
+        self.context_pages = {}
+        self.retired_contexts = set()
+        # the browser context behind each context name, seen from the pages opened in it
+        self.browser_contexts = {}
+        self.watchdog = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('BROWSER_POOL_ENABLED'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    async def process_request(self, request, spider):
+        stage = request.meta.get("crawl_stage")
+        if not request.meta.get("playwright") or stage not in self.stages or request.meta.get("pool_slot"):
+            return None
+
+        # StageScheduler only lets through what has_room allows, with it this only waits when a cap was lowered meanwhile
+        await self.stage_slots[stage].acquire()
+        self.pages_in_flight[stage] += 1
+        self.stats.set_value(f"browser_pool/pages_in_flight/{stage}", self.pages_in_flight[stage])
+        self.stats.max_value(f"browser_pool/max_pages_in_flight/{stage}", self.pages_in_flight[stage])
+
+        context_name = self.assign_context(stage)
+        request.meta["playwright_context"] = context_name
+        request.meta["pool_slot"] = context_name
+        add_page_init_callback(request, self.track_context)
+        return None
+
+    async def track_context(self, page, request):
+        # scrapy-playwright has no public way to reach its contexts, so they are closed through their pages' one
+        self.browser_contexts.setdefault(request.meta["playwright_context"], page.context)
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        page = response.meta.get("playwright_page") if request.meta.get("playwright_include_page") else None
+        if page and not page.is_closed():
+            # the callback still uses the page, keep the slot until it is closed
+            page.once("close", lambda _: self.release(request))
+        else:
+            self.release(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        context_name = request.meta.get("pool_slot")
+        if not context_name:
+            return None
+        # only the first request failing with a context has to recycle the pool
+        context_current = context_name not in self.retired_contexts
+        self.release(request)
+
+        if isinstance(exception, PlaywrightError) and ("closed" in str(exception) or "crash" in str(exception).lower()):
+            retries = request.meta.get('browser_crash_retries', 0) + 1
+            self.stats.inc_value("browser_pool/browser_errors")
+            if retries <= self.crash_retries:
+                spider.logger.info(f"Rescheduling {request.url} after the browser or its page was closed (retry {retries}/{self.crash_retries}).")
+                if context_current:
+                    # the old contexts went away with the browser
+                    self.recycle_all("crash")
+                retryreq = request.copy()
+                retryreq.meta['browser_crash_retries'] = retries
+                # set again by each middleware, and a bound method would keep the request from being persisted in JOBDIR
+                retryreq.meta.pop("playwright_page_init_callback", None)
+                retryreq.dont_filter = True
+                return retryreq
+        return None
+
+    def has_room(self, stage):
+        """
+            Whether a request of the stage would get a page right away, counting the requests of the stage already
+            in the downloader and not through this middleware yet
+        """
+        if stage not in self.stage_slots:
+            return True
+        arriving = sum(
+            1 for request in self.crawler.engine.downloader.active
+            if request.meta.get("crawl_stage") == stage and request.meta.get("playwright") and "pool_slot" not in request.meta
+        )
+        return self.stage_slots[stage].in_use + arriving < self.stage_slots[stage].limit
+
+    def set_concurrency(self, stage, concurrency):
+        """
+            Change how many pages of a stage can be open at the same time
+        """
+        self.stage_slots[stage].set_limit(concurrency)
+        self.stats.set_value(f"browser_pool/concurrency/{stage}", concurrency)
+        self.wake_engine()
+
+    def assign_context(self, stage):
+        # spread the pages of a stage over its contexts in turn
+        contexts = self.stages[stage].get("contexts", 1)
+        slot = self.next_slot[stage] % contexts
+        self.next_slot[stage] += 1
+
+        generation = self.generations.setdefault((stage, slot), 0)
+        context_name = f"{stage}-{slot}-{generation}"
+        self.pages_served[context_name] = self.pages_served.get(context_name, 0) + 1
+        self.context_pages[context_name] = self.context_pages.get(context_name, 0) + 1
+
+        if self.recycle_after_pages and self.pages_served[context_name] >= self.recycle_after_pages:
+            self.recycle((stage, slot), "pages")
+        return context_name
+
+    def release(self, request):
+        context_name = request.meta.pop("pool_slot", None)
+        if context_name is None:
+            return
+
+        stage = request.meta["crawl_stage"]
+        self.stage_slots[stage].release()
+        self.pages_in_flight[stage] -= 1
+        self.stats.set_value(f"browser_pool/pages_in_flight/{stage}", self.pages_in_flight[stage])
+
+        self.context_pages[context_name] -= 1
+        if context_name in self.retired_contexts and self.context_pages[context_name] <= 0:
+            asyncio.ensure_future(self.close_context(context_name))
+        self.wake_engine()
+
+    def wake_engine(self):
+        # a page closed by a callback frees its slot without any download finishing, so the engine would only
+        # send the requests StageScheduler held back for it on its next heartbeat
+        slot = getattr(self.crawler.engine, "slot", None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+    def recycle(self, key, reason):
+        stage, slot = key
+        old_name = f"{stage}-{slot}-{self.generations[key]}"
+        self.generations[key] += 1
+        self.retired_contexts.add(old_name)
+        self.stats.inc_value("browser_pool/recycled_contexts")
+        self.stats.inc_value(f"browser_pool/recycled_contexts/{reason}")
+
+        if self.context_pages.get(old_name, 0) <= 0:
+            asyncio.ensure_future(self.close_context(old_name))
+
+    def recycle_all(self, reason):
+        for key in list(self.generations):
+            self.recycle(key, reason)
+
+    async def close_context(self, context_name):
+        self.retired_contexts.discard(context_name)
+        self.pages_served.pop(context_name, None)
+        self.context_pages.pop(context_name, None)
+
+        context = self.browser_contexts.pop(context_name, None)
+        if context is not None:
+            try:
+                # scrapy-playwright forgets the context once it is closed
+                await context.close()
+            except PlaywrightError:
+                # already gone with the browser
+                pass
+        self.stats.set_value("browser_pool/contexts_open", len(self.browser_contexts))
+
+    def check_memory(self):
+        rss = child_processes_rss_bytes()
+        if rss is None:
+            return
+        self.stats.set_value("browser_pool/browser_rss_bytes", rss)
+        self.stats.max_value("browser_pool/max_browser_rss_bytes", rss)
+        self.stats.set_value("browser_pool/contexts_open", len(self.browser_contexts))
+
+        if self.max_rss and rss > self.max_rss:
+            self.crawler.spider.logger.info(f"Browser memory {rss // (1024 * 1024)}MB over the limit, recycling all contexts")
+            self.recycle_all("rss")
+
+    def spider_opened(self, spider):
+        if self.watchdog_interval:
+            self.watchdog = task.LoopingCall(self.check_memory)
+            self.watchdog.start(self.watchdog_interval, now=False)
+        spider.logger.info(f"PlaywrightPoolMiddleware initialized: stages={self.stages}, recycle after {self.recycle_after_pages} pages or {self.max_rss // (1024 * 1024)}MB")
+
+    def spider_closed(self, spider):
+        if self.watchdog and self.watchdog.running:
+            self.watchdog.stop()
+
+
+class FixtureRecorderMiddleware:
+    """
+        Records the responses of a crawl into the fixture set in FIXTURES_RECORD_DIR, to replay it offline later.
+        For browser requests every response the page receives (document, scripts, XHRs...) is recorded,
+        for plain HTTP requests the response itself
+    """
+
+    def __init__(self, crawler):
+        self.stats = crawler.stats
+        self.store = FixtureStore(crawler.settings.get('FIXTURES_RECORD_DIR'), crawler.settings.getlist('FIXTURES_IGNORED_QUERY_PARAMS'))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('FIXTURES_RECORD_DIR') or crawler.settings.get('FIXTURES_REPLAY_DIR'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if request.meta.get("playwright"):
+            add_page_init_callback(request, self.listen_to_responses)
+        return None
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        if not request.meta.get("playwright") and request.url.startswith("http"):
+            headers = {name.decode(): b", ".join(values).decode("latin-1") for name, values in response.headers.items()}
+            self.store.save(request.method, request.url, request.body, response.status, headers, response.body, request.meta.get("crawl_stage"), "document")
+            self.stats.inc_value(f"fixtures/recorded/{request.meta.get('crawl_stage')}")
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return None
+
+    async def listen_to_responses(self, page, request):
+        stage = request.meta.get("crawl_stage")
+
+        async def record(response):
+            await self.record_browser_response(response, stage)
+
+        page.on("response", record)
+
+    async def record_browser_response(self, response, stage):
+        try:
+            body = await response.body()
+        except PlaywrightError:
+            # redirects have no body
+            body = b""
+        request = response.request
+        self.store.save(request.method, request.url, request.post_data_buffer, response.status, response.headers, body, stage, request.resource_type)
+        self.stats.inc_value(f"fixtures/recorded/{stage}")
+
+    def spider_opened(self, spider):
+        spider_args = {name: getattr(spider, name) for name in getattr(spider, "crawl_limit_args", ()) if getattr(spider, name) is not None}
+        self.store.write_metadata(spider.start_urls, spider_args)
+        spider.logger.info(f"FixtureRecorderMiddleware recording into {self.store.directory}")
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+
+class FixtureReplayMiddleware:
+    """
+        Serves a crawl from the fixture set in FIXTURES_REPLAY_DIR instead of the live site.
+        Browser pages are fulfilled from the fixtures through a page route, keeping their original urls,
+        and plain HTTP requests are sent to a local server serving the same fixtures.
+        Requests that were not recorded fail, and are counted in fixtures/missing
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.store = FixtureStore(crawler.settings.get('FIXTURES_REPLAY_DIR'), crawler.settings.getlist('FIXTURES_IGNORED_QUERY_PARAMS'))
+        self.server = ReplayServer(self.store, crawler.settings.getint('FIXTURES_REPLAY_PORT'), on_missing=self.missing)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('FIXTURES_REPLAY_DIR'):
+            raise exceptions.NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if request.meta.get("playwright"):
+            # routed before the resource blocking rules, which are then applied first
+            add_page_init_callback(request, self.route_fixtures)
+            return None
+
+        if request.url.startswith("http") and not request.url.startswith(self.server.base_url):
+            # the local server is within allowed_domains
+            return request.replace(url=self.server.url_for(request.url), meta={**request.meta, "fixture_url": request.url}, dont_filter=True)
+        return None
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        if "fixture_url" in request.meta:
+            # the spider sees the url it asked for
+            return response.replace(url=request.meta["fixture_url"])
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        return None
+
+    async def route_fixtures(self, page, request):
+        stage = request.meta.get("crawl_stage")
+
+        async def fulfill(route, playwright_request):
+            entry = self.store.get(playwright_request.method, playwright_request.url, playwright_request.post_data_buffer)
+            if entry is None:
+                self.missing(playwright_request.url)
+                await route.abort()
+                return
+            self.stats.inc_value(f"fixtures/replayed/{stage}")
+            await route.fulfill(status=entry["status"], headers=entry["headers"], body=self.store.read_body(entry))
+
+        await page.route("**/*", fulfill)
+
+    def missing(self, url):
+        self.stats.inc_value("fixtures/missing")
+        self.crawler.spider.logger.debug(f"No fixture recorded for {url}")
+
+    def spider_opened(self, spider):
+        self.server.start()
+        spider.logger.info(f"FixtureReplayMiddleware replaying {len(self.store.index)} responses from {self.store.directory}, plain HTTP served on {self.server.base_url}")
+
+    def spider_closed(self, spider):
+        self.server.stop()
+
+
+class StageTimingMiddleware:
+    """
+        Records where the download time of each request goes, per crawl stage, in the timing/<stage>/* histograms:
+        download (all of it), and for browser requests navigation (until the page loaded), page_methods (the readiness
+        checks and scrolling run on the loaded page), selector_wait (the rest of page_methods, mostly spent waiting for selectors),
+        server (the time the server took to answer the page, as measured by the browser) and render (everything else).
+        The durations of a request are also left in its "download_timing" meta key
+    """
+
+    def __init__(self, crawler):
+        self.stats = crawler.stats
+        self.buckets = histogram_buckets(crawler.settings, 'CRAWL_METRICS_HISTOGRAM_BUCKETS_MS')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CRAWL_METRICS_ENABLED'):
+            raise exceptions.NotConfigured
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        request.meta["timing_started"] = time.perf_counter()
+        if request.meta.get("playwright"):
+            add_page_init_callback(request, self.listen_to_load)
+        return None
+
+    async def listen_to_load(self, page, request):
+        page.once("load", lambda _: request.meta.__setitem__("timing_loaded", time.perf_counter()))
+
+        def document_response(response):
+            # how long the server took to answer the page itself, as measured by the browser
+            if "timing_server" not in request.meta and response.request.is_navigation_request() and response.frame == page.main_frame:
+                timing = response.request.timing
+                if timing.get("responseStart", -1) >= 0 and timing.get("requestStart", -1) >= 0:
+                    request.meta["timing_server"] = timing["responseStart"] - timing["requestStart"]
+
+        page.on("response", document_response)
+
+    def process_response(self, request, response, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        started = request.meta.pop("timing_started", None)
+        loaded = request.meta.pop("timing_loaded", None)
+        server = request.meta.pop("timing_server", None)
+        stage = request.meta.get("crawl_stage")
+        if started is None or stage is None:
+            return response
+
+        finished = time.perf_counter()
+        timing = {"download": (finished - started) * 1000}
+        if loaded is not None:
+            timing["navigation"] = (loaded - started) * 1000
+            timing["page_methods"] = (finished - loaded) * 1000
+            readiness_ms = sum(
+                page_method.result["readinessMs"]
+                for page_method in request.meta.get("playwright_page_methods") or []
+                if isinstance(page_method.result, dict) and "readinessMs" in page_method.result
+            )
+            timing["selector_wait"] = max(timing["page_methods"] - readiness_ms, 0)
+        if server is not None:
+            timing["server"] = server
+            timing["render"] = max(timing["download"] - server, 0)
+
+        for phase, value_ms in timing.items():
+            record_histogram(self.stats, f"timing/{stage}/{phase}", value_ms, self.buckets)
+        # kept on the request for the adaptive timeouts of PlaywrightRetryMiddleware
+        request.meta["download_timing"] = timing
+        return response
+
+    def process_exception(self, request, exception, spider):
+        request.meta.pop("playwright_page_init_callback", None)
+        request.meta.pop("timing_started", None)
+        request.meta.pop("timing_loaded", None)
+        request.meta.pop("timing_server", None)
+        stage = request.meta.get("crawl_stage")
+        if stage is not None:
+            self.stats.inc_value(f"timing/{stage}/failed")
+        return None
@@ -0,0 +1,88 @@
+# Normalizers of the raw product fields, shared by the item pipelines (in the crawl
+# process or in the worker processes) and by the export writers.
+
+import re
+
+
+# compiled once, every item of the crawl goes through them
+# volume patterns such as numbers followed by ml, L, g, etc.
+QUANTITY_PATTERN = re.compile(r'\s+((\d+\.?\d*\s*(ml|L|g|kg|oz|pcs|lb|cc|oz|gal|m|cm))\.?)', re.IGNORECASE)
+BAR_CODE_PATTERN = re.compile(r'\s?(\d+)')
+# the price string might contain commas
+PRICE_CLEANUP_PATTERN = re.compile(r'[^\d\.]')
+
+
+def split_name_quantity(name):
+    match = QUANTITY_PATTERN.search(name)
+    if match:
+        # possibly with a trailing dot
+        volume = match.group(1)
+        name = " ".join(name.split(volume))
+
+        # without a trailing dot
+        volume = match.group(2)
+        return name, volume
+    else:
+        return name, None
+
+
+def extract_bar_code(sku):
+    match = BAR_CODE_PATTERN.search(sku)
+    return match.group(0).strip() if match else ""
+
+
+def convert_price_to_float(price):
+    return float(PRICE_CLEANUP_PATTERN.sub('', price))
+
+
+def normalize_name(fields):
+    name, quantity = split_name_quantity(fields["product_name"])
+    fields["product_name"] = name.strip()
+    fields["quantity"] = quantity
+
+
+def normalize_bar_code(fields):
+    fields["bar_code_number"] = extract_bar_code(fields["bar_code_number"])
+
+
+def normalize_details(fields):
+    # the text nodes of the details, already joined for items built from structured data
+    details = fields["product_details"]
+    fields["product_details"] = (details if isinstance(details, str) else "".join(details)).strip()
+
+
+def normalize_price(fields):
+    fields["price"] = convert_price_to_float(fields["price"])
+
+
+# the normalizer of each field, applied in the order of the item fields (alphabetical), so an item
+# failing on a field keeps the fields normalized before it
+NORMALIZERS = (
+    normalize_bar_code,
+    normalize_price,
+    normalize_details,
+    normalize_name,
+)
+
+
+def normalize_fields(fields):
+    """
+        Normalize the raw fields of a product in place, fields being an item adapter or a dict
+    """
+    for normalizer in NORMALIZERS:
+        normalizer(fields)
+
+
+def normalize_batch(rows):
+    """
+        Normalize a batch of product dicts, in a worker process. Returns each of them with the error that stopped
+        its normalization, if any
+    """
+    results = []
+    for row in rows:
+        try:
+            normalize_fields(row)
+            results.append((row, None))
+        except Exception as e:
+            results.append((row, str(e)))
+    return results
@@ -4,68 +4,382 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 
+import asyncio
+import hashlib
+import mimetypes
+import multiprocessing
+import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy import Request
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.http.request import NO_CALLBACK
+from scrapy.pipelines.files import FilesPipeline
+from twisted.internet import task
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from .items import StoredProductItem
+from .metrics import timed_process_item
+from .stores import ImageIndex, content_fingerprint
+from .exporters import PART_WRITERS, missing_dependency
+from .normalizers import normalize_batch, normalize_fields
 
 
 class ScraperPipeline:
-    def split_name_quantity(self, name):
-        # Regular expression to find volume patterns such as numbers followed by ml, L, g, etc.
-        pattern = re.compile(r'\s+((\d+\.?\d*\s*(ml|L|g|kg|oz|pcs|lb|cc|oz|gal|m|cm))\.?)', re.IGNORECASE)
-        
-        match = pattern.search(name)
-        if match:
-            # possibly with a trailing dot
-            volume = match.group(1)
-            name = " ".join(name.split(volume))
-
-            # without a trailing dot
-            volume = match.group(2)
-            return name, volume
-        else:
-            return name, None
-        
-    def extract_bar_code(self, sku):
-        pattern = re.compile(r'\s?(\d+)', re.IGNORECASE)
-        match = pattern.search(sku)
-        return match.group(0).strip() if match else ""
-    
-    def convert_price_to_float(self, price):
-        # the price string might contain commas
-        price = re.sub(r'[^\d\.]', '', price)
-        return float(price)
+    """
+        Normalizes the raw product fields: splits the quantity out of the name, and cleans up the bar code,
+        the details and the price. With NORMALIZE_BATCH_SIZE, items are normalized in batches by a pool of
+        NORMALIZE_WORKERS processes, a batch being sent once full or NORMALIZE_BATCH_TIMEOUT seconds after its first item
+    """
+
+    def __init__(self, stats=None, batch_size=0, workers=1, batch_timeout=1.0):
+        self.stats = stats
+        self.batch_size = batch_size
+        self.workers = workers
+        self.batch_timeout = batch_timeout
+        self.executor = None
+        self.pending = []
+        self.flush_call = None
 
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            crawler.stats,
+            settings.getint("NORMALIZE_BATCH_SIZE"),
+            settings.getint("NORMALIZE_WORKERS"),
+            settings.getfloat("NORMALIZE_BATCH_TIMEOUT"),
+        )
 
+    def open_spider(self, spider):
+        if self.batch_size:
+            # spawned, forking a process running a browser and the reactor threads is not safe
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    @timed_process_item
     def process_item(self, item, spider):
-        try:
-            adapter = ItemAdapter(item)
+        if isinstance(item, StoredProductItem):
+            # already normalized when it was first scraped
+            return item
+
+        if self.batch_size:
+            return self.queue(item, spider)
 
-            field_names = adapter.field_names()
-            for field in field_names:
-                spider.logger.debug(f"field is {field}")
-
-                if 'product_name' == field:
-                    spider.logger.debug(f"name and vol {adapter[field]}")
-                    name, quantity = self.split_name_quantity(adapter[field])
-                    spider.logger.debug(f"name and vol after {name}, {quantity}")
-                    adapter["product_name"] = name.strip()
-                    adapter["quantity"] = quantity
-
-                if 'product_details' == field:
-                    adapter[field] = "".join(adapter[field]).strip()
-                
-                if 'price' == field:
-                    adapter[field] = self.convert_price_to_float(adapter[field])
-
-                if 'bar_code_number' == field:
-                    adapter[field] = self.extract_bar_code(adapter[field])
+        try:
+            normalize_fields(ItemAdapter(item))
         except Exception as e:
             spider.logger.error(f"Error processing item {item}: {e}")
             spider.failed_items += 1
 
         return item
-    
+
+    def queue(self, item, spider):
+        from twisted.internet import reactor
+
+        deferred = Deferred()
+        self.pending.append((item, deferred))
+        if len(self.pending) >= self.batch_size:
+            self.flush(spider)
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.batch_timeout, self.flush, spider)
+        return deferred
+
+    def flush(self, spider):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        rows = [ItemAdapter(item).asdict() for item, _ in batch]
+        future = asyncio.wrap_future(self.executor.submit(normalize_batch, rows))
+        Deferred.fromFuture(future).addCallbacks(
+            self.batch_normalized, self.batch_failed,
+            callbackArgs=(batch, spider), errbackArgs=(batch, spider),
+        )
+        if self.stats:
+            self.stats.inc_value("normalize/batches")
+
+    def batch_normalized(self, results, batch, spider):
+        for (item, deferred), (row, error) in zip(batch, results):
+            adapter = ItemAdapter(item)
+            for field, value in row.items():
+                adapter[field] = value
+            if error:
+                spider.logger.error(f"Error processing item {item}: {error}")
+                spider.failed_items += 1
+            deferred.callback(item)
+
+    def batch_failed(self, failure, batch, spider):
+        # the pool is broken, normalize the batch here rather than losing it
+        spider.logger.error(f"Normalizing a batch in the worker pool failed, normalizing it in the crawl process: {failure.value!r}")
+        rows = [ItemAdapter(item).asdict() for item, _ in batch]
+        self.batch_normalized(normalize_batch(rows), batch, spider)
+
     def close_spider(self, spider):
+        if self.executor is not None:
+            self.executor.shutdown()
         spider.logger.info(f"Pipeline closed for spider: {spider.name}")
         spider.logger.info(f"Pipeline failed to process: {spider.failed_items} items")
+
+
+class ProductImagesPipeline(FilesPipeline):
+    """
+        Downloads the product images into PRODUCT_IMAGES_STORE, through the crawl downloader, up to
+        PRODUCT_IMAGES_CONCURRENCY at a time. The image urls of each product are normalized and deduplicated,
+        and each image is downloaded once per crawl however many products use it. Images are stored under the
+        sha256 of their content, so identical images are saved once, and their paths are kept in image_files.
+        An image downloaded by a previous crawl is not downloaded again for PRODUCT_IMAGES_REVALIDATE_HOURS,
+        and after that only if the server does not answer 304 to its ETag/Last-Modified
+    """
+    MEDIA_NAME = "image"
+
+    def __init__(self, store_uri, download_func=None, settings=None, *, crawler=None):
+        super().__init__(store_uri, download_func, settings, crawler=crawler)
+        settings = crawler.settings
+        self.ignored_query = re.compile(settings.get("PRODUCT_IMAGES_IGNORED_QUERY_PATTERN"))
+        self.revalidate_after = settings.getfloat("PRODUCT_IMAGES_REVALIDATE_HOURS") * 3600
+        self.concurrency = settings.getint("PRODUCT_IMAGES_CONCURRENCY")
+        self.index = ImageIndex(settings.get("PRODUCT_IMAGES_INDEX_PATH"))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PRODUCT_IMAGES_ENABLED"):
+            raise NotConfigured
+        cls._update_stores(crawler.settings)
+        return cls(crawler.settings.get("PRODUCT_IMAGES_STORE"), crawler=crawler)
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        # the images share one download slot, whatever host serves them
+        self.crawler.engine.downloader.per_slot_settings.setdefault("product_images", {"concurrency": self.concurrency, "delay": 0})
+
+    def close_spider(self, spider):
+        self.index.close()
+
+    @timed_process_item
+    def process_item(self, item, spider):
+        return super().process_item(item, spider)
+
+    def normalize_image_url(self, url):
+        # "?$JPEG$" style presets are the same asset, and the fragment never reaches the server
+        url = url.split("#", 1)[0]
+        base, _, query = url.partition("?")
+        if query and self.ignored_query.fullmatch(query):
+            return base
+        return url
+
+    def get_media_requests(self, item, info):
+        adapter = ItemAdapter(item)
+        images = adapter.get("product_images") or []
+        urls = list(dict.fromkeys(self.normalize_image_url(url) for url in images))
+        adapter["product_images"] = urls
+        self.crawler.stats.inc_value("product_images/duplicate_urls", len(images) - len(urls))
+
+        return [
+            Request(url, callback=NO_CALLBACK, dont_filter=True, meta={"crawl_stage": "image", "download_slot": "product_images"})
+            for url in urls
+        ]
+
+    def media_to_download(self, request, info, *, item=None):
+        record = self.index.get(request.url)
+        if record is None:
+            return None
+
+        def stored(stat):
+            if not stat:
+                # the index outlived the file, download it again
+                return None
+            if time.time() - record["checked_at"] < self.revalidate_after:
+                self.inc_stats(info.spider, "uptodate")
+                return {"url": request.url, "path": record["path"], "checksum": record["checksum"], "status": "uptodate"}
+            # only downloaded again if it changed
+            if record["etag"]:
+                request.headers["If-None-Match"] = record["etag"]
+            if record["last_modified"]:
+                request.headers["If-Modified-Since"] = record["last_modified"]
+            return None
+
+        deferred = maybeDeferred(self.store.stat_file, record["path"], info)
+        deferred.addCallback(stored)
+        deferred.addErrback(lambda _: None)
+        return deferred
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        if response.status == 304:
+            record = self.index.get(request.url)
+            self.index.touch(request.url)
+            self.inc_stats(info.spider, "not_modified")
+            return {"url": request.url, "path": record["path"], "checksum": record["checksum"], "status": "uptodate"}
+
+        result = super().media_downloaded(response, request, info, item=item)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        self.index.save(
+            request.url, result["path"], result["checksum"],
+            etag.decode("latin-1") if etag else None, last_modified.decode("latin-1") if last_modified else None,
+        )
+        return result
+
+    def file_path(self, request, response=None, info=None, *, item=None):
+        if response is None:
+            # only known once downloaded
+            return super().file_path(request, info=info, item=item)
+        digest = hashlib.sha256(response.body).hexdigest()
+        content_type = (response.headers.get("Content-Type") or b"").decode("latin-1").split(";")[0].strip()
+        extension = mimetypes.guess_extension(content_type) if content_type else None
+        if not extension:
+            extension = os.path.splitext(request.url.split("?", 1)[0])[1][:5]
+        return f"full/{digest[:2]}/{digest}{extension}"
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        path = self.file_path(request, response=response, info=info, item=item)
+        stat = self.store.stat_file(path, info)
+        if isinstance(stat, dict) and stat:
+            # the same image was already stored, for another url or by another crawl
+            self.crawler.stats.inc_value("product_images/identical_content")
+        else:
+            self.store.persist_file(path, BytesIO(response.body), info)
+        return path.rsplit("/", 1)[-1].split(".")[0]
+
+    def item_completed(self, results, item, info):
+        ItemAdapter(item)["image_files"] = [result["path"] for ok, result in results if ok]
+        return item
+
+
+class IncrementalStorePipeline:
+    """
+        Saves every scraped product to the incremental store of the spider, with the fingerprint of its content.
+        When INCREMENTAL_OUTPUT is "delta", the products whose content did not change since the last crawl are dropped
+    """
+
+    def __init__(self, stats, output):
+        self.stats = stats
+        self.output = output
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("INCREMENTAL_ENABLED"):
+            raise NotConfigured
+        return cls(crawler.stats, crawler.settings.get("INCREMENTAL_OUTPUT"))
+
+    @timed_process_item
+    def process_item(self, item, spider):
+        if isinstance(item, StoredProductItem):
+            return item
+
+        adapter = ItemAdapter(item)
+        fingerprint = content_fingerprint(adapter)
+        record = spider.product_store.get(adapter["url"])
+        spider.product_store.save(adapter.asdict(), fingerprint, spider.listing_signatures.pop(adapter["url"], None))
+
+        if record is not None and record["fingerprint"] == fingerprint:
+            self.stats.inc_value("incremental/unchanged")
+            if self.output == "delta":
+                raise DropItem(f"Product unchanged since the last crawl: {adapter['url']}")
+        else:
+            self.stats.inc_value("incremental/changed")
+
+        return item
+
+
+class BatchedExportPipeline:
+    """
+        Streams the products to part files in BATCHED_EXPORT_DIR, in batches of BATCHED_EXPORT_BATCH_SIZE items.
+        A part is rotated after BATCHED_EXPORT_ROTATE_ITEMS items or BATCHED_EXPORT_ROTATE_BYTES bytes, and only appears
+        under its final name once complete, so downstream jobs can load the finished parts while the crawl is running.
+        Every BATCHED_EXPORT_ROTATE_SECONDS the pending batch is written and the open part completed whatever its size,
+        which bounds what a crash of the crawl loses to the items of that interval
+    """
+
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.directory = settings.get("BATCHED_EXPORT_DIR")
+        self.export_format = settings.get("BATCHED_EXPORT_FORMAT")
+        self.compression = settings.get("BATCHED_EXPORT_COMPRESSION")
+        self.batch_size = settings.getint("BATCHED_EXPORT_BATCH_SIZE")
+        self.rotate_items = settings.getint("BATCHED_EXPORT_ROTATE_ITEMS")
+        self.rotate_bytes = settings.getint("BATCHED_EXPORT_ROTATE_BYTES")
+        self.rotate_seconds = settings.getfloat("BATCHED_EXPORT_ROTATE_SECONDS")
+        self.rotation = None
+
+        self.writer_class = PART_WRITERS[self.export_format]
+        self.batch = []
+        self.writer = None
+        self.part = 0
+        self.part_items = 0
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("BATCHED_EXPORT_ENABLED"):
+            raise NotConfigured
+        missing = missing_dependency(settings.get("BATCHED_EXPORT_FORMAT"), settings.get("BATCHED_EXPORT_COMPRESSION"))
+        if missing:
+            raise NotConfigured(f"{missing} is required for the configured BATCHED_EXPORT_FORMAT/BATCHED_EXPORT_COMPRESSION")
+        return cls(settings, crawler.stats)
+
+    def open_spider(self, spider):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.rotate_seconds:
+            self.rotation = task.LoopingCall(self.rotate, spider)
+            self.rotation.start(self.rotate_seconds, now=False)
+
+    @timed_process_item
+    def process_item(self, item, spider):
+        self.batch.append(ItemAdapter(item).asdict())
+        if len(self.batch) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def flush(self, spider):
+        if not self.batch:
+            return
+
+        if self.writer is None:
+            self.part += 1
+            extension = self.writer_class.extensions.get(self.compression, "")
+            path = os.path.join(self.directory, f"{spider.name}-{self.run_id}-{self.part:05d}{extension}")
+            self.writer = self.writer_class(path, self.compression)
+
+        # taken out first, a batch failing to be written is not written again with every later one
+        batch, self.batch = self.batch, []
+        try:
+            rejected = self.writer.write_batch(batch) or 0
+        except Exception as e:
+            spider.logger.error(f"Failed to export a batch of {len(batch)} items to {self.writer.path}: {e}")
+            self.stats.inc_value("batched_export/failed_batches")
+            self.stats.inc_value("batched_export/failed_items", len(batch))
+            return
+        if rejected:
+            spider.logger.warning(f"{rejected} items not matching the export schema written to {self.writer.path}.rejects.jsonl")
+            self.stats.inc_value("batched_export/rejected_items", rejected)
+        self.part_items += len(batch) - rejected
+        self.stats.inc_value("batched_export/items", len(batch) - rejected)
+        self.stats.inc_value("batched_export/batches")
+
+        if (self.rotate_items and self.part_items >= self.rotate_items) or (self.rotate_bytes and self.writer.size >= self.rotate_bytes):
+            self.close_part(spider)
+
+    def close_part(self, spider):
+        self.writer.close()
+        spider.logger.info(f"Exported part {self.writer.path} with {self.part_items} items")
+        self.stats.inc_value("batched_export/parts")
+        self.writer = None
+        self.part_items = 0
+
+    def rotate(self, spider):
+        self.flush(spider)
+        if self.writer is not None:
+            self.close_part(spider)
+
+    def close_spider(self, spider):
+        if self.rotation is not None and self.rotation.running:
+            self.rotation.stop()
+        self.rotate(spider)
@@ -0,0 +1,295 @@
+# Event-driven page readiness checks used instead of fixed sleeps.
+#
+# Each crawl stage waits for its key selector and then for the page to settle
+# according to the condition configured in READINESS_BUDGETS:
+#   - "dom_stable": no nodes added/removed/changed for stable_ms
+#   - "count_stable": the number of elements matching the selector is unchanged for stable_ms
+#   - "network_idle": no new resources were fetched for stable_ms
+# The wait never lasts longer than timeout_ms. The time it actually took is
+# returned by the script so it can be recorded in the crawl stats.
+
+import asyncio
+
+from scrapy_playwright.page import PageMethod
+
+from .metrics import record_histogram
+
+
+readiness_script = """
+    async ({ selector, condition, stableMs, timeoutMs }) => {
+        const start = performance.now()
+        const count = () => selector ? document.querySelectorAll(selector).length : 0
+
+        let mutations = 0
+        const observer = new MutationObserver(records => { mutations += records.length })
+        observer.observe(document.documentElement, { childList: true, subtree: true, characterData: true })
+
+        const signatures = {
+            dom_stable: () => mutations,
+            count_stable: count,
+            network_idle: () => performance.getEntriesByType("resource").length,
+        }
+        const signature = signatures[condition] || signatures.dom_stable
+
+        let last = signature()
+        let lastChange = performance.now()
+        let timedOut = false
+        while (true) {
+            await new Promise(r => setTimeout(r, 50))
+            const now = performance.now()
+            const current = signature()
+
+            if (current !== last) {
+                last = current
+                lastChange = now
+            } else if (now - lastChange >= stableMs && (!selector || count() > 0)) {
+                break
+            }
+
+            if (now - start >= timeoutMs) {
+                timedOut = true
+                break
+            }
+        }
+        observer.disconnect()
+
+        return { readinessMs: Math.round(performance.now() - start), timedOut, count: count() }
+    }
+"""
+
+# scrolls to the bottom of the list until no more new products are loaded.
+# Instead of sleeping after every scroll, it moves on as soon as new items are rendered,
+# and only stops after the page has been quiet for idleMs (or roundTimeoutMs has passed).
+# The page is not quiet while a request it sent since the scroll started (fetch or XHR) is
+# still loading, so a slow next page of the list does not end the scroll early. Why the
+# scroll stopped ("idle" or "round_timeout") and the requests still loading then are returned.
+# When harvestBinding is given, the links of every new batch are passed to that exposed
+# function as soon as they are rendered, each link only once.
+# When pruneSelector is given, the items matching it are emptied once their links have been
+# harvested, keeping their height so the page still loads the next batch when scrolled to the
+# bottom, so it should be used along with harvestBinding to keep the links of the emptied items.
+# The peak JS heap size and DOM node count seen while scrolling are returned as well
+scrolling_infinite_list_script = """
+    async ({ itemSelector, idleMs, roundTimeoutMs, harvestBinding, pruneSelector }) => {
+        const start = performance.now()
+        const seen = new Set()
+        let prunedLinks = 0
+        const count = () => document.querySelectorAll(itemSelector).length + prunedLinks
+
+        let pendingRequests = 0
+        const originalFetch = window.fetch
+        const originalSend = XMLHttpRequest.prototype.send
+        window.fetch = (...args) => {
+            pendingRequests++
+            return originalFetch.apply(window, args).finally(() => pendingRequests--)
+        }
+        XMLHttpRequest.prototype.send = function (...args) {
+            pendingRequests++
+            this.addEventListener("loadend", () => pendingRequests--, { once: true })
+            return originalSend.apply(this, args)
+        }
+
+        let peakHeapBytes = 0
+        let peakDomNodes = 0
+        const sampleMemory = () => {
+            if (performance.memory) {
+                peakHeapBytes = Math.max(peakHeapBytes, performance.memory.usedJSHeapSize)
+            }
+            peakDomNodes = Math.max(peakDomNodes, document.getElementsByTagName("*").length)
+        }
+
+        const prune = () => {
+            for (const item of document.querySelectorAll(`${pruneSelector}:not([data-pruned])`)) {
+                const links = item.querySelectorAll(itemSelector)
+                if (![...links].every(link => seen.has(link.href))) {
+                    continue
+                }
+                item.style.height = `${item.getBoundingClientRect().height}px`
+                item.replaceChildren()
+                item.setAttribute("data-pruned", "")
+                prunedLinks += links.length
+            }
+        }
+
+        const harvest = async () => {
+            sampleMemory()
+            if (!harvestBinding && !pruneSelector) {
+                return
+            }
+            const hrefs = []
+            for (const link of document.querySelectorAll(itemSelector)) {
+                if (link.href && !seen.has(link.href)) {
+                    seen.add(link.href)
+                    hrefs.push(link.href)
+                }
+            }
+            // the binding is exposed by HarvestedLinksMiddleware, the scroll goes on without it if it is disabled
+            if (hrefs.length && harvestBinding && typeof window[harvestBinding] === "function") {
+                await window[harvestBinding](hrefs)
+            }
+            if (pruneSelector) {
+                prune()
+            }
+        }
+
+        // resolves true as soon as more items are rendered, false once nothing happens for idleMs
+        let stopReason = null
+        const waitForMoreItems = (previous) => new Promise(resolve => {
+            let idleTimer = null
+            const finish = (loaded, reason) => {
+                observer.disconnect()
+                clearTimeout(idleTimer)
+                clearTimeout(roundTimer)
+                stopReason = loaded ? null : reason
+                resolve(loaded)
+            }
+            const resetIdleTimer = () => {
+                clearTimeout(idleTimer)
+                // still loading the next page, keep waiting (up to roundTimeoutMs)
+                idleTimer = setTimeout(() => pendingRequests > 0 ? resetIdleTimer() : finish(false, "idle"), idleMs)
+            }
+            const observer = new MutationObserver(() => {
+                if (count() > previous) {
+                    finish(true)
+                } else {
+                    // the page is still busy (e.g. showing a loader), keep waiting
+                    resetIdleTimer()
+                }
+            })
+            const roundTimer = setTimeout(() => finish(count() > previous, "round_timeout"), roundTimeoutMs)
+
+            observer.observe(document.body, { childList: true, subtree: true })
+            resetIdleTimer()
+        })
+
+        let rounds = 0
+        await harvest()
+        while (true) {
+            const previous = count()
+            window.scrollBy(0, document.body.scrollHeight)
+            rounds++
+
+            if (!(await waitForMoreItems(previous))) {
+                break
+            }
+            await harvest()
+        }
+        // pick up anything rendered while the last round was timing out
+        await harvest()
+        window.fetch = originalFetch
+        XMLHttpRequest.prototype.send = originalSend
+
+        return {
+            readinessMs: Math.round(performance.now() - start),
+            rounds,
+            stopReason,
+            pendingRequests,
+            count: count(),
+            harvested: seen.size,
+            peakHeapBytes,
+            peakDomNodes,
+        }
+    }
+"""
+
+
+def readiness_page_methods(stage, selector, settings):
+    """
+        Build the page methods waiting for the given stage to be ready, using the budget configured for the stage
+    """
+    budget = settings.getdict("READINESS_BUDGETS").get(stage, {})
+    timeout_ms = budget.get("timeout_ms", 10000)
+
+    return [
+        # "attached" rather than visible, since images may be blocked from loading
+        PageMethod("wait_for_selector", selector, state = "attached", timeout = settings.getint("READINESS_SELECTOR_TIMEOUT_MS")),
+        PageMethod("evaluate", readiness_script, {
+            "stage": stage,
+            "selector": selector,
+            "condition": budget.get("condition", "dom_stable"),
+            "stableMs": budget.get("stable_ms", 500),
+            "timeoutMs": timeout_ms,
+        }),
+    ]
+
+
+def scrolling_page_method(item_selector, settings, harvest_binding=None, prune_selector=None):
+    """
+        Build the page method scrolling a product list until all of its items are loaded.
+        With prune_selector, the harvested items are emptied while scrolling to keep the page memory flat
+    """
+    budget = settings.getdict("READINESS_BUDGETS").get("scroll", {})
+
+    return PageMethod("evaluate", scrolling_infinite_list_script, {
+        "stage": "scroll",
+        "itemSelector": item_selector,
+        "idleMs": budget.get("stable_ms", 2000),
+        "roundTimeoutMs": budget.get("timeout_ms", 15000),
+        "harvestBinding": harvest_binding,
+        "pruneSelector": prune_selector,
+    })
+
+
+# name of the function exposed to the page to receive the harvested product links
+harvest_binding = "harvestProductLinks"
+
+
+async def stream_product_links(page, scroll_method):
+    """
+        Run a scrolling page method built with harvest_binding on an open page and yield the new product links
+        of each batch as soon as it is rendered. The result of the script is set on the page method once it is done
+    """
+    batches = asyncio.Queue()
+    await page.expose_function(harvest_binding, batches.put_nowait)
+
+    scrolling = asyncio.ensure_future(page.evaluate(*scroll_method.args))
+
+    while True:
+        next_batch = asyncio.ensure_future(batches.get())
+        await asyncio.wait([next_batch, scrolling], return_when=asyncio.FIRST_COMPLETED)
+        if not next_batch.done():
+            next_batch.cancel()
+            break
+        yield next_batch.result()
+
+    while not batches.empty():
+        yield batches.get_nowait()
+
+    scroll_method.result = scrolling.result()
+
+
+def record_page_method(stats, page_method, buckets=None, label=None):
+    """
+        Record how long a readiness check took in the readiness/<stage> histogram.
+        The scroll rounds of a list are also kept under scroll_rounds/<label> when a label is given, and why
+        the scroll stopped under readiness/<stage>/stopped/<reason>. A scroll ending on its round timeout while
+        the page was still loading may have missed the end of the list, it is counted in stopped_while_loading
+    """
+    if not isinstance(page_method.result, dict) or "readinessMs" not in page_method.result:
+        return
+
+    stage = page_method.args[1]["stage"]
+    record_histogram(stats, f"readiness/{stage}", page_method.result["readinessMs"], buckets)
+    if page_method.result.get("timedOut"):
+        stats.inc_value(f"readiness/{stage}/timed_out")
+    if "rounds" in page_method.result:
+        stats.inc_value(f"readiness/{stage}/rounds", page_method.result["rounds"])
+        stats.max_value(f"readiness/{stage}/max_rounds", page_method.result["rounds"])
+        if label:
+            stats.set_value(f"scroll_rounds/{label}", page_method.result["rounds"])
+    if page_method.result.get("stopReason"):
+        stats.inc_value(f"readiness/{stage}/stopped/{page_method.result['stopReason']}")
+        if page_method.result.get("pendingRequests"):
+            stats.inc_value(f"readiness/{stage}/stopped_while_loading")
+    if page_method.result.get("peakHeapBytes"):
+        stats.max_value(f"memory/{stage}/peak_js_heap_bytes", page_method.result["peakHeapBytes"])
+    if page_method.result.get("peakDomNodes"):
+        stats.max_value(f"memory/{stage}/peak_dom_nodes", page_method.result["peakDomNodes"])
+
+
+def record_readiness(stats, response, buckets=None, label=None):
+    """
+        Record how long each readiness check of the response took in the readiness/<stage> histograms
+    """
+    for page_method in response.meta.get("playwright_page_methods") or []:
+        record_page_method(stats, page_method, buckets, label)
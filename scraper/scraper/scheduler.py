@@ -0,0 +1,85 @@
+# Scheduler keeping the crawl stages of the browser pool apart.
+#
+# A request counts against CONCURRENT_REQUESTS (and the slot of its domain)
+# from the moment the engine hands it to the downloader, including while
+# PlaywrightPoolMiddleware makes it wait for a page of its stage. So the
+# Playwright requests of a stage at its page cap are held back instead, and
+# the downloader only gets requests that can be rendered right away.
+
+from collections import deque
+
+from scrapy.core.scheduler import Scheduler
+
+
+class StageScheduler(Scheduler):
+    """
+        Scheduler holding back the Playwright requests of a crawl stage while the browser pool has no page free for it:
+        the next request of another stage is sent instead, and the held ones are sent first once a page of their stage is free.
+        Each request is looked at once while its stage is full, however many of them are queued ahead of the other stages.
+        The held requests are kept in memory, in their queue order, and put back in the queues when the spider closes
+        so a JOBDIR crawl still persists them. Behaves like the default scheduler when PlaywrightPoolMiddleware is disabled
+    """
+
+    def open(self, spider):
+        self.pool = None
+        # (request, queue it came from) per stage, in the order they came out of the queues
+        self.held = {}
+        return super().open(spider)
+
+    def close(self, reason):
+        # reversed, so they come out of the (last in, first out) queues in the same order again
+        for requests in self.held.values():
+            for request, _ in reversed(requests):
+                if not self._dqpush(request):
+                    self._mqpush(request)
+        self.held = {}
+        return super().close(reason)
+
+    def __len__(self):
+        return super().__len__() + sum(len(requests) for requests in self.held.values())
+
+    def browser_pool(self):
+        if self.pool is None:
+            middlewares = self.crawler.engine.downloader.middleware.middlewares
+            self.pool = next((middleware for middleware in middlewares if hasattr(middleware, "has_room")), False)
+        return self.pool
+
+    def next_request(self):
+        pool = self.browser_pool()
+        if not pool:
+            return super().next_request()
+
+        # whether each stage has a free page, looked up once per call
+        room = {}
+
+        def has_room(stage):
+            if stage not in room:
+                room[stage] = pool.has_room(stage)
+            return room[stage]
+
+        for stage, requests in self.held.items():
+            if requests and has_room(stage):
+                return self.dequeued(*requests.popleft())
+
+        while True:
+            request, queue = self.pop()
+            if request is None:
+                return None
+            stage = request.meta.get("crawl_stage")
+            if not request.meta.get("playwright") or has_room(stage):
+                return self.dequeued(request, queue)
+            self.held.setdefault(stage, deque()).append((request, queue))
+            self.stats.inc_value("scheduler/held_saturated_stage", spider=self.spider)
+            self.stats.max_value(f"scheduler/max_held/{stage}", len(self.held[stage]), spider=self.spider)
+
+    def dequeued(self, request, queue):
+        self.stats.inc_value(f"scheduler/dequeued/{queue}", spider=self.spider)
+        self.stats.inc_value("scheduler/dequeued", spider=self.spider)
+        return request
+
+    def pop(self):
+        # the memory queue first, as the default scheduler does
+        request = self.mqs.pop()
+        if request is not None:
+            return request, "memory"
+        return self._dqpop(), "disk"
@@ -11,6 +11,7 @@ BOT_NAME = "scraper"
 
 SPIDER_MODULES = ["scraper.spiders"]
 NEWSPIDER_MODULE = "scraper.spiders"
+COMMANDS_MODULE = "scraper.commands"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -44,29 +45,46 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    "scraper.middlewares.ScraperSpiderMiddleware": 543,
-#}
+    # closest to the spider, so only the callbacks themselves are timed
+    "scraper.middlewares.CallbackTimingMiddleware": 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
     # "scraper.middlewares.ScraperDownloaderMiddleware": 540,
     "scraper.middlewares.PlaywrightRetryMiddleware": 543,
+    # keeps the product links of the subcategory pages scrolled without streaming (STREAMING_HARVEST_ENABLED)
+    "scraper.middlewares.HarvestedLinksMiddleware": 545,
+    "scraper.middlewares.ResourceBlockingMiddleware": 550,
+    # after the resource blocking, so blocked resources are neither recorded nor replayed
+    "scraper.middlewares.FixtureRecorderMiddleware": 555,
+    "scraper.middlewares.FixtureReplayMiddleware": 556,
+    "scraper.middlewares.PlaywrightPoolMiddleware": 560,
+    # after the pool, so the time spent waiting for a page slot is not counted as download time
+    "scraper.middlewares.StageTimingMiddleware": 565,
     # "rotating_proxies.middlewares.RotatingProxyMiddleware": 610,
     # "rotating_proxies.middlewares.BanDetectionMiddleware": 620,
 }
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
+    "scraper.extensions.BenchmarkStats": 500,
+    "scraper.extensions.CrawlMetrics": 510,
+    "scraper.extensions.StageAutoThrottle": 520,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    "scraper.pipelines.ScraperPipeline": 300,
+   "scraper.pipelines.ProductImagesPipeline": 350,
+   "scraper.pipelines.IncrementalStorePipeline": 400,
+   "scraper.pipelines.BatchedExportPipeline": 800,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -123,4 +141,286 @@ PLAYWRIGHT_LAUNCH_OPTIONS = {
 
 DOWNLOAD_TIMEOUT = 300
 # PLAYWRIGHT_TIMEOUT = 300
-PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 600 * 1000
\ No newline at end of file
+PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 600 * 1000
+
+# Fetch product detail pages over plain HTTP first and only render them with
+# Playwright when one of the required fields is missing from the served HTML.
+# Opt-in: every page missing them pays for both fetches, so only worth enabling
+# when the detail_pages/http_fallback stat stays low compared to detail_pages/http
+DETAIL_FAST_PATH_ENABLED = False
+DETAIL_FAST_PATH_REQUIRED_FIELDS = ["product_name", "bar_code_number", "price", "product_details"]
+
+# Build products straight from the JSON batches a subcategory page loads while
+# scrolling. Detail pages are only visited for products missing any of
+# LISTING_CAPTURE_REQUIRED_FIELDS
+LISTING_CAPTURE_ENABLED = False
+LISTING_CAPTURE_URL_PATTERNS = [r"/graphql", r"/api/.*product"]
+LISTING_CAPTURE_REQUIRED_FIELDS = ["product_name", "bar_code_number", "price", "product_details"]
+
+# Time budgets of the readiness checks each crawl stage waits on before its page is parsed.
+# condition is one of "dom_stable", "count_stable" or "network_idle" and has to hold
+# for stable_ms, the wait gives up after timeout_ms. For "scroll", stable_ms is how long
+# the list has to stay quiet before scrolling stops and timeout_ms caps a single scroll round
+READINESS_BUDGETS = {
+    "home": {"condition": "dom_stable", "stable_ms": 500, "timeout_ms": 5000},
+    "category": {"condition": "count_stable", "stable_ms": 750, "timeout_ms": 8000},
+    "subcategory": {"condition": "count_stable", "stable_ms": 750, "timeout_ms": 8000},
+    "detail": {"condition": "dom_stable", "stable_ms": 300, "timeout_ms": 5000},
+    "scroll": {"stable_ms": 2500, "timeout_ms": 15000},
+}
+READINESS_SELECTOR_TIMEOUT_MS = 300 * 1000
+# bucket bounds of the readiness/<stage> histograms kept in the crawl stats
+READINESS_HISTOGRAM_BUCKETS_MS = [100, 250, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000]
+
+# Scroll subcategory pages from the spider callback and schedule the detail page of
+# each product as soon as it is rendered, so details are fetched while the list is
+# still loading. Detail requests found this way get STREAMING_DETAIL_PRIORITY
+STREAMING_HARVEST_ENABLED = False
+STREAMING_DETAIL_PRIORITY = 10
+
+# Empty the product nodes of subcategory pages once their links are harvested while
+# scrolling, so the browser memory stays flat regardless of the list length. The peak
+# JS heap size and DOM node count of the scrolled pages are kept in the memory/scroll stats
+LOW_MEMORY_SCROLL_ENABLED = False
+
+# Resources the browser does not download, per crawl stage. Product images are only
+# needed as urls, so images are blocked everywhere along with fonts, media and
+# third-party analytics/ads. Blocked requests are counted in resource_blocking/<stage>/*.
+# The bytes saved are estimated from the average size of the same type of resource when
+# it was downloaded, or from RESOURCE_BLOCKING_ESTIMATED_BYTES before any was seen
+RESOURCE_BLOCKING_ENABLED = True
+RESOURCE_BLOCKING_THIRD_PARTY_PATTERNS = [
+    r"google-analytics\.com",
+    r"googletagmanager\.com",
+    r"doubleclick\.net",
+    r"googlesyndication\.com",
+    r"facebook\.(net|com)/tr",
+    r"connect\.facebook\.net",
+    r"hotjar\.com",
+    r"criteo\.(com|net)",
+    r"tiktok\.com",
+    r"clarity\.ms",
+]
+RESOURCE_BLOCKING_POLICY = {
+    "home": {"resource_types": ["image", "media", "font"], "url_patterns": RESOURCE_BLOCKING_THIRD_PARTY_PATTERNS},
+    "category": {"resource_types": ["image", "media", "font"], "url_patterns": RESOURCE_BLOCKING_THIRD_PARTY_PATTERNS},
+    "subcategory": {"resource_types": ["image", "media", "font"], "url_patterns": RESOURCE_BLOCKING_THIRD_PARTY_PATTERNS},
+    "detail": {"resource_types": ["image", "media", "font"], "url_patterns": RESOURCE_BLOCKING_THIRD_PARTY_PATTERNS},
+}
+RESOURCE_BLOCKING_ESTIMATED_BYTES = {
+    "image": 50 * 1024,
+    "font": 40 * 1024,
+    "media": 500 * 1024,
+    "script": 30 * 1024,
+    "default": 10 * 1024,
+}
+
+# Browser contexts and pages. Each crawl stage has its own contexts and cap on
+# concurrently open pages, since scroll pages are far heavier than detail pages.
+# A context is recycled after BROWSER_POOL_RECYCLE_AFTER_PAGES pages, and all of
+# them are when the browser processes use more than BROWSER_POOL_MAX_RSS_MB (checked
+# every BROWSER_POOL_WATCHDOG_INTERVAL seconds). Requests lost to a browser crash
+# are rescheduled up to BROWSER_POOL_CRASH_RETRIES times. Off by default, as the
+# stage caps change how many pages are rendered at once
+BROWSER_POOL_ENABLED = False
+BROWSER_POOL_STAGES = {
+    "home": {"contexts": 1, "concurrency": 1},
+    "category": {"contexts": 1, "concurrency": 2},
+    "subcategory": {"contexts": 1, "concurrency": 2},
+    "detail": {"contexts": 2, "concurrency": 8},
+}
+BROWSER_POOL_RECYCLE_AFTER_PAGES = 250
+BROWSER_POOL_MAX_RSS_MB = 3072
+BROWSER_POOL_WATCHDOG_INTERVAL = 30
+BROWSER_POOL_CRASH_RETRIES = 3
+# with the pool, hold back the requests of a stage at its page cap in the scheduler,
+# so they do not take downloader slots while they wait for a page
+# SCHEDULER = "scraper.scheduler.StageScheduler"
+# leaves room for the recycled contexts still finishing their pages
+PLAYWRIGHT_MAX_CONTEXTS = 10
+PLAYWRIGHT_MAX_PAGES_PER_CONTEXT = 8
+PLAYWRIGHT_RESTART_DISCONNECTED_BROWSER = True
+
+# Keep every product in a local SQLite store and only render its details page again
+# when its name, price or labels in the list changed, or when it was rendered more
+# than INCREMENTAL_TTL_HOURS ago. The other products are carried forward from the
+# store. INCREMENTAL_OUTPUT is "snapshot" to export every product, or "delta" to
+# only export the ones that changed since the last crawl
+INCREMENTAL_ENABLED = False
+INCREMENTAL_STORE_PATH = "products.sqlite3"
+INCREMENTAL_TTL_HOURS = 72
+INCREMENTAL_OUTPUT = "snapshot"
+
+# Render each product once even when it is listed under several categories or
+# subcategories. The lists are all scrolled first, then every product is handled
+# once with all the (category, subcategory) pairs it was found under in "categories"
+PRODUCT_DEDUP_ENABLED = False
+
+# Stream the products to part files in BATCHED_EXPORT_DIR as they leave the pipeline,
+# in batches of BATCHED_EXPORT_BATCH_SIZE. BATCHED_EXPORT_FORMAT is "jsonl" (with
+# BATCHED_EXPORT_COMPRESSION None, "gzip" or "zstd") or "parquet" (with None, "snappy",
+# "gzip" or "zstd"). zstd needs the zstandard package and parquet needs pyarrow.
+# Parts are rotated by item count or size and renamed to their final name once complete.
+# An open part is lost if the crawl crashes, so it is also completed every
+# BATCHED_EXPORT_ROTATE_SECONDS (None to only rotate by count or size): a crash loses
+# at most the items of that interval
+BATCHED_EXPORT_ENABLED = False
+BATCHED_EXPORT_DIR = "output"
+BATCHED_EXPORT_FORMAT = "jsonl"
+BATCHED_EXPORT_COMPRESSION = "gzip"
+BATCHED_EXPORT_BATCH_SIZE = 500
+BATCHED_EXPORT_ROTATE_ITEMS = 50000
+BATCHED_EXPORT_ROTATE_BYTES = 128 * 1024 * 1024
+BATCHED_EXPORT_ROTATE_SECONDS = 300
+
+# Record the responses of a crawl into a fixture set, or replay a crawl from one
+# without touching the live site. Query parameters in FIXTURES_IGNORED_QUERY_PARAMS
+# (cache busters) are left out when matching requests to recorded responses.
+# Plain HTTP requests are replayed from a local server on FIXTURES_REPLAY_PORT
+# (0 picks a free port)
+FIXTURES_RECORD_DIR = None
+FIXTURES_REPLAY_DIR = None
+FIXTURES_REPLAY_PORT = 0
+FIXTURES_IGNORED_QUERY_PARAMS = ["_", "timestamp", "cb"]
+
+# Fixture sets of the benchmark command (scrapy benchmark), recorded in
+# BENCHMARK_FIXTURES_DIR with the given spider arguments. The benchmark figures of
+# a crawl are written to BENCHMARK_STATS_PATH, with the browser processes sampled
+# every BENCHMARK_SAMPLE_INTERVAL seconds
+BENCHMARK_FIXTURES_DIR = "fixtures"
+BENCHMARK_FIXTURE_SETS = {
+    "small": {"max_categories": 1, "max_subcategories": 1, "max_products": 20},
+    "medium": {"max_categories": 3, "max_subcategories": 3, "max_products": 100},
+    "large": {},
+}
+BENCHMARK_STATS_PATH = None
+BENCHMARK_SAMPLE_INTERVAL = 1.0
+
+# Time every request by crawl stage and phase (timing/<stage>/download, navigation,
+# page_methods and selector_wait), the spider callbacks (timing/callback/<name>), the
+# process_item of each pipeline of the project (timing/pipeline/<name>) and the items
+# from their callback to their outcome, queueing included (timing/item_pipelines/<outcome>).
+# Every CRAWL_METRICS_INTERVAL seconds the throughput and engine queues are added to
+# the stats (crawl/*), which are served in the Prometheus text format on
+# http://127.0.0.1:<CRAWL_METRICS_HTTP_PORT>/metrics and written to
+# CRAWL_METRICS_JSON_PATH, when set
+CRAWL_METRICS_ENABLED = True
+CRAWL_METRICS_INTERVAL = 30
+CRAWL_METRICS_HTTP_PORT = None
+CRAWL_METRICS_JSON_PATH = None
+CRAWL_METRICS_HISTOGRAM_BUCKETS_MS = [1, 5, 10, 50, 100, 250, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000]
+
+# Retries of Playwright timeouts wait RETRY_BACKOFF_BASE * 2^(retry - 1) seconds (at most
+# RETRY_BACKOFF_MAX, half of it random). With ADAPTIVE_TIMEOUT_ENABLED, the navigation and
+# selector timeouts of a stage are the ADAPTIVE_TIMEOUT_PERCENTILE of its recent latencies
+# times ADAPTIVE_TIMEOUT_MULTIPLIER, doubled on each retry, between ADAPTIVE_TIMEOUT_MIN_MS
+# and the configured PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT / READINESS_SELECTOR_TIMEOUT_MS.
+# The latencies are measured by StageTimingMiddleware (CRAWL_METRICS_ENABLED)
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 60
+ADAPTIVE_TIMEOUT_ENABLED = True
+ADAPTIVE_TIMEOUT_PERCENTILE = 95
+ADAPTIVE_TIMEOUT_MULTIPLIER = 3
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20
+ADAPTIVE_TIMEOUT_WINDOW = 200
+ADAPTIVE_TIMEOUT_MIN_MS = 15 * 1000
+
+# When at least CIRCUIT_BREAKER_FAILURE_RATE of the last CIRCUIT_BREAKER_WINDOW requests to
+# a host failed, its download concurrency is dropped to CIRCUIT_BREAKER_OPEN_CONCURRENCY
+# for CIRCUIT_BREAKER_COOLDOWN seconds
+CIRCUIT_BREAKER_ENABLED = True
+CIRCUIT_BREAKER_WINDOW = 50
+CIRCUIT_BREAKER_MIN_REQUESTS = 20
+CIRCUIT_BREAKER_FAILURE_RATE = 0.5
+CIRCUIT_BREAKER_OPEN_CONCURRENCY = 1
+CIRCUIT_BREAKER_COOLDOWN = 120
+
+# Adjust the page concurrency of each stage of the browser pool while the crawl runs,
+# every STAGE_AUTOTHROTTLE_INTERVAL seconds: halved when more than
+# STAGE_AUTOTHROTTLE_MAX_FAILURE_RATE of the stage's requests failed, lowered by one when
+# the server or browser time got STAGE_AUTOTHROTTLE_LATENCY_FACTOR times slower than the
+# fastest seen, and raised by one while all pages are in use and the stage is below its
+# target rate (no target: as fast as it stays healthy). Starts from BROWSER_POOL_STAGES,
+# needs CRAWL_METRICS_ENABLED, and is still bounded by CONCURRENT_REQUESTS_PER_DOMAIN
+STAGE_AUTOTHROTTLE_ENABLED = False
+STAGE_AUTOTHROTTLE_INTERVAL = 30
+STAGE_AUTOTHROTTLE_MIN_CONCURRENCY = 1
+STAGE_AUTOTHROTTLE_MAX_CONCURRENCY = {"home": 1, "category": 4, "subcategory": 6, "detail": 16}
+STAGE_AUTOTHROTTLE_TARGET_PAGES_PER_MINUTE = {}
+STAGE_AUTOTHROTTLE_MAX_FAILURE_RATE = 0.05
+STAGE_AUTOTHROTTLE_LATENCY_FACTOR = 2.0
+
+# Keep a checkpoint of the category tree and of the pending and finished lists and products
+# in CHECKPOINT_PATH, so an interrupted crawl resumes where it stopped instead of starting
+# over: finished lists are not scrolled again and exported products are not rendered again.
+# The checkpoint is committed every CHECKPOINT_COMMIT_EVERY writes or CHECKPOINT_COMMIT_INTERVAL
+# seconds, and cleared once a crawl finishes
+CHECKPOINT_ENABLED = False
+CHECKPOINT_PATH = "crawl_state.sqlite3"
+CHECKPOINT_COMMIT_EVERY = 100
+CHECKPOINT_COMMIT_INTERVAL = 10
+
+# `scrapy shard tops_online -o products.jsonl` runs the crawl in SHARD_WORKERS processes
+# (default: one per core), each with its own browser. They claim the home page, categories
+# and subcategory lists from a SQLite frontier in SHARD_DIR, up to SHARD_WORKER_UNITS at a
+# time, render each product only once across workers, and their feeds are merged into one.
+# A worker that crashes has its work handed back and is restarted up to SHARD_MAX_RESTARTS times
+SHARD_WORKERS = None
+SHARD_DIR = "shards"
+SHARD_WORKER_UNITS = 2
+SHARD_MAX_RESTARTS = 2
+SHARD_PROGRESS_INTERVAL = 30
+# set by `scrapy shard` for each worker
+SHARD_FRONTIER_PATH = None
+SHARD_WORKER_ID = None
+
+# Cache the category tree (the view all url of each subcategory list, with its category and
+# subcategory) in DISCOVERY_CACHE_PATH, so repeat runs start from the lists instead of rendering
+# the home and category pages first. A tree older than DISCOVERY_CACHE_TTL_HOURS is discovered
+# again before the lists are crawled. One older than DISCOVERY_CACHE_REFRESH_AFTER_HOURS is still
+# used, and discovered again in the background with DISCOVERY_CACHE_REFRESH_PRIORITY
+DISCOVERY_CACHE_ENABLED = False
+DISCOVERY_CACHE_PATH = "discovery_cache.json"
+DISCOVERY_CACHE_TTL_HOURS = 7 * 24
+DISCOVERY_CACHE_REFRESH_AFTER_HOURS = 24
+DISCOVERY_CACHE_REFRESH_PRIORITY = -100
+
+# How the products to crawl are found: "scroll" scrolls every subcategory list, "sitemap"
+# reads the sitemaps (SITEMAP_URLS, or the ones listed in robots.txt) and requests the
+# details page of each url matching SITEMAP_PRODUCT_URL_PATTERNS as the sitemap is read.
+# Sitemap indexes are followed for the sitemaps matching SITEMAP_FOLLOW_PATTERNS (all when
+# empty). The category of a sitemap product is read from the breadcrumb of its page and, with
+# SITEMAP_MEMBERSHIP_SCROLL, the lists are only scrolled when some pages had no breadcrumb.
+# "both" crawls from the lists and also reads the sitemaps, to compare the coverage and speed
+# of the two engines in the discovery/* stats
+PRODUCT_DISCOVERY_ENGINE = "scroll"
+SITEMAP_URLS = []
+SITEMAP_FOLLOW_PATTERNS = []
+# the product urls end with the barcode
+SITEMAP_PRODUCT_URL_PATTERNS = [r"-\d{8,14}/?$"]
+SITEMAP_MEMBERSHIP_SCROLL = True
+
+# Normalize the products in batches of NORMALIZE_BATCH_SIZE items (0: one at a time, in the
+# crawl process) in a pool of NORMALIZE_WORKERS processes. A batch is sent once full or
+# NORMALIZE_BATCH_TIMEOUT seconds after its first item. Only worth it when the normalization
+# gets CPU heavy, see benchmarks/normalize_benchmark.py
+NORMALIZE_BATCH_SIZE = 0
+NORMALIZE_WORKERS = 2
+NORMALIZE_BATCH_TIMEOUT = 1
+
+# Download the product images into PRODUCT_IMAGES_STORE, PRODUCT_IMAGES_CONCURRENCY at a time,
+# stored under the sha256 of their content and listed in image_files. Query strings fully
+# matching PRODUCT_IMAGES_IGNORED_QUERY_PATTERN (the "?$JPEG$" presets) are dropped from the
+# image urls before they are deduplicated. Images already downloaded (PRODUCT_IMAGES_INDEX_PATH)
+# are not checked again for PRODUCT_IMAGES_REVALIDATE_HOURS, then with their ETag/Last-Modified
+PRODUCT_IMAGES_ENABLED = False
+PRODUCT_IMAGES_STORE = "images"
+PRODUCT_IMAGES_INDEX_PATH = "images.sqlite3"
+PRODUCT_IMAGES_CONCURRENCY = 8
+PRODUCT_IMAGES_REVALIDATE_HOURS = 24
+PRODUCT_IMAGES_IGNORED_QUERY_PATTERN = r"\$[^$]*\$"
+
+# Build the products of the detail pages as compact ProductRecords, read in a single pass over
+# the page with their text already cleaned, instead of ProductItems holding every text node of
+# the details. See benchmarks/detail_extraction_benchmark.py
+COMPACT_ITEMS_ENABLED = False
@@ -1,7 +1,20 @@
-import scrapy
-from ..items import ProductItem
+import json
+import re
+import time
+from urllib.parse import urljoin
 
-from scrapy_playwright.page import PageMethod
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import XmlResponse
+from scrapy.utils.gz import gunzip, gzip_magic_number
+from scrapy.utils.sitemap import Sitemap, sitemap_urls_from_robots
+from ..items import ProductItem, ProductRecord, StoredProductItem
+from ..middlewares import RetryScheduled
+from ..extractors import extract_embedded_product, extract_breadcrumb, extract_detail_fields, products_from_listing_payload
+from ..stores import ProductStore, CheckpointStore, ShardFrontier, DiscoveryCache, listing_signature
+from ..metrics import histogram_buckets
+from ..readiness import readiness_page_methods, scrolling_page_method, stream_product_links, harvest_binding, record_readiness, record_page_method
 
 class TopsOnlineSpider(scrapy.Spider):
     name = "tops_online"
@@ -24,53 +37,548 @@ class TopsOnlineSpider(scrapy.Spider):
     ])
     # used to keep track of how many items failed to be extracted in the pipeline
     failed_items = 0 
+    # products seen by previous crawls, only used in incremental mode
+    product_store = None
+    # pending and finished pages of the current crawl, only used in checkpoint mode
+    checkpoint = None
+    # work shared with the other worker processes, only used in a sharded crawl (scrapy shard)
+    shard_frontier = None
+    # category tree resolved by a previous run, only used when the discovery cache is enabled
+    discovery_cache = None
+    # optional spider arguments (-a max_categories=2) limiting how much of the catalog is crawled,
+    # used to record fixture sets of a given size
+    crawl_limit_args = ("max_categories", "max_subcategories", "max_products")
+    max_categories = None
+    max_subcategories = None
+    max_products = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # listing XHR payloads captured for each open subcategory page
+        self.captured_listings = {}
+        # listing signature of each product whose details page is scheduled in incremental mode
+        self.listing_signatures = {}
+        # products found in the lists so far in dedup mode, by url
+        self.deferred_products = {}
+        # urls of the units claimed from the shard frontier and not finished yet
+        self.shard_units = set()
+        # lists scheduled from the discovery cache, not scheduled again when discovery is refreshed
+        self.cached_lists = set()
+        # product urls found by each discovery engine, and when the first and the last of them were found
+        self.discovered = {"sitemap": set(), "scroll": set()}
+        self.discovery_times = {}
+        self.discovery_started = time.monotonic()
+        # items of the products discovered from the sitemap whose category is not known yet, by url
+        self.awaiting_membership = {}
+        self.membership_pass = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        if crawler.settings.getbool("INCREMENTAL_ENABLED"):
+            spider.product_store = ProductStore(crawler.settings.get("INCREMENTAL_STORE_PATH"))
+            crawler.signals.connect(spider.close_product_store, signal=signals.spider_closed)
+        if crawler.settings.getbool("PRODUCT_DEDUP_ENABLED"):
+            crawler.signals.connect(spider.schedule_deferred_products, signal=signals.spider_idle)
+        if crawler.settings.getbool("CHECKPOINT_ENABLED"):
+            spider.checkpoint = CheckpointStore(
+                crawler.settings.get("CHECKPOINT_PATH"),
+                crawler.settings.getint("CHECKPOINT_COMMIT_EVERY"),
+                crawler.settings.getfloat("CHECKPOINT_COMMIT_INTERVAL"),
+            )
+            crawler.signals.connect(spider.product_finished, signal=signals.item_scraped)
+            crawler.signals.connect(spider.product_finished, signal=signals.item_dropped)
+            crawler.signals.connect(spider.close_checkpoint, signal=signals.spider_closed)
+        if crawler.settings.get("SHARD_FRONTIER_PATH"):
+            spider.shard_frontier = ShardFrontier(crawler.settings.get("SHARD_FRONTIER_PATH"), crawler.settings.get("SHARD_WORKER_ID"))
+            crawler.signals.connect(spider.claim_shard_units, signal=signals.spider_idle)
+            crawler.signals.connect(spider.shard_product_finished, signal=signals.item_scraped)
+            crawler.signals.connect(spider.shard_product_finished, signal=signals.item_dropped)
+            crawler.signals.connect(spider.close_shard_frontier, signal=signals.spider_closed)
+        if crawler.settings.getbool("DISCOVERY_CACHE_ENABLED"):
+            spider.discovery_cache = DiscoveryCache(crawler.settings.get("DISCOVERY_CACHE_PATH"), {
+                "start_urls": spider.start_urls,
+                "categories": sorted(spider.categories_to_be_scrapped),
+                "max_categories": spider.crawl_limit("max_categories"),
+                "max_subcategories": spider.crawl_limit("max_subcategories"),
+            })
+            crawler.signals.connect(spider.save_discovery_cache, signal=signals.spider_closed)
+        if crawler.settings.get("PRODUCT_DISCOVERY_ENGINE") == "sitemap":
+            crawler.signals.connect(spider.recover_memberships, signal=signals.spider_idle)
+        if crawler.settings.get("PRODUCT_DISCOVERY_ENGINE") != "scroll":
+            crawler.signals.connect(spider.record_discovery_coverage, signal=signals.spider_closed)
+        return spider
+
+    def close_product_store(self, spider):
+        self.product_store.close()
+
+    def product_finished(self, item, spider):
+        # exported (or dropped as unchanged), it is not rendered again when the crawl is resumed
+        if item.get("url"):
+            self.checkpoint.finish(item["url"])
+
+    def close_checkpoint(self, spider, reason):
+        if reason == "finished":
+            # the next crawl starts from scratch
+            self.checkpoint.reset()
+        self.checkpoint.close()
+
+    def shard_product_finished(self, item, spider):
+        if item.get("url"):
+            self.shard_frontier.finish_product(item["url"])
+            self.shard_units.discard(item["url"])
+
+    def close_shard_frontier(self, spider):
+        self.shard_frontier.close()
+
+    def save_discovery_cache(self, spider):
+        if self.discovery_cache.complete:
+            self.discovery_cache.save()
+            self.crawler.stats.set_value("discovery_cache/saved_lists", len(self.discovery_cache.lists))
+
+    def record_discovery_coverage(self, spider):
+        """
+            Keep how many products each discovery engine found, how fast, and how much they overlap
+        """
+        stats = self.crawler.stats
+        for engine, urls in self.discovered.items():
+            if not urls:
+                continue
+            stats.set_value(f"discovery/{engine}/products", len(urls))
+            stats.set_value(f"discovery/{engine}/first_product_s", round(self.discovery_times[(engine, "first")], 1))
+            stats.set_value(f"discovery/{engine}/last_product_s", round(self.discovery_times[(engine, "last")], 1))
+        if self.discovered["sitemap"] and self.discovered["scroll"]:
+            stats.set_value("discovery/both", len(self.discovered["sitemap"] & self.discovered["scroll"]))
+            stats.set_value("discovery/sitemap_only", len(self.discovered["sitemap"] - self.discovered["scroll"]))
+            stats.set_value("discovery/scroll_only", len(self.discovered["scroll"] - self.discovered["sitemap"]))
+        self.logger.info(
+            "Discovered " + ", ".join(
+                f"{len(urls)} products from the {engine} in {self.discovery_times.get((engine, 'last'), 0):.0f}s"
+                for engine, urls in self.discovered.items()
+            )
+        )
+
+    def crawl_limit(self, name):
+        value = getattr(self, name)
+        return int(value) if value is not None else None
+
+    def scroll_prune_selector(self):
+        # the product nodes emptied after their links are harvested in low memory mode
+        return ".product-item" if self.settings.getbool("LOW_MEMORY_SCROLL_ENABLED") else None
+
+    def record_readiness(self, response):
+        record_readiness(self.crawler.stats, response, histogram_buckets(self.settings, "READINESS_HISTOGRAM_BUCKETS_MS"), self.list_label(response))
+
+    def list_label(self, response):
+        # "<category>/<subcategory>" of a subcategory page, used to keep its scroll rounds apart
+        extra_data = response.meta.get("extra_data") or {}
+        if "subcategory" not in extra_data:
+            return None
+        return f"{extra_data['category']}/{extra_data['subcategory']}"
 
-    # the scripts will keep scrolling to the bottom of the page until no more new products are loaded
-    scrolling_infinite_list_script = """
-        async () => {
-            let currentItems = 0
-
-            while (true) {
-                window.scrollBy(0, document.body.scrollHeight)
-                await new Promise(r => setTimeout(r, 5000)); // Wait for new content to load
-                
-                let newItems = document.querySelectorAll(".product-item a").length
-        
-                if (newItems === currentItems) {
-                    break
-                }
-                currentItems = newItems
-            }
-        }
-    """
-    
     def start_requests(self):
+        if self.shard_frontier is not None:
+            # the start urls were added to the shard frontier, whichever worker claims them crawls them
+            for request in self.claim_shard_requests():
+                yield request
+            return
+        if self.checkpoint is not None and (self.checkpoint.has_flag("home_finished") or self.checkpoint.has_flag("sitemap_started")):
+            for request in self.resume_requests():
+                yield request
+            return
+        if self.checkpoint is not None:
+            # neither the home page nor the sitemaps were handled, nothing to resume
+            self.checkpoint.reset()
+
+        if self.discovery_engine != "scroll":
+            for request in self.sitemap_requests():
+                yield request
+            if self.discovery_engine == "sitemap":
+                return
+
+        for request in self.discovery_requests():
+            yield request
+
+    @property
+    def discovery_engine(self):
+        # "scroll" (the subcategory lists), "sitemap", or "both" to compare their coverage and speed
+        return self.settings.get("PRODUCT_DISCOVERY_ENGINE")
+
+    def discovery_requests(self):
+        """
+            Yield the requests discovering the subcategory lists: the cached lists, or else the home page
+        """
+        if self.discovery_cache is not None:
+            cached = self.discovery_cache.load()
+            if cached is not None and cached[0] < self.settings.getfloat("DISCOVERY_CACHE_TTL_HOURS") * 3600:
+                for request in self.cached_discovery_requests(*cached):
+                    yield request
+                return
+
         self.logger.debug("start running here")
         for url in self.start_urls:
             self.logger.debug(f"url {url}")
 
-            yield scrapy.Request(url, callback=self.parse, meta={
-                "playwright": True,
-                "playwright_page_methods": [
-                    PageMethod("wait_for_selector", ".pc-sidenavbar a", timeout = 300 * 1000),
-                    PageMethod("wait_for_timeout", 1000)
-                ],
-            })
+            yield self.home_request(url)
+
+    def cached_discovery_requests(self, age, lists):
+        """
+            Start from the subcategory lists of the cached category tree, skipping the home and category pages.
+            Once the tree is older than DISCOVERY_CACHE_REFRESH_AFTER_HOURS, it is discovered again in the background,
+            at a lower priority than the lists, and the lists that are new are scheduled too
+        """
+        self.logger.info(f"Starting from {len(lists)} lists of the discovery cache, {age / 3600:.1f} hours old")
+        self.crawler.stats.set_value("discovery_cache/cached_lists", len(lists))
+        self.crawler.stats.set_value("discovery_cache/age_hours", round(age / 3600, 1))
+
+        for url, extra_data in lists:
+            self.cached_lists.add(url)
+            yield self.subcategory_request(url, extra_data)
+        if self.checkpoint is not None:
+            # the lists are in the checkpoint, a resumed crawl does not need the home page
+            self.checkpoint.set_flag("home_finished")
+
+        if age >= self.settings.getfloat("DISCOVERY_CACHE_REFRESH_AFTER_HOURS") * 3600:
+            self.crawler.stats.set_value("discovery_cache/refreshed", True)
+            for url in self.start_urls:
+                yield self.home_request(url, priority=self.settings.getint("DISCOVERY_CACHE_REFRESH_PRIORITY"))
+
+    def sitemap_requests(self):
+        """
+            Yield the requests for the sitemaps of SITEMAP_URLS, or else for the robots.txt listing them
+        """
+        sitemap_urls = self.settings.getlist("SITEMAP_URLS")
+        for url in sitemap_urls:
+            yield self.sitemap_request(url)
+        if not sitemap_urls:
+            for url in self.start_urls:
+                yield self.robots_request(urljoin(url, "/robots.txt"))
+        if self.checkpoint is not None:
+            # the sitemaps are in the checkpoint, a resumed crawl picks up the ones not read yet
+            self.checkpoint.set_flag("sitemap_started")
+
+    def robots_request(self, url):
+        if self.checkpoint is not None:
+            self.checkpoint.add("robots", url, {})
+        return scrapy.Request(url, callback=self.parse_robots, meta={"crawl_stage": "sitemap"})
+
+    def sitemap_request(self, url):
+        if self.checkpoint is not None:
+            self.checkpoint.add("sitemap", url, {})
+        return scrapy.Request(url, callback=self.parse_sitemap, meta={"crawl_stage": "sitemap"})
+
+    def parse_robots(self, response):
+        """
+            Follow the sitemaps listed in robots.txt, or the default /sitemap.xml when it lists none
+        """
+        try:
+            sitemap_urls = list(sitemap_urls_from_robots(response.text, base_url=response.url))
+            if not sitemap_urls:
+                self.logger.warning(f"No sitemap listed in {response.url}, trying /sitemap.xml")
+                sitemap_urls = [response.urljoin("/sitemap.xml")]
+            for url in sitemap_urls:
+                yield self.sitemap_request(url)
+            if self.checkpoint is not None:
+                self.checkpoint.finish(response.request.url)
+        except Exception as e:
+            self.logger.error(f'Unexpected error in parse_robots: {e}')
+
+    def parse_sitemap(self, response):
+        """
+            Follow the product sitemaps of a sitemap index, and turn the product urls of a sitemap into details page
+            requests as they are read
+        """
+        try:
+            body = self.sitemap_body(response)
+            if body is None:
+                self.logger.warning(f"Ignoring {response.url}, it is not a sitemap")
+                return
+
+            sitemap = Sitemap(body)
+            self.crawler.stats.inc_value(f"sitemap/{sitemap.type}")
+            if sitemap.type == "sitemapindex":
+                follow_patterns = [re.compile(pattern) for pattern in self.settings.getlist("SITEMAP_FOLLOW_PATTERNS")]
+                for entry in sitemap:
+                    if not follow_patterns or any(pattern.search(entry["loc"]) for pattern in follow_patterns):
+                        yield self.sitemap_request(entry["loc"])
+            elif sitemap.type == "urlset":
+                product_patterns = [re.compile(pattern) for pattern in self.settings.getlist("SITEMAP_PRODUCT_URL_PATTERNS")]
+                for entry in sitemap:
+                    if any(pattern.search(entry["loc"]) for pattern in product_patterns):
+                        for request in self.sitemap_product_requests(entry["loc"]):
+                            yield request
+            if self.checkpoint is not None:
+                # read to the end, a resumed crawl does not read it again
+                self.checkpoint.finish(response.request.url)
+        except Exception as e:
+            self.logger.error(f'Unexpected error in parse_sitemap: {e}')
+
+    def sitemap_body(self, response):
+        # sitemaps may be served gzipped, with or without a gzip content type
+        if isinstance(response, XmlResponse):
+            return response.body
+        if gzip_magic_number(response):
+            return gunzip(response.body, max_size=self.settings.getint("DOWNLOAD_MAXSIZE"))
+        if response.url.endswith(".xml"):
+            return response.body
+        return None
+
+    def sitemap_product_requests(self, product_detail_url):
+        """
+            Yield the details page request of a product found in a sitemap. Its category is read from the page.
+            When comparing both engines, the products are only counted and are rendered from the lists
+        """
+        if product_detail_url in self.discovered["sitemap"]:
+            return
+        self.note_discovered("sitemap", product_detail_url)
+        if self.discovery_engine != "sitemap":
+            return
+        max_products = self.crawl_limit("max_products")
+        if max_products is not None and len(self.discovered["sitemap"]) > max_products:
+            return
+        extra_data = {"url": product_detail_url, "category": None, "subcategory": None, "from_sitemap": True}
+        if self.checkpoint is not None:
+            if self.checkpoint.is_finished(product_detail_url):
+                # already exported before the crawl was interrupted
+                self.crawler.stats.inc_value("checkpoint/skipped_products")
+                return
+            self.checkpoint.add("product", product_detail_url, extra_data)
+        yield self.detail_request(product_detail_url, extra_data)
+
+    def note_discovered(self, engine, product_detail_url):
+        elapsed = time.monotonic() - self.discovery_started
+        self.discovered[engine].add(product_detail_url)
+        self.discovery_times.setdefault((engine, "first"), elapsed)
+        self.discovery_times[(engine, "last")] = elapsed
+
+    def sitemap_membership(self, product_item, response):
+        """
+            Yield the item of a product discovered from the sitemap once its category and subcategory are known.
+            They are read from the breadcrumb of its page. Products out of categories_to_be_scrapped are dropped,
+            and those whose page has no breadcrumb wait for a scroll pass over the lists, once the sitemap is done
+        """
+        if not response.meta["extra_data"].get("from_sitemap"):
+            yield product_item
+            return
+
+        breadcrumb = extract_breadcrumb(response)
+        category = next((name for name in breadcrumb if name in self.categories_to_be_scrapped), None)
+        if category is None:
+            if breadcrumb:
+                self.crawler.stats.inc_value("sitemap/out_of_scope")
+            elif self.settings.getbool("SITEMAP_MEMBERSHIP_SCROLL"):
+                self.awaiting_membership[product_item["url"]] = product_item
+                self.crawler.stats.inc_value("sitemap/membership_awaiting")
+            else:
+                self.crawler.stats.inc_value("sitemap/membership_unknown")
+                yield product_item
+            return
+
+        position = breadcrumb.index(category)
+        # the last element is the product itself
+        subcategory = breadcrumb[position + 1] if position + 2 < len(breadcrumb) else None
+        self.set_membership(product_item, category, subcategory)
+        self.crawler.stats.inc_value("sitemap/membership_breadcrumb")
+        yield product_item
+
+    def set_membership(self, product_item, category, subcategory):
+        product_item["category"] = category
+        product_item["subcategory"] = subcategory
+        product_item["categories"] = [{"category": category, "subcategory": subcategory}]
+
+    def retries_pending(self):
+        """
+            Whether retries are still waiting out their backoff (PlaywrightRetryMiddleware). The crawl is not done
+            until they are sent, even though the engine goes idle meanwhile, so the idle handlers wait for them
+        """
+        middlewares = self.crawler.engine.downloader.middleware.middlewares
+        return any(getattr(middleware, "delayed_retries", None) for middleware in middlewares)
+
+    def recover_memberships(self, spider):
+        """
+            Once the products of the sitemap are handled, scroll the lists to find the category of those whose page
+            had no breadcrumb. The ones still unknown after the scroll pass are exported without a category
+        """
+        if not self.awaiting_membership or self.retries_pending():
+            return
+        if self.membership_pass is None:
+            self.membership_pass = "running"
+            self.logger.info(f"Scrolling the lists to find the category of {len(self.awaiting_membership)} products of the sitemap")
+            for request in self.discovery_requests():
+                self.crawler.engine.crawl(request)
+            raise DontCloseSpider
+        if self.membership_pass == "running":
+            self.membership_pass = "done"
+            self.crawler.engine.crawl(scrapy.Request("data:,", callback=self.parse_unrecovered_memberships, dont_filter=True))
+            raise DontCloseSpider
+
+    def parse_unrecovered_memberships(self, response):
+        """
+            Yield the items of the products of the sitemap that the scroll pass did not find in any list
+        """
+        awaiting_membership, self.awaiting_membership = self.awaiting_membership, {}
+        self.crawler.stats.inc_value("sitemap/membership_unknown", len(awaiting_membership))
+        for product_item in awaiting_membership.values():
+            yield product_item
+
+    def home_request(self, url, priority=0):
+        return scrapy.Request(url, callback=self.parse, priority=priority, meta={
+            "playwright": True,
+            "crawl_stage": "home",
+            "playwright_page_methods": readiness_page_methods("home", ".pc-sidenavbar a", self.settings),
+        })
+
+    def follow(self, kind, url, extra_data, priority=0):
+        """
+            Return the request for a category or subcategory list found in a page.
+            In a sharded crawl it is added to the shard frontier instead, for whichever worker claims it
+        """
+        if self.shard_frontier is not None:
+            self.shard_frontier.add(kind, url, extra_data)
+            return []
+        if kind == "category":
+            return [self.category_request(url, extra_data, priority)]
+        return [self.subcategory_request(url, extra_data, priority)]
+
+    def claim_shard_requests(self):
+        """
+            Claim units from the shard frontier, up to SHARD_WORKER_UNITS in progress in this worker, and return their requests
+        """
+        requests = []
+        for kind, url, extra_data in self.shard_frontier.claim(self.settings.getint("SHARD_WORKER_UNITS") - len(self.shard_units)):
+            self.shard_units.add(url)
+            self.crawler.stats.inc_value(f"shard/claimed/{kind}")
+            if kind == "home":
+                request = self.home_request(url)
+            elif kind == "category":
+                request = self.category_request(url, extra_data)
+            elif kind == "list":
+                request = self.subcategory_request(url, extra_data)
+            else:
+                # a product left unfinished by a worker that stopped
+                request = self.detail_request(url, extra_data)
+            request.meta["shard_unit"] = url
+            if request.errback is None:
+                request.errback = self.shard_unit_failed
+            requests.append(request)
+        return requests
+
+    def finish_shard_unit(self, request):
+        """
+            Mark the unit of a request as done in the shard frontier, and return the requests of the units claimed in its place
+        """
+        url = request.meta.get("shard_unit")
+        if self.shard_frontier is None or url not in self.shard_units:
+            return []
+        self.shard_units.discard(url)
+        self.shard_frontier.finish(url)
+        return self.claim_shard_requests()
+
+    def shard_unit_failed(self, failure):
+        if failure.check(RetryScheduled):
+            # still claimed, finished by its retry
+            return
+        self.logger.error(f"Shard unit {failure.request.url} failed: {failure.value!r}")
+        for request in self.finish_shard_unit(failure.request):
+            yield request
+
+    def claim_shard_units(self, spider):
+        """
+            Once this worker runs out of work, claim more from the shard frontier,
+            and keep waiting as long as other workers may still add some
+        """
+        if self.retries_pending():
+            # a unit may still be in progress through one of them
+            return
+        if self.shard_units:
+            # nothing is in progress any more, these were dropped on the way (offsite, duplicates...)
+            for url in self.shard_units:
+                self.shard_frontier.finish(url)
+            self.shard_units.clear()
+
+        requests = self.claim_shard_requests()
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if requests or self.shard_frontier.unfinished():
+            raise DontCloseSpider
+
+
+    def resume_requests(self):
+        """
+            Pick up an interrupted crawl from its checkpoint: the products still pending first, then the lists,
+            categories and sitemaps that were not finished. Finished lists are not scrolled again, finished sitemaps not
+            read again and finished products not rendered again. The discovery engines of PRODUCT_DISCOVERY_ENGINE that
+            had not started yet (the home page or the sitemaps) are started
+        """
+        products = self.checkpoint.pending("product")
+        lists = self.checkpoint.pending("list")
+        categories = self.checkpoint.pending("category")
+        sitemaps = self.checkpoint.pending("sitemap")
+        robots = self.checkpoint.pending("robots")
+        self.logger.info(f"Resuming the crawl from its checkpoint: {len(products)} products, {len(lists)} lists, {len(categories)} categories and {len(sitemaps) + len(robots)} sitemaps pending")
+        self.crawler.stats.set_value("checkpoint/resumed_products", len(products))
+        self.crawler.stats.set_value("checkpoint/resumed_lists", len(lists))
+        self.crawler.stats.set_value("checkpoint/resumed_categories", len(categories))
+        self.crawler.stats.set_value("checkpoint/resumed_sitemaps", len(sitemaps) + len(robots))
+
+        for product_detail_url, extra_data in products:
+            if extra_data.get("from_sitemap"):
+                # found in a sitemap, its category is still read from its page
+                self.note_discovered("sitemap", product_detail_url)
+                yield self.detail_request(product_detail_url, extra_data)
+                continue
+            if self.settings.getbool("PRODUCT_DEDUP_ENABLED"):
+                # the categories found so far are in extra_data, more may be merged from the pending lists
+                self.deferred_products[product_detail_url] = {"extra_data": extra_data, "fields": None, "listing_signal": None, "priority": 0}
+                continue
+            for result in self.product_or_detail_request(product_detail_url, extra_data, None, None):
+                yield result
+        for url, extra_data in lists:
+            yield self.subcategory_request(url, extra_data)
+        for url, extra_data in categories:
+            yield self.category_request(url, extra_data)
+        for url, _ in robots:
+            yield self.robots_request(url)
+        for url, _ in sitemaps:
+            yield self.sitemap_request(url)
+
+        if self.discovery_engine != "scroll" and not self.checkpoint.has_flag("sitemap_started"):
+            for request in self.sitemap_requests():
+                yield request
+        if self.discovery_engine != "sitemap" and not self.checkpoint.has_flag("home_finished"):
+            for request in self.discovery_requests():
+                yield request
 
+    def category_request(self, category_url, extra_data, priority=0):
+        if self.checkpoint is not None:
+            self.checkpoint.add("category", category_url, extra_data)
+        return scrapy.Request(category_url, callback=self.parse_category, priority=priority, meta={
+            "extra_data": extra_data,
+            "playwright": True,
+            "crawl_stage": "category",
+            "playwright_page_methods": readiness_page_methods("category", ".plp-carousel__link", self.settings),
+        })
 
     def parse(self, response):
         """
             Extract categories from the main page
         """
         try:
+            self.record_readiness(response)
             self.logger.debug("start parsing")
             category_selectors = response.css(".pc-sidenavbar a")
             self.logger.debug(f"parsing ${len(category_selectors)}")
+            max_categories = self.crawl_limit("max_categories")
+            categories_found = 0
+            category_urls = []
 
             for selector in category_selectors:
                 category = selector.css("span::text").get()
                 self.logger.debug(f"cat is {category}")
                 if category in self.categories_to_be_scrapped:
+                    categories_found += 1
+                    if max_categories is not None and categories_found > max_categories:
+                        break
                     category_url = selector.attrib["href"]
                     self.logger.debug(f"cat url  {category_url}")
 
@@ -78,28 +586,30 @@ class TopsOnlineSpider(scrapy.Spider):
                         category_url = response.urljoin(category_url)
                     self.logger.debug(f"cat url after  {category_url}")
 
-                    yield scrapy.Request(category_url, callback=self.parse_category, meta={
-                        "extra_data": {
-                            "category": category
-                        }, 
-                        "playwright": True,
-                        "playwright_page_methods": [
-                            PageMethod("wait_for_timeout", 3000),
-                            PageMethod("wait_for_selector", ".plp-carousel__link", timeout = 300 * 1000),
-                        ],
-                    })
+                    category_urls.append(category_url)
+                    # a background refresh of the discovery cache keeps its lower priority
+                    for request in self.follow("category", category_url, {"category": category}, response.request.priority):
+                        yield request
 
+            if self.discovery_cache is not None:
+                self.discovery_cache.categories_found(category_urls)
+            if self.checkpoint is not None:
+                self.checkpoint.set_flag("home_finished")
         except Exception as e:
             self.logger.error(f'Unexpected error in parse: {e}')
 
+        for request in self.finish_shard_unit(response.request):
+            yield request
+
     def parse_category(self, response):
         """
             Extract subcategories from each category
         """
         try:
+            self.record_readiness(response)
             self.logger.debug("parsing category ")
 
-            subcategory_selectors = response.css(".plp-carousel")
+            subcategory_selectors = response.css(".plp-carousel")[:self.crawl_limit("max_subcategories")]
 
             self.logger.debug(f"sub cats are {len(subcategory_selectors)}")
             for selector in subcategory_selectors:
@@ -112,52 +622,321 @@ class TopsOnlineSpider(scrapy.Spider):
 
                 self.logger.debug(f"view all url is {view_all_url}")
 
-                yield scrapy.Request(view_all_url, callback=self.parse_subcategory, meta={
-                    "extra_data": {**response.meta["extra_data"], "subcategory": subcategory},
-                    "playwright": True,
-                    "playwright_page_methods": [
-                        PageMethod("wait_for_timeout", 3000),
-                        # wait for the items to be loaded first
-                        PageMethod("wait_for_selector", "img.product-item-image", timeout = 300 * 1000),
-                        # scroll to the bottom of the list to load more items
-                        PageMethod("evaluate", self.scrolling_infinite_list_script),
-                    ],
-                })
+                extra_data = {**response.meta["extra_data"], "subcategory": subcategory}
+                if self.discovery_cache is not None:
+                    self.discovery_cache.add_list(view_all_url, extra_data)
+                    if view_all_url in self.cached_lists:
+                        # already scheduled from the discovery cache
+                        continue
+                    if self.cached_lists:
+                        self.crawler.stats.inc_value("discovery_cache/new_lists")
+
+                for request in self.follow("list", view_all_url, extra_data):
+                    yield request
+
+            if self.discovery_cache is not None and subcategory_selectors:
+                # a category that came out empty leaves the tree incomplete, so it is not cached
+                self.discovery_cache.category_finished(response.request.url)
+            if self.checkpoint is not None:
+                self.checkpoint.finish(response.request.url)
         except Exception as e:
             self.logger.error(f'Unexpected error in parse_category: {e}')
 
-    def parse_subcategory(self, response):
+        for request in self.finish_shard_unit(response.request):
+            yield request
+
+    def subcategory_request(self, view_all_url, extra_data, priority=0):
+        if self.checkpoint is not None:
+            self.checkpoint.add("list", view_all_url, extra_data)
+
+        meta = {
+            "extra_data": extra_data,
+            "playwright": True,
+            "crawl_stage": "subcategory",
+            "playwright_page_methods": [
+                # wait for the items to be loaded first
+                *readiness_page_methods("subcategory", "img.product-item-image", self.settings),
+            ],
+        }
+        if self.settings.getbool("STREAMING_HARVEST_ENABLED"):
+            # the list is scrolled from parse_subcategory, which schedules the products while they load
+            meta["playwright_include_page"] = True
+            meta["streaming_harvest"] = True
+        else:
+            # scroll to the bottom of the list to load more items. The links harvested while scrolling are kept
+            # in the "harvested_links" meta key, so they are not lost if the page fails before the end of the list
+            meta["playwright_page_methods"].append(scrolling_page_method(".product-item a", self.settings, harvest_binding=harvest_binding, prune_selector=self.scroll_prune_selector()))
+            meta["harvest_links"] = True
+
+        if self.settings.getbool("LISTING_CAPTURE_ENABLED"):
+            # keep the product batches the page loads while scrolling
+            meta["playwright_include_page"] = True
+            meta["playwright_page_event_handlers"] = {"response": "capture_listing_response"}
+
+        return scrapy.Request(view_all_url, callback=self.parse_subcategory, errback=self.subcategory_failed, priority=priority, meta=meta)
+
+    async def capture_listing_response(self, response):
+        """
+            Keep the JSON product batches loaded by a subcategory page while it is being scrolled
+        """
+        try:
+            if response.request.resource_type not in ("xhr", "fetch"):
+                return
+            if not any(re.search(pattern, response.url) for pattern in self.settings.getlist("LISTING_CAPTURE_URL_PATTERNS")):
+                return
+
+            payload = await response.json()
+            self.captured_listings.setdefault(response.frame.page, []).append(payload)
+            self.crawler.stats.inc_value("listing_capture/responses")
+        except Exception as e:
+            self.logger.debug(f"Could not capture listing response {response.url}: {e}")
+
+    async def subcategory_failed(self, failure):
+        """
+            Close the page of a subcategory that failed, and still handle the products it harvested before failing
+        """
+        page = failure.request.meta.get("playwright_page")
+        if page:
+            self.captured_listings.pop(page, None)
+            await page.close()
+
+        if failure.check(RetryScheduled):
+            # the retry, carrying the harvested links, is handled once it is sent again
+            return
+
+        harvested_links = failure.request.meta.get("harvested_links")
+        if harvested_links and "extra_data" in failure.request.meta:
+            self.logger.info(f"Recovering {len(harvested_links)} products harvested from {failure.request.url} before it failed")
+            self.crawler.stats.inc_value("retry/recovered_links", len(harvested_links))
+            for result in self.products_or_detail_requests(failure.request, harvested_links, {}, set()):
+                yield result
+
+        for request in self.finish_shard_unit(failure.request):
+            yield request
+
+    async def parse_subcategory(self, response):
         """
             Extract the url to the product details page of each product in the product list
         """
+        page = response.meta.get("playwright_page")
         try:
-            product_selectors = response.css(".product-item a")
-                
-            for selector in product_selectors:
-                product_detail_url = selector.attrib["href"]
-                self.logger.debug(f"detail url is {product_detail_url}")
-
-                yield scrapy.Request(product_detail_url, callback=self.parse_details, meta={
-                    "extra_data": {
-                        **response.meta["extra_data"],
-                        "url": product_detail_url,
-                    },
-                    "playwright": True,
-                    "playwright_page_methods": [
-                        PageMethod("wait_for_timeout", 3000),
-                        # wait for the items to be loaded first
-                        PageMethod("wait_for_selector", ".product-Details-page-root .add-to-cart", timeout = 300 * 1000),
-                    ],
-                })
+            self.record_readiness(response)
+            listed_products = {}
+            scheduled_urls = set()
+
+            if page and response.meta.get("streaming_harvest"):
+                # schedule the products of each batch while the rest of the list is still loading
+                scroll_method = scrolling_page_method(".product-item a", self.settings, harvest_binding=harvest_binding, prune_selector=self.scroll_prune_selector())
+                async for product_detail_urls in stream_product_links(page, scroll_method):
+                    self.crawler.stats.inc_value("streaming_harvest/batches")
+                    self.collect_listed_products(page, response.url, listed_products)
+                    for result in self.products_or_detail_requests(response, product_detail_urls, listed_products, scheduled_urls, priority=self.settings.getint("STREAMING_DETAIL_PRIORITY")):
+                        yield result
+                record_page_method(self.crawler.stats, scroll_method, histogram_buckets(self.settings, "READINESS_HISTOGRAM_BUCKETS_MS"), self.list_label(response))
+
+            if page:
+                self.collect_listed_products(page, response.url, listed_products)
+
+            product_detail_urls = []
+            listing_signals = {}
+            for selector in response.css(".product-item"):
+                for href in selector.css("a::attr(href)").getall():
+                    product_detail_url = response.urljoin(href)
+                    product_detail_urls.append(product_detail_url)
+                    # the name, price and labels shown in the list
+                    listing_signals[product_detail_url] = listing_signature(selector.css("::text").getall())
+            # in low memory mode the scrolled items are no longer in the page, their links were harvested while scrolling
+            product_detail_urls += response.meta.get("harvested_links") or []
+            # products that only showed up in the captured responses
+            product_detail_urls += [url for url in listed_products if url not in product_detail_urls]
+
+            for result in self.products_or_detail_requests(response, product_detail_urls, listed_products, scheduled_urls, listing_signals=listing_signals):
+                yield result
+
+            if self.checkpoint is not None:
+                self.checkpoint.finish(response.request.url)
         except Exception as e:
             self.logger.error(f'Unexpected error in parse_subcategory: {e}')
+        finally:
+            if page:
+                self.captured_listings.pop(page, None)
+                await page.close()
 
+        for request in self.finish_shard_unit(response.request):
+            yield request
 
-    def parse_details(self, response):
+    def collect_listed_products(self, page, base_url, listed_products):
         """
-            Extract product information from the product detail page
+            Move the products of the listing responses captured so far for the page into listed_products, keyed by url
         """
-        try:
+        payloads = self.captured_listings.get(page, [])
+        while payloads:
+            for fields in products_from_listing_payload(payloads.pop(0), base_url):
+                listed_products[fields["url"]] = fields
+
+    def products_or_detail_requests(self, response, product_detail_urls, listed_products, scheduled_urls, priority=0, listing_signals=None):
+        """
+            Yield the product item or details page request of each product of a list.
+            Urls in scheduled_urls are skipped, and the new ones are added to it, up to max_products of them.
+            In dedup mode, the products are only recorded here and handled once every list has been seen
+        """
+        max_products = self.crawl_limit("max_products")
+        for product_detail_url in product_detail_urls:
+            if product_detail_url in scheduled_urls:
+                continue
+            if max_products is not None and len(scheduled_urls) >= max_products:
+                break
+            scheduled_urls.add(product_detail_url)
+            self.note_discovered("scroll", product_detail_url)
+            if self.discovery_engine == "sitemap":
+                # a scroll pass recovering the category of the products of the sitemap
+                product_item = self.awaiting_membership.pop(product_detail_url, None)
+                if product_item is not None:
+                    self.set_membership(product_item, response.meta["extra_data"]["category"], response.meta["extra_data"]["subcategory"])
+                    self.crawler.stats.inc_value("sitemap/membership_scroll")
+                    yield product_item
+                    continue
+                if product_detail_url in self.discovered["sitemap"]:
+                    continue
+                # missing from the sitemap, rendered from the list as usual
+            if self.checkpoint is not None and self.checkpoint.is_finished(product_detail_url):
+                # already exported before the crawl was interrupted
+                self.crawler.stats.inc_value("checkpoint/skipped_products")
+                continue
+
+            self.logger.debug(f"detail url is {product_detail_url}")
+            extra_data = {
+                **response.meta["extra_data"],
+                "url": product_detail_url,
+            }
+            if self.shard_frontier is not None and not self.shard_frontier.claim_product(product_detail_url, extra_data):
+                # found first by another list, of this worker or another one, only its category is kept for the merged feed
+                self.crawler.stats.inc_value("shard/products_skipped")
+                continue
+            fields = listed_products.get(product_detail_url)
+            listing_signal = (listing_signals or {}).get(product_detail_url)
+
+            if self.settings.getbool("PRODUCT_DEDUP_ENABLED"):
+                self.defer_product(product_detail_url, extra_data, fields, listing_signal, priority)
+                continue
+
+            if self.checkpoint is not None:
+                self.checkpoint.add("product", product_detail_url, extra_data)
+            for result in self.product_or_detail_request(product_detail_url, extra_data, fields, listing_signal, priority):
+                yield result
+
+    def product_or_detail_request(self, product_detail_url, extra_data, fields, listing_signal, priority=0):
+        """
+            Yield the product item of a listed product that is already complete or unchanged since the last crawl,
+            or else the request for its details page
+        """
+        if self.product_store is not None:
+            if fields:
+                signature = listing_signature([fields.get("product_name"), fields.get("price"), *fields.get("labels", [])])
+            else:
+                signature = listing_signal
+
+            record = self.product_store.get(product_detail_url)
+            if self.product_store.is_fresh(record, signature, self.settings.getfloat("INCREMENTAL_TTL_HOURS") * 3600):
+                # unchanged since the last crawl, no need to render it again
+                self.product_store.touch(record["url"])
+                self.crawler.stats.inc_value("incremental/carried_forward")
+                if self.checkpoint is not None:
+                    self.checkpoint.finish(product_detail_url)
+                if self.settings.get("INCREMENTAL_OUTPUT") == "snapshot":
+                    yield self.stored_product_item(record, extra_data)
+                return
+            self.listing_signatures[product_detail_url] = signature
+
+        if fields and all(fields.get(field) for field in self.settings.getlist("LISTING_CAPTURE_REQUIRED_FIELDS")):
+            # everything is already known, no need to visit the details page
+            self.crawler.stats.inc_value("listing_capture/items")
+            yield self.product_item_from_fields(fields, extra_data)
+            return
+
+        if self.settings.getbool("LISTING_CAPTURE_ENABLED"):
+            self.crawler.stats.inc_value("listing_capture/detail_requests")
+        yield self.detail_request(product_detail_url, extra_data, priority=priority)
+
+    def defer_product(self, product_detail_url, extra_data, fields, listing_signal, priority):
+        """
+            Record a product found in a list, merging the categories of every list it was found in
+        """
+        membership = {"category": extra_data["category"], "subcategory": extra_data["subcategory"]}
+        deferred = self.deferred_products.get(product_detail_url)
+
+        if deferred is None:
+            self.deferred_products[product_detail_url] = {
+                "extra_data": {**extra_data, "categories": [membership]},
+                "fields": fields,
+                "listing_signal": listing_signal,
+                "priority": priority,
+            }
+            self.crawler.stats.inc_value("dedup/unique_products")
+            if self.checkpoint is not None:
+                self.checkpoint.add("product", product_detail_url, self.deferred_products[product_detail_url]["extra_data"])
+            return
+
+        # already found in another list, it will only be rendered once
+        self.crawler.stats.inc_value("dedup/renders_avoided")
+        if membership not in deferred["extra_data"]["categories"]:
+            deferred["extra_data"]["categories"].append(membership)
+        deferred["fields"] = deferred["fields"] or fields
+        deferred["listing_signal"] = deferred["listing_signal"] or listing_signal
+        if self.checkpoint is not None:
+            self.checkpoint.add("product", product_detail_url, deferred["extra_data"])
+
+    def schedule_deferred_products(self, spider):
+        """
+            Once every list has been scrolled and the spider goes idle, handle the products recorded in dedup mode
+        """
+        if self.deferred_products and not self.retries_pending():
+            # items can only be emitted from a callback, so go through a request that needs no download
+            self.crawler.engine.crawl(scrapy.Request("data:,", callback=self.parse_deferred_products, dont_filter=True))
+            raise DontCloseSpider
+
+    def parse_deferred_products(self, response):
+        """
+            Yield the product item or details page request of each product recorded in dedup mode
+        """
+        deferred_products, self.deferred_products = self.deferred_products, {}
+        for product_detail_url, deferred in deferred_products.items():
+            try:
+                for result in self.product_or_detail_request(product_detail_url, deferred["extra_data"], deferred["fields"], deferred["listing_signal"], deferred["priority"]):
+                    yield result
+            except Exception as e:
+                self.logger.error(f'Unexpected error in parse_deferred_products: {e}')
+
+    def detail_request(self, product_detail_url, extra_data, use_playwright=None, priority=0):
+        """
+            Build the request for a product details page.
+            Unless Playwright is asked for explicitly, the page is fetched over plain HTTP first when the fast path is enabled
+        """
+        if use_playwright is None:
+            use_playwright = not self.settings.getbool("DETAIL_FAST_PATH_ENABLED")
+
+        if not use_playwright:
+            return scrapy.Request(product_detail_url, callback=self.parse_details_http, priority=priority, meta={
+                "extra_data": extra_data,
+                "crawl_stage": "detail",
+            })
+
+        return scrapy.Request(product_detail_url, callback=self.parse_details, priority=priority, meta={
+            "extra_data": extra_data,
+            "playwright": True,
+            "crawl_stage": "detail",
+            # wait for the items to be loaded first
+            "playwright_page_methods": readiness_page_methods("detail", ".product-Details-page-root .add-to-cart", self.settings),
+        })
+
+    def extract_product(self, response):
+        """
+            Extract the raw product fields from a product detail page, as a ProductRecord in a single pass
+            over the page with COMPACT_ITEMS_ENABLED
+        """
+        if self.settings.getbool("COMPACT_ITEMS_ENABLED"):
+            product_item = ProductRecord(**extract_detail_fields(response))
+        else:
             product_item = ProductItem()
 
             product_item["product_name"] = response.css(".product-tile__name::text").get()
@@ -167,10 +946,87 @@ class TopsOnlineSpider(scrapy.Spider):
             product_item["product_details"] = response.css('.accordion-property').xpath('.//text()').getall()
             product_item["price"] = response.css(".product-Details-current-price::text").get()
             product_item["labels"] = response.css(".product-Details-seasonal-label::text, .product-Details-promo .promo-name").xpath('.//text()').getall()
-            product_item["url"] = response.meta["extra_data"]["url"]
-            product_item["category"] = response.meta["extra_data"]["category"]
-            product_item["subcategory"] = response.meta["extra_data"]["subcategory"]
-        
-            yield product_item
+        product_item["url"] = response.meta["extra_data"]["url"]
+        product_item["category"] = response.meta["extra_data"]["category"]
+        product_item["subcategory"] = response.meta["extra_data"]["subcategory"]
+        product_item["categories"] = self.categories(response.meta["extra_data"])
+
+        return product_item
+
+    def categories(self, extra_data):
+        # every (category, subcategory) the product was found in, only merged in dedup mode
+        return extra_data.get("categories") or [{"category": extra_data["category"], "subcategory": extra_data["subcategory"]}]
+
+    def product_item_from_fields(self, fields, extra_data):
+        """
+            Build a product item from raw fields collected outside of the detail page
+        """
+        product_item = ProductItem()
+
+        product_item["product_name"] = fields.get("product_name")
+        product_item["product_images"] = fields.get("product_images", [])
+        product_item["bar_code_number"] = fields.get("bar_code_number")
+        product_item["product_details"] = fields.get("product_details", [])
+        product_item["price"] = fields.get("price")
+        product_item["labels"] = fields.get("labels", [])
+        product_item["url"] = extra_data["url"]
+        product_item["category"] = extra_data["category"]
+        product_item["subcategory"] = extra_data["subcategory"]
+        product_item["categories"] = self.categories(extra_data)
+
+        return product_item
+
+    def stored_product_item(self, record, extra_data):
+        """
+            Build a product item from a record of the incremental store, for the category it was found in this time
+        """
+        product_item = StoredProductItem(json.loads(record["item"]))
+
+        product_item["url"] = extra_data["url"]
+        product_item["category"] = extra_data["category"]
+        product_item["subcategory"] = extra_data["subcategory"]
+        product_item["categories"] = self.categories(extra_data)
+
+        return product_item
+
+    def parse_details(self, response):
+        """
+            Extract product information from the product detail page
+        """
+        try:
+            self.record_readiness(response)
+            self.crawler.stats.inc_value("detail_pages/playwright")
+            for product_item in self.sitemap_membership(self.extract_product(response), response):
+                yield product_item
+        except Exception as e:
+            self.logger.error(f'Unexpected error in parse_details: {e}')
+
+    def parse_details_http(self, response):
+        """
+            Extract product information from the server-rendered product detail page.
+            The request is sent again through Playwright if any of the required fields is missing
+        """
+        try:
+            product_item = self.extract_product(response)
+
+            # fill the gaps from the structured data embedded in the page
+            for field, value in extract_embedded_product(response).items():
+                if not product_item.get(field):
+                    product_item[field] = value
+
+            missing_fields = [field for field in self.settings.getlist("DETAIL_FAST_PATH_REQUIRED_FIELDS") if not product_item.get(field)]
+            if missing_fields:
+                self.logger.debug(f"fields {missing_fields} missing from {response.url}, falling back to playwright")
+                self.crawler.stats.inc_value("detail_pages/http_fallback")
+
+                fallback_request = self.detail_request(response.request.url, response.meta["extra_data"], use_playwright=True, priority=response.request.priority)
+                # the url has already been seen by the dupefilter
+                fallback_request.dont_filter = True
+                yield fallback_request
+                return
+
+            self.crawler.stats.inc_value("detail_pages/http")
+            for product_item in self.sitemap_membership(product_item, response):
+                yield product_item
         except Exception as e:
-            self.logger.error(f'Unexpected error in parse_details: {e}')
\ No newline at end of file
+            self.logger.error(f'Unexpected error in parse_details_http: {e}')
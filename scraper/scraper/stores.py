@@ -0,0 +1,442 @@
+# Local on-disk stores used to carry crawl state over between runs
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+
+# the product urls end with the barcode, e.g. /en/chao-thai-coconut-powder-60g-8852114531602
+URL_BAR_CODE_PATTERN = re.compile(r'-(\d{8,14})/?$')
+
+# the fields describing the product itself, as opposed to where it was found
+CONTENT_FIELDS = ["product_name", "product_images", "quantity", "bar_code_number", "product_details", "price", "labels"]
+
+
+def bar_code_from_url(url):
+    match = URL_BAR_CODE_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+def listing_signature(values):
+    """
+        Hash the listing-level signals of a product (name, price, labels...), whitespace insensitive
+    """
+    text = " ".join(" ".join(str(value).split()) for value in values if value)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest() if text else None
+
+
+def content_fingerprint(item):
+    """
+        Hash the content fields of a normalized product item
+    """
+    content = {field: item.get(field) for field in CONTENT_FIELDS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ProductStore:
+    """
+        SQLite store of the products seen by previous crawls, keyed by url and barcode.
+        Each record keeps the last exported item, its content fingerprint, the listing signature it was rendered with
+        and when it was last seen and last rendered
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS products (
+                url TEXT PRIMARY KEY,
+                bar_code_number TEXT,
+                fingerprint TEXT,
+                listing_signature TEXT,
+                item TEXT,
+                last_seen REAL,
+                last_rendered REAL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS products_bar_code ON products (bar_code_number)")
+        self.connection.commit()
+
+    def get(self, url):
+        """
+            Return the record of a product by url, or by the barcode in the url if the url changed
+        """
+        row = self.connection.execute("SELECT * FROM products WHERE url = ?", (url,)).fetchone()
+        bar_code = bar_code_from_url(url)
+        if row is None and bar_code:
+            row = self.connection.execute(
+                "SELECT * FROM products WHERE bar_code_number = ? ORDER BY last_seen DESC", (bar_code,)
+            ).fetchone()
+        return row
+
+    def is_fresh(self, record, signature, ttl):
+        """
+            Whether a record can be carried forward: rendered within ttl seconds and with unchanged listing signals
+        """
+        if record is None or record["item"] is None:
+            return False
+        if time.time() - record["last_rendered"] > ttl:
+            return False
+        # without listing signals only the age of the record can be checked
+        return signature is None or signature == record["listing_signature"]
+
+    def save(self, item, fingerprint, signature):
+        now = time.time()
+        self.connection.execute("""
+            INSERT INTO products (url, bar_code_number, fingerprint, listing_signature, item, last_seen, last_rendered)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET
+                bar_code_number = excluded.bar_code_number,
+                fingerprint = excluded.fingerprint,
+                listing_signature = COALESCE(excluded.listing_signature, products.listing_signature),
+                item = excluded.item,
+                last_seen = excluded.last_seen,
+                last_rendered = excluded.last_rendered
+        """, (item["url"], item.get("bar_code_number"), fingerprint, signature, json.dumps(item, ensure_ascii=False), now, now))
+        self.connection.commit()
+
+    def touch(self, url):
+        # committed with the next save, or when the store is closed
+        self.connection.execute("UPDATE products SET last_seen = ? WHERE url = ?", (time.time(), url))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class CheckpointStore:
+    """
+        SQLite checkpoint of a running crawl, to resume it after a crash or a deploy.
+        Keeps whether the home page was handled and the sitemaps were found, and every category, subcategory list,
+        sitemap and product found so far, with its extra_data and whether it is still pending or finished.
+        Writes are committed every commit_every writes or commit_interval seconds, whichever comes first
+    """
+
+    def __init__(self, path, commit_every=100, commit_interval=10):
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS frontier (
+                url TEXT PRIMARY KEY,
+                kind TEXT,
+                extra_data TEXT,
+                finished INTEGER DEFAULT 0
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS frontier_pending ON frontier (kind, finished)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+    def wrote(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def add(self, kind, url, extra_data):
+        """
+            Record a pending category, list, sitemap or product. The extra_data of a pending one is updated, a finished one is left as is
+        """
+        self.connection.execute("""
+            INSERT INTO frontier (url, kind, extra_data) VALUES (?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET extra_data = excluded.extra_data WHERE finished = 0
+        """, (url, kind, json.dumps(extra_data, ensure_ascii=False)))
+        self.wrote()
+
+    def finish(self, url):
+        self.connection.execute("UPDATE frontier SET finished = 1 WHERE url = ?", (url,))
+        self.wrote()
+
+    def is_finished(self, url):
+        row = self.connection.execute("SELECT finished FROM frontier WHERE url = ?", (url,)).fetchone()
+        return bool(row and row["finished"])
+
+    def pending(self, kind):
+        """
+            Return the (url, extra_data) of the pending categories, lists, sitemaps or products
+        """
+        rows = self.connection.execute("SELECT url, extra_data FROM frontier WHERE kind = ? AND finished = 0", (kind,))
+        return [(row["url"], json.loads(row["extra_data"])) for row in rows]
+
+    def set_flag(self, name):
+        self.connection.execute("INSERT OR IGNORE INTO flags (name) VALUES (?)", (name,))
+        self.commit()
+
+    def has_flag(self, name):
+        return self.connection.execute("SELECT 1 FROM flags WHERE name = ?", (name,)).fetchone() is not None
+
+    def reset(self):
+        self.connection.execute("DELETE FROM frontier")
+        self.connection.execute("DELETE FROM flags")
+        self.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class ShardFrontier:
+    """
+        SQLite frontier shared by the worker processes of a sharded crawl.
+        The home page, categories and subcategory lists are units of work claimed by one worker at a time.
+        Products are claimed by the first worker whose list finds them, which renders them, and every
+        category/subcategory they were found under is kept so the merged feed has all of them
+    """
+
+    # the products handed back by a crashed worker first, then lists, then categories and the home page last,
+    # so products start flowing as soon as possible
+    KIND_ORDER = "CASE kind WHEN 'product' THEN 0 WHEN 'list' THEN 1 WHEN 'category' THEN 2 ELSE 3 END"
+
+    def __init__(self, path, worker=None):
+        self.worker = worker
+        # several processes write to it, wait for the others instead of failing
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+                url TEXT PRIMARY KEY,
+                kind TEXT,
+                extra_data TEXT,
+                state TEXT DEFAULT 'pending',
+                worker TEXT
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state, worker)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS products (
+                url TEXT PRIMARY KEY,
+                worker TEXT,
+                extra_data TEXT,
+                done INTEGER DEFAULT 0
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS memberships (
+                url TEXT,
+                category TEXT,
+                subcategory TEXT,
+                PRIMARY KEY (url, category, subcategory)
+            )
+        """)
+
+    def add(self, kind, url, extra_data):
+        """
+            Add a unit of work, unless it is already known
+        """
+        self.connection.execute(
+            "INSERT OR IGNORE INTO units (url, kind, extra_data) VALUES (?, ?, ?)",
+            (url, kind, json.dumps(extra_data, ensure_ascii=False)),
+        )
+
+    def claim(self, count):
+        """
+            Claim up to count pending units for this worker, returned as (kind, url, extra_data)
+        """
+        if count <= 0:
+            return []
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute(
+                f"SELECT url, kind, extra_data FROM units WHERE state = 'pending' ORDER BY {self.KIND_ORDER}, rowid LIMIT ?",
+                (count,),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE units SET state = 'claimed', worker = ? WHERE url = ?",
+                [(self.worker, row["url"]) for row in rows],
+            )
+            self.connection.executemany(
+                "UPDATE products SET worker = ? WHERE url = ?",
+                [(self.worker, row["url"]) for row in rows if row["kind"] == "product"],
+            )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return [(row["kind"], row["url"], json.loads(row["extra_data"])) for row in rows]
+
+    def finish(self, url):
+        self.connection.execute("UPDATE units SET state = 'done' WHERE url = ?", (url,))
+
+    def claim_product(self, url, extra_data):
+        """
+            Record the category/subcategory a product was found under, and return whether this worker should render it:
+            the first worker finding a product owns it
+        """
+        self.connection.execute(
+            "INSERT OR IGNORE INTO memberships (url, category, subcategory) VALUES (?, ?, ?)",
+            (url, extra_data["category"], extra_data["subcategory"]),
+        )
+        self.connection.execute(
+            "INSERT OR IGNORE INTO products (url, worker, extra_data) VALUES (?, ?, ?)",
+            (url, self.worker, json.dumps(extra_data, ensure_ascii=False)),
+        )
+        row = self.connection.execute("SELECT worker FROM products WHERE url = ?", (url,)).fetchone()
+        return row["worker"] == self.worker
+
+    def finish_product(self, url):
+        self.connection.execute("UPDATE products SET done = 1 WHERE url = ?", (url,))
+        self.finish(url)
+
+    def release(self, worker):
+        """
+            Hand the work of a worker that stopped back to the others: its claimed units go back to pending,
+            and the products it owned but did not export become units of their own. Returns how many were released
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            released = self.connection.execute(
+                "UPDATE units SET state = 'pending', worker = NULL WHERE state = 'claimed' AND worker = ?", (worker,)
+            ).rowcount
+            released += self.connection.execute("""
+                INSERT OR IGNORE INTO units (url, kind, extra_data)
+                SELECT url, 'product', extra_data FROM products WHERE worker = ? AND done = 0
+            """, (worker,)).rowcount
+            # whoever claims them owns them now
+            self.connection.execute("UPDATE products SET worker = NULL WHERE worker = ? AND done = 0", (worker,))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return released
+
+    def unfinished(self):
+        """
+            Return how many units are still pending or claimed
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM units WHERE state != 'done'").fetchone()[0]
+
+    def progress(self):
+        """
+            Return the number of units of each kind and state, and of products claimed and exported
+        """
+        rows = self.connection.execute("SELECT kind, state, COUNT(*) AS count FROM units GROUP BY kind, state")
+        progress = {f"{row['kind']}/{row['state']}": row["count"] for row in rows}
+        row = self.connection.execute("SELECT COUNT(*) AS claimed, COALESCE(SUM(done), 0) AS done FROM products").fetchone()
+        progress["products/claimed"] = row["claimed"]
+        progress["products/done"] = row["done"]
+        return progress
+
+    def memberships(self):
+        """
+            Return every category/subcategory each product was found under, by url
+        """
+        memberships = {}
+        for row in self.connection.execute("SELECT url, category, subcategory FROM memberships ORDER BY rowid"):
+            memberships.setdefault(row["url"], []).append({"category": row["category"], "subcategory": row["subcategory"]})
+        return memberships
+
+    def close(self):
+        self.connection.close()
+
+
+class DiscoveryCache:
+    """
+        JSON file keeping the category tree resolved by the discovery stages: the view all url of each subcategory
+        list with its category and subcategory, so repeat runs can start from the lists. The tree found by the
+        current run is only saved once every category found on the home page has been handled
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        # what the tree depends on (start urls, categories, crawl limits), a cache saved for another key is not used
+        self.key = key
+        self.lists = {}
+        # urls of the categories found on the home page and not handled yet
+        self.pending_categories = None
+
+    def load(self):
+        """
+            Return the age in seconds and the (url, extra_data) of each list of the cached tree,
+            or None if there is no tree cached for this key
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("key") != self.key:
+            return None
+        return time.time() - cache["created_at"], [(entry["url"], entry["extra_data"]) for entry in cache["lists"]]
+
+    def categories_found(self, urls):
+        self.pending_categories = set(urls)
+
+    def add_list(self, url, extra_data):
+        self.lists[url] = extra_data
+
+    def category_finished(self, url):
+        if self.pending_categories is not None:
+            self.pending_categories.discard(url)
+
+    @property
+    def complete(self):
+        return self.pending_categories is not None and not self.pending_categories
+
+    def save(self):
+        cache = {
+            "key": self.key,
+            "created_at": time.time(),
+            "lists": [{"url": url, "extra_data": extra_data} for url, extra_data in self.lists.items()],
+        }
+        # written next to the cache and renamed, so a crash never leaves half a tree behind
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+class ImageIndex:
+    """
+        SQLite index of the product images downloaded by previous crawls, by normalized url: the content-addressed path
+        the image is stored under, its checksum, the ETag and Last-Modified it was served with, and when it was last checked
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                url TEXT PRIMARY KEY,
+                path TEXT,
+                checksum TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                checked_at REAL
+            )
+        """)
+        self.connection.commit()
+
+    def get(self, url):
+        return self.connection.execute("SELECT * FROM images WHERE url = ?", (url,)).fetchone()
+
+    def save(self, url, path, checksum, etag, last_modified):
+        self.connection.execute("""
+            INSERT INTO images (url, path, checksum, etag, last_modified, checked_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET
+                path = excluded.path,
+                checksum = excluded.checksum,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                checked_at = excluded.checked_at
+        """, (url, path, checksum, etag, last_modified, time.time()))
+        self.connection.commit()
+
+    def touch(self, url):
+        # committed with the next save, or when the index is closed
+        self.connection.execute("UPDATE images SET checked_at = ? WHERE url = ?", (time.time(), url))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,88 @@
+import io
+import json
+
+import pytest
+from itemadapter import ItemAdapter
+from scrapy.exporters import JsonLinesItemExporter
+
+from scraper.exporters import JsonLinesPartWriter, ParquetPartWriter, pyarrow
+from scraper.items import ProductItem, ProductRecord
+from scraper.pipelines import normalize_fields
+from scraper.stores import content_fingerprint
+
+
+def compact_product():
+    return ProductRecord(
+        product_name="Chao Thai Coconut Powder 60g",
+        product_images=["https://assets.tops.co.th/8852114531602-1"],
+        category="Pantry & Ingredients",
+        subcategory="Seasonings & Spices",
+        bar_code_number="SKU 8852114531602",
+        product_details="Storage: Keep in a cool and dry place.",
+        price="฿18.00",
+        url="https://www.tops.co.th/en/chao-thai-coconut-powder-60g-8852114531602",
+    )
+
+
+def test_unset_fields_are_missing_keys():
+    adapter = ItemAdapter(compact_product())
+
+    assert adapter.get("quantity") is None
+    assert "quantity" not in adapter
+    assert "image_files" not in adapter
+    assert "quantity" not in adapter.asdict()
+    with pytest.raises(KeyError):
+        adapter["quantity"]
+
+    adapter["quantity"] = "60g"
+    assert adapter["quantity"] == "60g"
+    assert "quantity" in adapter
+
+
+def test_fingerprint_before_normalization():
+    # normalization failing before the quantity is set leaves it unset
+    record = compact_product()
+    item = ProductItem(ItemAdapter(compact_product()).asdict())
+
+    assert content_fingerprint(ItemAdapter(record)) == content_fingerprint(ItemAdapter(item))
+
+
+def test_exported_like_a_product_item():
+    record, item = compact_product(), ProductItem(ItemAdapter(compact_product()).asdict())
+    normalize_fields(ItemAdapter(record))
+    normalize_fields(ItemAdapter(item))
+
+    assert content_fingerprint(ItemAdapter(record)) == content_fingerprint(ItemAdapter(item))
+    assert ItemAdapter(record).asdict() == ItemAdapter(item).asdict()
+
+    exported = []
+    for product in (record, item):
+        output = io.BytesIO()
+        exporter = JsonLinesItemExporter(output)
+        exporter.start_exporting()
+        exporter.export_item(product)
+        exporter.finish_exporting()
+        exported.append(json.loads(output.getvalue()))
+    assert exported[0] == exported[1]
+    assert "image_files" not in exported[0]
+
+
+def test_part_writers(tmp_path):
+    record = compact_product()
+    normalize_fields(ItemAdapter(record))
+    row = ItemAdapter(record).asdict()
+
+    writer = JsonLinesPartWriter(str(tmp_path / "part.jsonl"))
+    writer.write_batch([row])
+    writer.close()
+    assert json.loads((tmp_path / "part.jsonl").read_text(encoding="utf-8")) == row
+
+    if pyarrow is None:
+        pytest.skip("pyarrow is not installed")
+    writer = ParquetPartWriter(str(tmp_path / "part.parquet"))
+    assert writer.write_batch([row]) == 0
+    writer.close()
+    table = pyarrow.parquet.read_table(str(tmp_path / "part.parquet"))
+    assert table.num_rows == 1
+    assert table.column("quantity").to_pylist() == [row["quantity"]]
+    assert table.column("image_files").to_pylist() in ([None], [[]])